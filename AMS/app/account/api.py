@@ -1,6 +1,5 @@
 from typing import Optional, List
 
-from json import dumps as json_dumps
 from enum import Enum, unique
 
 import ujson
@@ -8,13 +7,16 @@ from sanic import Blueprint, Request, json
 from sanic.exceptions import InvalidUsage
 from sanic.log import logger
 from schema import Schema, And, SchemaError
-from sqlalchemy import select
+from sqlalchemy import select, null
 from sqlalchemy.engine import Row
 from stellar_sdk import Keypair
 
-from AMS.core import ams_crypt, AMSCore
+from AMS.core import ams_crypt, AMSCore, ACC_HASH_V2, ACC_PUBLIC_FIELDS, ASSET_MAX_LENGTH, transfer, executor, \
+    replicas
 from AMS.core.ams_crypt import AMSCrypt
-from AMS.core.encoder import MyEncoder
+from AMS.core.cache import acc_cache
+from AMS.config import settings
+from AMS.core.encoder import dumps
 from AMS.exceptions import AddressNotFound
 from AMS.app.model import AccountRow, TransactionRow
 
@@ -22,7 +24,7 @@ accounts_v1_bp = Blueprint("accounts", version=1, url_prefix='accounts')
 
 
 @accounts_v1_bp.get('/<account_address:str>')
-async def get_account_by_address(_: Request, account_address: str):
+async def get_account_by_address(request: Request, account_address: str):
     """Get account info by address.
 
     openapi:
@@ -31,21 +33,34 @@ async def get_account_by_address(_: Request, account_address: str):
     tags:
       - account
     """
-    async with AMSCore.conn() as conn:
-        try:
-            Keypair.from_public_key(account_address)
-        except Exception:
-            raise AddressNotFound(extra=dict(address=account_address))
-        else:
-            acc_model = await AMSCore.acc_model(account_address, conn=conn)
-        select_query = select(acc_model).where(acc_model.c.address == account_address)
-        row: Optional[Row] = await conn.fetch_one(query=select_query)
-    if not row:
+    try:
+        Keypair.from_public_key(account_address)
+    except Exception:
+        raise AddressNotFound(extra=dict(address=account_address))
+    account = await acc_cache.account(account_address, primary=replicas.wants_primary(request))
+    if not account:
         raise AddressNotFound(extra=dict(address=account_address))
-    else:
-        await AMSCore.validate_acc_row(row)
 
-    return json(AccountRow.to_json(row), dumps=json_dumps, cls=MyEncoder)
+    return json(account, dumps=dumps)
+
+
+def new_account_values() -> dict:
+    """Keypair, encrypted secret, mnemonic and first hash of a new account: run in the thread pool"""
+    s_address: Keypair = Keypair.random()
+    values = {
+        "address": s_address.public_key,
+        "sequence": 0,
+        "secret": ams_crypt.aes_encrypt(
+            s_address.secret,
+            AMSCrypt.account_secret_aes_key(),
+            AMSCrypt.account_secret_aes_iv()).decode(),
+        "balances": [],
+        "mnemonic": s_address.generate_mnemonic_phrase(),
+    }
+    _, values['hash'], _ = AMSCore.build_acc_hash_v2(prev_hash=None, delta=None, **values)
+    # balances live in `AccountBalance__N`, a new account has none
+    values.update(balances=null(), transactions=[], hash_version=ACC_HASH_V2, prev_hash=None, hash_delta=None)
+    return values
 
 
 @accounts_v1_bp.post('/')
@@ -53,23 +68,17 @@ async def create_account(_: Request):
     """
 
     """
-    s_address: Keypair = Keypair.random()
+    values = await executor.in_thread(new_account_values)
     async with AMSCore.conn() as conn:
-        acc_model = await AMSCore.acc_model(s_address.public_key, conn=conn)
-        query = acc_model.insert()
-        values = {
-            "address": s_address.public_key,
-            "sequence": 0,
-            "secret": ams_crypt.aes_encrypt(
-                s_address.secret,
-                AMSCrypt.account_secret_aes_key(),
-                AMSCrypt.account_secret_aes_iv()).decode(),
-            "balances": [],
-            "mnemonic": s_address.generate_mnemonic_phrase(),
-            "transactions": [],
-        }
-        _, values['hash'], _ = AMSCore.build_acc_hash(**values)
-        await conn.execute(query=query, values=values)
+        acc_model = await AMSCore.acc_model(values['address'], conn=conn)
+        mirror = await AMSCore.acc_mirror_model(values['address'], acc_model, conn=conn)
+        if mirror is None:
+            await conn.execute(query=acc_model.insert(), values=values)
+        else:
+            # resharding: the new account is written to both shard tables
+            async with conn.transaction():
+                await conn.execute(query=acc_model.insert(), values=values)
+                await conn.execute(query=mirror.insert(), values=values)
         select_query = select([
             acc_model.c.address, acc_model.c.sequence, acc_model.c.balances, acc_model.c.mnemonic,
             acc_model.c.secret,
@@ -79,8 +88,8 @@ async def create_account(_: Request):
         row: Optional[Row] = await conn.fetch_one(query=select_query)
     if not row:
         raise AddressNotFound(extra=dict(address=values['address']))
-    return json(AccountRow.to_json(row, secret=True, decrypt_secret=True, mnemonic=True),
-                dumps=json_dumps, status=201, cls=MyEncoder)
+    return json(AccountRow.to_json(row, secret=True, decrypt_secret=True, mnemonic=True, balances=[]),
+                dumps=dumps, status=201)
 
 
 @accounts_v1_bp.post('/<account_address:str>/asset')
@@ -88,79 +97,55 @@ async def create_account_asset(request: Request, account_address: str):
     """
     信任资产
     """
-    asset_str: str = request.form.get('asset')  # TODO valid asset from request form params
+    asset_str: str = request.form.get('asset') or ''
     asset_list: List[str] = [a.strip() for a in asset_str.split(',')]
+    if not all(asset_list) or any(len(a) > ASSET_MAX_LENGTH for a in asset_list):
+        raise InvalidUsage(message=f"Wrong args <asset>: {asset_str}, comma separated, "
+                                   f"at most {ASSET_MAX_LENGTH} chars each")
     async with AMSCore.conn() as conn:
-        acc_model = await AMSCore.acc_model(account_address, conn=conn)
-        select_query = select(acc_model).where(acc_model.c.address == account_address)
-        # search_query = f"SELECT * FROM {acc_model.name} WHERE address = '{account_address}'"
-        row: Optional[Row] = await conn.fetch_one(query=select_query)
-
-        if not row:
-            raise AddressNotFound(extra=dict(address=account_address))
-        else:
-            await AMSCore.validate_acc_row(row)
-
-        sequence: int = row.sequence
+        acc_models = await transfer.acc_models(conn, account_address)
+        acc_model = acc_models[account_address]
 
         async with conn.transaction():
+            state = (await transfer.lock_accounts(conn, acc_models))[account_address]
             for asset in asset_list:
-
-                query = """UPDATE :account_name
-    SET
-        balances=JSON_ARRAY_APPEND(balances, '$', CAST('{"asset": ":asset", "balance": "0.0000000"}' AS JSON)),
-        sequence=sequence+1
-    WHERE address=':account_address' AND sequence=:sequence AND JSON_SEARCH(balances, 'all', ':asset') IS NULL"""
-                rst = await conn.execute(AMSCore.format_query(query, values={
-                    'account_name': acc_model.name,
-                    'asset': asset, 'account_address': account_address, "sequence": sequence
-                }))
-                if rst:
-                    sequence += 1
-            # update hash
-            await AMSCore.acc_rehash(conn=conn, model=acc_model, address=account_address)
+                state.trust(asset)
+            if state.trusted:
+                await transfer.write_accounts(conn, (state, ), None)
+        if state.trusted:
+            await acc_cache.invalidate(account_address)
         # fetch rst
-        row: Optional[Row] = await conn.fetch_one(
-            query=select(acc_model).where(acc_model.c.address == account_address))
+        row, balances = await AMSCore.fetch_acc(
+            conn, acc_model, account_address, validate=False, fields=ACC_PUBLIC_FIELDS)
 
-    return json(AccountRow.to_json(row), dumps=json_dumps, cls=MyEncoder)
+    return json(AccountRow.to_json(row, balances=balances), dumps=dumps)
 
 
 @accounts_v1_bp.get('/<account_address:str>/sequence')
-async def account_address_sequence(_: Request, account_address: str):
+async def account_address_sequence(request: Request, account_address: str):
     """
     """
-    async with AMSCore.conn() as conn:
-        acc_model = await AMSCore.acc_model(account_address, conn=conn)
-        select_query = select(acc_model).where(acc_model.c.address == account_address)
-        row: Optional[Row] = await conn.fetch_one(query=select_query)
-    if not row:
+    account = await acc_cache.account(account_address, primary=replicas.wants_primary(request))
+    if not account:
         raise AddressNotFound(extra=dict(address=account_address))
-    else:
-        await AMSCore.validate_acc_row(row)
 
     return json(
         {
-            "sequence": row.sequence,
+            "sequence": account['sequence'],
         }, dumps=ujson.dumps
     )
 
 
 @accounts_v1_bp.get('/<account_address:str>/balances')
-async def account_address_sequence(_: Request, account_address: str):
+async def account_address_sequence(request: Request, account_address: str):
     """
     """
-    async with AMSCore.conn() as conn:
-        acc_model = await AMSCore.acc_model(account_address, conn=conn)
-        search_query = select(acc_model).where(acc_model.c.address == account_address)
-        row: Optional[Row] = await conn.fetch_one(query=search_query)
-    if not row:
+    account = await acc_cache.account(account_address, primary=replicas.wants_primary(request))
+    if not account:
         raise AddressNotFound(extra=dict(address=account_address))
-    else:
-        await AMSCore.validate_acc_row(row)
     return json(
         {
-            "balances": ujson.loads(row.balances),
+            "balances": account['balances'],
         }, dumps=ujson.dumps
     )
 
@@ -176,57 +161,52 @@ address_schema = Schema(And(str, Keypair.from_public_key))
 
 @accounts_v1_bp.get('/<account_address:str>/transactions')
 async def account_address_transactions(request: Request, account_address: str):
-    # TODO assert txn hash to account json `transactions`
     try:
         address_schema.validate(account_address)
     except SchemaError:
         raise AddressNotFound(extra=dict(address=account_address))
 
-    limit = int(request.args.get('limit', 30))
+    try:
+        limit = min(max(int(request.args.get('limit', 30)), 1), settings.AMS_TXN_PAGE_MAX_LIMIT)
+    except ValueError:
+        raise InvalidUsage(message=f"Wrong args <limit>: {request.args.get('limit')}")
     cursor = request.args.get('cursor', None)
+    try:
+        acc_txn_cursor = AMSCore.acc_txn_cursor(cursor)
+    except ValueError:
+        raise InvalidUsage(message=f"Wrong args <cursor>: {cursor}")
     try:
         order = getattr(Order, request.args.get('order', 'DESC'))
     except AttributeError:
         # return json([])
         raise InvalidUsage(message=f"Wrong args <order>: {request.args.get('order')}")
 
-    async with AMSCore.conn() as conn:
-        acc_model = await AMSCore.acc_model(account_address, conn=conn)
-        select_acc = select(acc_model).where(acc_model.c.address == account_address)
-        account_txn_row = await conn.fetch_one(select_acc)
+    async with AMSCore.read_conn(replicas.wants_primary(request)) as conn:
+        acc_model = await AMSCore.acc_model(account_address, conn=conn, create=False)
+        account_txn_row = None
+        if acc_model is not None:
+            account_txn_row, _ = await AMSCore.fetch_acc(
+                conn, acc_model, account_address, validate=settings.AMS_VERIFY_ON_READ, fields=('address', ))
         if not account_txn_row:
             raise AddressNotFound(extra=dict(address=account_address))
-        else:
-            await AMSCore.validate_acc_row(account_txn_row)
 
-        txn_s = account_txn_row.transactions
+        txn_s, next_cursor = await AMSCore.acc_txn_hashes(
+            conn, account_address, acc_model, limit=limit, cursor=acc_txn_cursor, desc=order is Order.DESC)
         if not txn_s:
             return json([])
 
-        if order is Order.DESC:
-            txn_s = reversed(txn_s)  # list_reverseiterator
-
-        rows = []
-        hit_cursor = False
-        for txn in txn_s:
-            if cursor:
-                if not hit_cursor:
-                    if txn == cursor:
-                        hit_cursor = True
-                        continue  # not include cursor
-                    else:
-                        continue
-
-            txn_model = await AMSCore.txn_model(txn, conn=conn)
-            txn_row = await conn.fetch_one(select(txn_model).where(txn_model.c.hash == txn))
-            if txn_row:
-                rows.append(txn_row)
-            else:
-                logger.error(f"{txn_model} {txn} of Account {account_address} NOT FOUND")
-            if len(rows) >= limit:
-                break
+        txn_rows = await AMSCore.txn_rows(txn_s, conn=conn)
+
+    rows = []
+    for txn in txn_s:
+        txn_row = txn_rows.get(txn)
+        if txn_row:
+            rows.append(txn_row)
+        else:
+            logger.error(f"{txn} of Account {account_address} NOT FOUND")
 
     return json(
         [TransactionRow.to_json(row, replace_id_with_hash=True) for row in rows],
-        dumps=json_dumps, cls=MyEncoder
+        headers={"X-AMS-Next-Cursor": next_cursor} if next_cursor else None,
+        dumps=dumps
     )
@@ -0,0 +1,12 @@
+from sanic import Blueprint, Request, json
+
+from AMS.core.cache import acc_cache
+from AMS.core.metrics import metrics
+
+metrics_v1_bp = Blueprint("metrics", version=1, url_prefix='metrics')
+
+
+@metrics_v1_bp.get('/')
+async def get_metrics(_: Request):
+    """Counters and gauges of the worker serving the request"""
+    return json({**metrics.snapshot(), "acc_cache": acc_cache.stats()})
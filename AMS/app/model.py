@@ -1,30 +1,21 @@
 import json
-from dataclasses import dataclass
-from datetime import datetime
 from decimal import Decimal
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, Optional, Tuple, Callable
 
 import sqlalchemy
 from arrow import Arrow
 from dateutil import tz
-from sqlalchemy import text, UniqueConstraint
+from sqlalchemy import text, UniqueConstraint, Index
+from sqlalchemy.dialects import mysql
 from sqlalchemy.engine import Row
 
 from AMS.core.ams_crypt import AMSCrypt, aes_decrypt
+from AMS.core.encoder import LOCAL_TZ, row_items, utc_times
 
 metadata = sqlalchemy.MetaData()
 
 
-@dataclass
-class AccountBalance:
-    balance: Decimal
-    asset: str
-
-    @property
-    def json(self):
-        return dict(balance=self.balance, asset=self.asset)
-
-
 Account = sqlalchemy.Table(
     "Account",
     metadata,
@@ -32,10 +23,15 @@ Account = sqlalchemy.Table(
     sqlalchemy.Column("sequence", sqlalchemy.BigInteger, default=0, server_default=text("0"), nullable=False),
     sqlalchemy.Column("address", sqlalchemy.String(length=56), nullable=False),
     sqlalchemy.Column("secret", sqlalchemy.String(length=100), nullable=False),
-    sqlalchemy.Column("balances", sqlalchemy.JSON(), default=[]),
+    # legacy, balances live in `AccountBalance__N`, NULL once moved there
+    sqlalchemy.Column("balances", sqlalchemy.JSON(), nullable=True),
     sqlalchemy.Column('mnemonic', sqlalchemy.String(length=128), nullable=True),
     sqlalchemy.Column('transactions', sqlalchemy.JSON()),
     sqlalchemy.Column('hash', sqlalchemy.String(length=64)),
+    # hash v2 is chained: `prev_hash` + `hash_delta` (the change applied) + current state
+    sqlalchemy.Column('hash_version', sqlalchemy.SmallInteger, default=1, server_default=text("1"), nullable=False),
+    sqlalchemy.Column('prev_hash', sqlalchemy.String(length=64), nullable=True),
+    sqlalchemy.Column('hash_delta', sqlalchemy.JSON(), nullable=True),
     sqlalchemy.Column(
         'created_at', sqlalchemy.TIMESTAMP(),
         server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
@@ -52,6 +48,44 @@ Account = sqlalchemy.Table(
 # Account_address_uindex = Index('Account_address_uindex', Account.c.address, unique=True)
 
 
+# Append-only account -> transaction index, sharded alongside `Account__N` (`AccountTransaction__N`).
+# Replaces the ever-growing `Account.transactions` JSON array, `created_at` is the transaction's own timestamp.
+AccountTransaction = sqlalchemy.Table(
+    "AccountTransaction",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("address", sqlalchemy.String(length=56), nullable=False),
+    sqlalchemy.Column("hash", sqlalchemy.String(length=74), nullable=False),
+    sqlalchemy.Column('created_at', sqlalchemy.TIMESTAMP(), nullable=False),
+    UniqueConstraint('address', 'hash', name='AccountTransaction_address_hash_uindex'),
+    Index('AccountTransaction_address_created_at_id_index', 'address', 'created_at', 'id'),
+)
+
+
+# One row per trust line, sharded alongside `Account__N` (`AccountBalance__N`), ordered by `id` like the legacy
+# `Account.balances` JSON array.
+AccountBalance = sqlalchemy.Table(
+    "AccountBalance",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("address", sqlalchemy.String(length=56), nullable=False),
+    sqlalchemy.Column("asset", sqlalchemy.String(length=20), nullable=False),
+    sqlalchemy.Column(
+        "balance", sqlalchemy.Numeric(precision=23, scale=7), default=0, server_default=text("0"), nullable=False),
+    sqlalchemy.Column(
+        'created_at', sqlalchemy.TIMESTAMP(),
+        server_default=text("CURRENT_TIMESTAMP"),
+    ),
+    sqlalchemy.Column(
+        'updated_at', sqlalchemy.TIMESTAMP(),
+        server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+        server_onupdate=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP")
+    ),
+    UniqueConstraint('address', 'asset', name='AccountBalance_address_asset_uindex'),
+    Index('AccountBalance_asset_balance_index', 'asset', 'balance'),
+)
+
+
 Transaction = sqlalchemy.Table(
     "Transaction",
     metadata,
@@ -78,6 +112,19 @@ Transaction = sqlalchemy.Table(
     # Constraint('to', name="Transaction_to_index", ),
     UniqueConstraint('hash', name='Transaction_hash_uindex'),
     UniqueConstraint('from', 'from_sequence', name='Transaction_from_from_sequence_uindex'),
+    # time range searches, see `AMSCore.search_txns`
+    Index('Transaction_created_at_id_index', 'created_at', 'id'),
+    Index('Transaction_from_created_at_id_index', 'from', 'created_at', 'id'),
+    Index('Transaction_to_created_at_id_index', 'to', 'created_at', 'id'),
+)
+
+# One row on every MySQL instance with a read replica, its `beat` moved on by each worker and compared with what
+# the replica has applied, see `core/replicas.py`.
+Heartbeat = sqlalchemy.Table(
+    "Heartbeat",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.SmallInteger, primary_key=True),
+    sqlalchemy.Column("beat", mysql.DATETIME(fsp=6), nullable=False),
 )
 
 # Transaction_from_from_sequence_uindex= Index('Transaction_from_from_sequence_uindex', "Transaction.from",
@@ -87,8 +134,8 @@ Transaction = sqlalchemy.Table(
 
 def dict_row(row: Row) -> dict:
     d_row = dict(row)
-    d_row['created_at'] = Arrow.fromdatetime(d_row['created_at'], tzinfo=tz.tzutc()).to(tz.gettz())
-    d_row['updated_at'] = Arrow.fromdatetime(d_row['updated_at'], tzinfo=tz.tzutc()).to(tz.gettz())
+    d_row['created_at'] = Arrow.fromdatetime(d_row['created_at'], tzinfo=tz.tzutc()).to(LOCAL_TZ)
+    d_row['updated_at'] = Arrow.fromdatetime(d_row['updated_at'], tzinfo=tz.tzutc()).to(LOCAL_TZ)
     d_row['balances'] = json.loads(d_row['balances'])
     d_row.pop('secret', None)
     return d_row
@@ -96,12 +143,13 @@ def dict_row(row: Row) -> dict:
 
 class AccountRow:
     @classmethod
-    def to_json(cls, row: Row, secret=False, decrypt_secret=False, mnemonic=False, transactions=False, hash_=False):
-        d_row: Dict[str, Arrow | int | str | datetime] = dict(row)
-        d_row['created_at_dt'] = Arrow.fromdatetime(d_row['created_at'], tzinfo=tz.tzutc()).to(tz.gettz())
-        d_row['created_at'] = int(d_row['created_at_dt'].timestamp())
-        d_row['updated_at_dt'] = Arrow.fromdatetime(d_row['updated_at'], tzinfo=tz.tzutc()).to(tz.gettz())
-        d_row['updated_at'] = int(d_row['updated_at_dt'].timestamp())
+    def to_json(cls, row: Row, secret=False, decrypt_secret=False, mnemonic=False, transactions=False, hash_=False,
+                balances: Optional[list] = None):
+        d_row: Dict[str, int | str | list] = dict(zip(*row_items(row)))
+        if balances is not None:
+            d_row['balances'] = balances
+        d_row['created_at'], d_row['created_at_dt'] = utc_times(d_row['created_at'])
+        d_row['updated_at'], d_row['updated_at_dt'] = utc_times(d_row['updated_at'])
 
         d_row.pop('id', None)
         if isinstance(d_row['balances'], str):
@@ -122,21 +170,46 @@ class AccountRow:
             d_row.pop('mnemonic', None)
         if not hash_:
             d_row.pop('hash', None)
+            d_row.pop('hash_version', None)
+            d_row.pop('prev_hash', None)
+            d_row.pop('hash_delta', None)
         return d_row
 
 
+def _json_column(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def _decimal(value):
+    return str(value) if isinstance(value, Decimal) else value
+
+
+# `Transaction` columns as `TransactionRow.to_json` gives them, the others as they are
+TXN_JSON: Dict[str, Callable] = {
+    'op': _json_column, 'is_bulk': bool, 'is_success': bool, 'amount': _decimal,
+}
+
+
+@lru_cache(maxsize=64)
+def _txn_plan(fields: Tuple[str, ...]) -> Tuple[Tuple[int, str, Optional[Callable]], ...]:
+    """(position, key, conversion) of the columns `TransactionRow.to_json` keeps, `fields` being a row's columns"""
+    return tuple((i, f, TXN_JSON.get(f)) for i, f in enumerate(fields) if f != 'id')
+
+
 class TransactionRow:
     @classmethod
     def to_json(cls, row: Row, replace_id_with_hash=False):
-        d_row = dict(row)
-        d_row.pop('id', None)
-        d_row['op'] = json.loads(d_row['op']) if isinstance(d_row['op'], str) else d_row['op']
-        d_row['is_bulk'] = bool(d_row['is_bulk'])
-        d_row['created_at_dt'] = Arrow.fromdatetime(d_row['created_at'], tzinfo=tz.tzutc()).to(tz.gettz())
-        d_row['created_at'] = int(d_row['created_at_dt'].timestamp())
-        d_row['updated_at_dt'] = Arrow.fromdatetime(d_row['updated_at'], tzinfo=tz.tzutc()).to(tz.gettz())
-        d_row['updated_at'] = int(d_row['updated_at_dt'].timestamp())
-        d_row['is_success'] = bool(d_row['is_success'])
+        """The row in JSON types, columns in order then `created_at_dt`, `updated_at_dt` (and `id`).
+
+        Goes by the row's positions, `_txn_plan` is worked out once per column set.
+        """
+        fields, values = row_items(row)
+        values = tuple(values)
+        d_row = {}
+        for i, key, convert in _txn_plan(fields):
+            d_row[key] = values[i] if convert is None else convert(values[i])
+        d_row['created_at'], d_row['created_at_dt'] = utc_times(d_row['created_at'])
+        d_row['updated_at'], d_row['updated_at_dt'] = utc_times(d_row['updated_at'])
         if replace_id_with_hash:
             d_row['id'] = d_row['hash']
         return d_row
@@ -1,6 +1,6 @@
 from decimal import Decimal
-from typing import Optional, List
-from json import dumps as json_dumps
+from functools import partial
+from typing import List, Dict, Optional
 
 from arrow import Arrow
 from databases.core import Connection
@@ -8,21 +8,24 @@ from pymysql import IntegrityError, OperationalError
 from redis.asyncio import Redis
 from redis.exceptions import LockError
 from sanic import Blueprint, Request, json
+from sanic.exceptions import InvalidUsage
 from sanic.views import HTTPMethodView
 from sqlalchemy import select, Table
 from sqlalchemy.engine import Row
 from schema import Schema, SchemaError, Use, And, Optional as OptionalSchema
 from stellar_sdk import Keypair
 
+from AMS.app.account.api import Order
 from AMS.app.model import TransactionRow
 from AMS.config import settings
-from AMS.core import AMSCore
-from AMS.core.encoder import MyEncoder
-from AMS.exceptions import TransactionNotFound, TransactionsBuildFailed, AssetNotTrusted, \
-    InsufficientFunds, TransactionsSendFailed, TransactionsSelfTransfer, AddressNotFound, BulkTransactionsFromAddress, \
-    BulkTransactionsLockFailed
+from AMS.core import AMSCore, transfer, idempotency, replicas
+from AMS.core.cache import acc_cache
+from AMS.core.encoder import dumps
+from AMS.core.group_commit import group_commit, TransferJob
+from AMS.core.locks import MultiLock
+from AMS.exceptions import TransactionNotFound, TransactionsBuildFailed, \
+    TransactionsSendFailed, TransactionsSelfTransfer, BulkTransactionsFromAddress, BulkTransactionsLockFailed
 
-DEM = settings.AMS_DECIMAL
 lock_name = settings.AMS_BULK_TXN_LOCK_NAME
 
 transactions_v1_bp = Blueprint("transactions", version=1, url_prefix='transactions')
@@ -61,136 +64,36 @@ class CreateTxnView(HTTPMethodView):
 
         return txn_hash, asset, from_addr, to_addr, amount, from_sequence, create_at, memo
 
-    @staticmethod
-    async def validate_account(from_addr: str, to_addr: str, conn: Connection, asset: str, amount: Decimal):
-        from_acc_model = await AMSCore.acc_model(from_addr, conn=conn)
-        to_acc_model = await AMSCore.acc_model(to_addr, conn=conn)
-        query_asset = f"SELECT JSON_SEARCH(balances, 'one', ':asset') as asset " \
-                      f"FROM :table where `address`=':addr';"
-        asset_row: Optional[Row] = await conn.fetch_one(
-            AMSCore.format_query(query_asset, values={"table": from_acc_model.name, "asset": asset, "addr": from_addr}))
-        if not asset_row:
-            raise AddressNotFound(extra=dict(address=from_addr))
-        if not asset_row.asset:
-            raise AssetNotTrusted(extra=dict(asset=asset, addr=from_addr))
-
-        from_asset_pos: str = asset_row.asset.strip('"').rsplit('.asset')[0]
-
-        from_asset_balance_query = f"""SELECT * FROM {from_acc_model.name} 
-        WHERE address='{from_addr}' 
-        AND cast(balances->>"{from_asset_pos}.balance" AS {DEM}) - CAST('{amount}' AS {DEM} ) >= 0;"""
-        from_asset_balance_row: Optional[Row] = await conn.fetch_one(from_asset_balance_query)
-        if not from_asset_balance_row:
-            raise InsufficientFunds(extra=dict(amount=amount, addr=from_addr))
-
-        to_asset_row: Optional[Row] = await conn.fetch_one(
-            AMSCore.format_query(query_asset, values={"table": to_acc_model.name, "asset": asset, "addr": to_addr}))
-        if not to_asset_row:
-            raise AddressNotFound(extra=dict(address=to_addr))
-        if not to_asset_row.asset:
-            raise AssetNotTrusted(extra=dict(asset=asset, addr=to_addr))
-        else:
-            to_asset_pos: str = to_asset_row.asset.strip('"').rsplit('.asset')[0]
-
-        await AMSCore.validate_acc(conn=conn, address=from_addr, model=from_acc_model)
-        await AMSCore.validate_acc(conn=conn, address=to_addr, model=to_acc_model)
-
-        return from_acc_model, from_asset_pos, to_acc_model, to_asset_pos
-
-    @staticmethod
-    async def transaction(conn: Connection,
-                          from_addr: str,
-                          from_acc_model: Table,
-                          from_asset_pos: str,
-                          from_sequence: int,
-                          to_addr: str,
-                          to_acc_model: Table,
-                          to_asset_pos: str,
-                          amount: Decimal,
-                          txn_hash: str,
-                          asset: str,
-                          memo: str,
-                          create_at: int):
-        cost_query = f"""UPDATE {from_acc_model.name}
-    SET
-        balances=JSON_REPLACE(balances, 
-        '{from_asset_pos}.balance', 
-        CAST(CAST(balances->>"{from_asset_pos}.balance" AS {DEM}) - CAST('{amount}' AS {DEM}) AS CHAR )),
-        `sequence`=`sequence`+1,
-        `transactions`=IF(
-            JSON_CONTAINS(`transactions`, CAST('"{txn_hash}"' AS JSON), '$') = 1, 
-            `transactions`, 
-            IFNULL(
-                json_array_append(transactions, '$', CAST('"{txn_hash}"' AS JSON)), 
-                CAST('["{txn_hash}"]' AS JSON)
-            )
-        )
-    WHERE address='{from_addr}' 
-    AND CAST(balances->>"{from_asset_pos}.balance" AS {DEM}) - CAST('{amount}' AS {DEM}) >= 0 
-    AND `sequence`={from_sequence};"""
-
-        add_query = f"""UPDATE {to_acc_model.name}
-    SET
-        balances=JSON_REPLACE(
-            balances, 
-            '{to_asset_pos}.balance', 
-            CAST(CAST(balances->>"{to_asset_pos}.balance" AS {DEM}) + CAST('{amount}' AS {DEM}) AS CHAR )),
-        `transactions`=IF(
-            JSON_CONTAINS(`transactions`, CAST('"{txn_hash}"' AS JSON), '$') = 1, 
-            `transactions`, 
-            IFNULL(
-                json_array_append(transactions, '$', CAST('"{txn_hash}"' AS JSON)), 
-                CAST('["{txn_hash}"]' AS JSON)
-            )
-        )
-    WHERE address='{to_addr}'"""
-
-        transaction_model = await AMSCore.txn_model(txn_hash=txn_hash, conn=conn)
-        txn_insert_query = transaction_model.insert()
-        cost_row = await conn.execute(cost_query)
-        if not cost_row:
-            raise TransactionsSendFailed(extra=dict(sequence=from_sequence))
-        add_row = await conn.execute(add_query)
-        if not add_row:
-            raise TransactionsSendFailed(extra=dict(to=to_addr))
-
-        await AMSCore.acc_rehash(conn=conn, model=from_acc_model, address=from_addr)
-        await AMSCore.acc_rehash(conn=conn, model=to_acc_model, address=to_addr)
-        try:
-            insert_row = await conn.execute(txn_insert_query, values={
-                "hash": txn_hash,
-                "asset": asset,
-                "from": from_addr,
-                "to": to_addr,
-                "amount": Decimal(amount),
-                "from_sequence": from_sequence,
-                "is_success": True,
-                "memo": memo,
-                "is_bulk": False,
-                "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
-            })
-        except IntegrityError as e:
-            raise TransactionsSendFailed(extra=dict(e=e))
-
-        if not insert_row:
-            raise TransactionsSendFailed(extra=dict(txn=txn_hash))
-
-        return transaction_model
-
     async def post(self, request: Request):
         (txn_hash, asset, from_addr, to_addr, amount,
          from_sequence, create_at, memo) = self.validate_request(request)
+        create = partial(self.create, txn_hash, asset, from_addr, to_addr, amount, from_sequence, create_at, memo)
+        if request.form.get('hash'):
+            # clients retry with their own hash
+            return await idempotency.once(txn_hash, create)
+        return await create()
+
+    @staticmethod
+    async def create(txn_hash: str, asset: str, from_addr: str, to_addr: str, amount: Decimal,
+                     from_sequence: int, create_at: int, memo: str):
+        batched = group_commit.accepts()
         async with AMSCore.conn() as conn:
-            from_acc_model, from_asset_pos, to_acc_model, to_asset_pos = await self.validate_account(
-                from_addr, to_addr, conn, asset, amount)
-            async with conn.transaction():
-                transaction_model = await self.transaction(
-                    conn, from_addr, from_acc_model, from_asset_pos, from_sequence,
-                    to_addr, to_acc_model, to_asset_pos,
-                    amount, txn_hash, asset, memo, create_at
-                )
-            txn_row = await conn.fetch_one(select(transaction_model).where(transaction_model.c.hash == txn_hash))
-            return json(TransactionRow.to_json(txn_row), dumps=json_dumps, cls=MyEncoder)
+            transaction_model = await AMSCore.txn_model(txn_hash=txn_hash, conn=conn)
+            acc_models = await transfer.acc_models(conn, from_addr, to_addr)
+            if not batched:
+                async with conn.transaction():
+                    txn_row = await transfer.transfer(
+                        conn, transaction_model, acc_models, txn_hash, asset, from_addr, to_addr,
+                        amount, from_sequence, memo, create_at
+                    )
+        if batched:
+            # the connection went back to the pool, the batch commits on its own
+            txn_row = await group_commit.submit(TransferJob(
+                transaction_model, acc_models, txn_hash, asset, from_addr, to_addr,
+                amount, from_sequence, memo, create_at
+            ))
+        await acc_cache.invalidate(from_addr, to_addr)
+        return json(TransactionRow.to_json(txn_row), dumps=dumps)
 
 
 bulk_create_transaction_hash_schema = Schema({
@@ -236,84 +139,16 @@ class BulkTransactionView(HTTPMethodView):
         return op, from_addr, from_sequence, memo, txn_hash, create_at
 
     @staticmethod
-    async def update_from_op(op_, txn_hash, conn):
-        op_from_acc_model = await AMSCore.acc_model(address=op_["from"], conn=conn)
-        op_to_acc_model = await AMSCore.acc_model(address=op_["to"], conn=conn)
-        await AMSCore.validate_acc(conn=conn, address=op_['from'], model=op_from_acc_model)
-        await AMSCore.validate_acc(conn=conn, address=op_['to'], model=op_to_acc_model)
-        cost_query = f"""UPDATE {op_from_acc_model.name}
-                    SET
-                        balances=JSON_REPLACE(
-                            balances,
-                            CONCAT_WS('.', SUBSTRING_INDEX(JSON_UNQUOTE(JSON_SEARCH(`balances`, 'one', '{op_["asset"]}')), '.', 1), 'balance'),
-                            CAST(
-                                CAST(
-                                    JSON_UNQUOTE( JSON_EXTRACT(`balances`, CONCAT_WS('.', SUBSTRING_INDEX(JSON_UNQUOTE(JSON_SEARCH(`balances`, 'one', '{op_["asset"]}')), '.', 1), 'balance')))
-                                    AS {DEM}
-                                ) -
-                                CAST( '{op_["amount"]}' AS {DEM} )
-                                AS CHAR
-                            )
-                        ),
-                        `sequence`=`sequence`+1,
-                        `transactions`=IF(
-                            JSON_CONTAINS(`transactions`, CAST('"{txn_hash}"' AS JSON), '$') = 1, 
-                            `transactions`, 
-                            IFNULL(
-                                json_array_append(transactions, '$', CAST('"{txn_hash}"' AS JSON)), 
-                                CAST('["{txn_hash}"]' AS JSON)
-                            )
-                        )
-                    WHERE address='{op_["from"]}'
-                    AND CAST(
-                            JSON_UNQUOTE( JSON_EXTRACT(`balances`, CONCAT_WS('.', SUBSTRING_INDEX(JSON_UNQUOTE(JSON_SEARCH(`balances`, 'one', '{op_["asset"]}')), '.', 1), 'balance')))
-                            AS {DEM}
-                        ) -
-                        CAST( '{op_["amount"]}' AS {DEM} ) >= 0"""
-        #     AND `sequence`=2;"""
-
-        add_query = f"""UPDATE {op_to_acc_model.name}
-                SET
-                    balances=JSON_REPLACE(
-                        balances,
-                        CONCAT_WS('.', SUBSTRING_INDEX(JSON_UNQUOTE(JSON_SEARCH(`balances`, 'one', '{op_["asset"]}')), '.', 1), 'balance'),
-                        CAST(
-                            CAST(
-                                JSON_UNQUOTE( JSON_EXTRACT(`balances`, CONCAT_WS('.', SUBSTRING_INDEX(JSON_UNQUOTE(JSON_SEARCH(`balances`, 'one', '{op_["asset"]}')), '.', 1), 'balance')))
-                                AS {DEM}
-                            ) +
-                            CAST(
-                                '{op_["amount"]}'
-                                AS {DEM}
-                            )
-                            AS CHAR
-                        )
-                    ),
-                    `transactions`=IF(
-                        JSON_CONTAINS(`transactions`, CAST('"{txn_hash}"' AS JSON), '$') = 1, 
-                        `transactions`, 
-                        IFNULL(
-                            json_array_append(transactions, '$', CAST('"{txn_hash}"' AS JSON)), 
-                            CAST('["{txn_hash}"]' AS JSON)
-                        )
-                    )
-                WHERE address='{op_["to"]}'"""
-
-        try:
-            cost_row = await conn.execute(cost_query)
-            if not cost_row:
-                raise TransactionsSendFailed(extra={"from": op_['from'], "e": "cost failed"})
-            add_row = await conn.execute(add_query)
-            if not add_row:
-                raise TransactionsSendFailed(extra=dict(to=op_['to'], e="add failed"))
-
-            await AMSCore.acc_rehash(conn=conn, model=op_from_acc_model, address=op_['from'])
-            await AMSCore.acc_rehash(conn=conn, model=op_to_acc_model, address=op_['to'])
-        except OperationalError as e:
-            if len(e.args) >= 2 and e.args[0] == 3143:
-                raise AssetNotTrusted(extra=dict(op=op_, addr='', asset=op_['asset']))
-            raise TransactionsSendFailed(extra=dict(e=e))
-        op_['amount'] = str(op_['amount'])  # to save in mysql json
+    def apply_ops(states: Dict[str, transfer.AccountState], op: List[dict]):
+        """Every op, in payload order, on the locked account states: a debit has to be covered by the balance
+        at its turn, and each op takes a sequence of its sender
+        """
+        for op_ in op:
+            from_state, to_state = states[op_['from']], states[op_['to']]
+            from_state.apply(op_['asset'], -op_['amount'])
+            from_state.sequence += 1
+            to_state.apply(op_['asset'], op_['amount'])
+            op_['amount'] = str(op_['amount'])  # to save in mysql json
 
     async def bulk_transaction(self,
                                conn: Connection,
@@ -324,43 +159,58 @@ class BulkTransactionView(HTTPMethodView):
                                from_sequence: int,
                                memo: str,
                                create_at: int,
-                               redis: Redis):
-        async with conn.transaction():
-            for _op in op:
+                               redis: Redis,
+                               acc_models: Dict[str, Table]):
+        """Lock every sender (one Redis call, queued fairly behind overlapping bulks), then every account once,
+        apply the ops in Python and write each account once: the statement count depends on the distinct accounts,
+        not on the ops
+        """
+        senders = sorted({_op['from'] for _op in op})
+        lock = MultiLock(redis, [lock_name.format(from_addr=sender) for sender in senders],
+                         lease=settings.AMS_BULK_LOCK_LEASE_SECONDS,
+                         blocking_timeout=settings.AMS_BULK_LOCK_WAIT_SECONDS, metric='bulk_lock')
+        try:
+            await lock.acquire()
+        except LockError:
+            raise BulkTransactionsLockFailed(extra=dict(from_addr=senders))
+        try:
+            async with conn.transaction():
+                try:
+                    states = await transfer.lock_accounts(conn, acc_models)
+                    if states[from_addr].sequence != from_sequence:
+                        raise TransactionsSendFailed(extra=dict(sequence=from_sequence, from_addr=from_addr))
+                    self.apply_ops(states, op)
+                    await transfer.write_accounts(conn, states.values(), txn_hash)
+                    await AMSCore.add_acc_txn(conn, txn_hash, *acc_models.items())
+                except OperationalError as e:
+                    raise TransactionsSendFailed(extra=dict(e=e))
+
+                # insert transaction
+                txn_insert_query = transaction_model.insert()
                 try:
-                    # Lock from_addr
-                    async with redis.lock(
-                            name=lock_name.format(from_addr=_op["from"]),
-                            blocking_timeout=0.2, timeout=100.0):
-                        # Do update in op list
-                        await self.update_from_op(_op, txn_hash, conn)
-                except LockError:
-                    raise BulkTransactionsLockFailed(extra=dict(from_addr=_op["from"]))
-
-            # insert transaction
-            txn_insert_query = transaction_model.insert()
-            try:
-                insert_row = await conn.execute(txn_insert_query, values={
-                    "hash": txn_hash,
-                    "asset": None,
-                    "from": from_addr,
-                    "to": None,
-                    "amount": None,
-                    "from_sequence": from_sequence,
-                    "is_success": True,
-                    "is_bulk": True,
-                    "op": op,
-                    "memo": memo,
-                    "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
-                })
-            except IntegrityError as e:
-                if len(e.args) >= 2 and e.args[0] == 1062:
-                    raise TransactionsSendFailed(extra=dict(sequence=from_sequence, from_addr=from_addr))
-                raise TransactionsSendFailed(extra=dict(e=e))
-
-            if not insert_row:
-                raise TransactionsSendFailed(extra=dict(txn=txn_hash))
-            # End db transaction
+                    insert_row = await conn.execute(txn_insert_query, values={
+                        "hash": txn_hash,
+                        "asset": None,
+                        "from": from_addr,
+                        "to": None,
+                        "amount": None,
+                        "from_sequence": from_sequence,
+                        "is_success": True,
+                        "is_bulk": True,
+                        "op": op,
+                        "memo": memo,
+                        "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
+                    })
+                except IntegrityError as e:
+                    if len(e.args) >= 2 and e.args[0] == 1062:
+                        raise TransactionsSendFailed(extra=dict(sequence=from_sequence, from_addr=from_addr))
+                    raise TransactionsSendFailed(extra=dict(e=e))
+
+                if not insert_row:
+                    raise TransactionsSendFailed(extra=dict(txn=txn_hash))
+                # End db transaction
+        finally:
+            await lock.release()
 
     async def bulk_conn(self,
                         txn_hash: str,
@@ -372,17 +222,13 @@ class BulkTransactionView(HTTPMethodView):
                         redis: Redis):
         async with AMSCore.conn() as conn:
             transaction_model = await AMSCore.txn_model(txn_hash=txn_hash, conn=conn)
-            acc_model = await AMSCore.acc_model(address=from_addr, conn=conn)
-            select_txn = select(acc_model.c.id).where(
-                acc_model.c.address == from_addr, acc_model.c.sequence == from_sequence)
-            owner_seq_query_row = await conn.fetch_one(select_txn)
-            if not owner_seq_query_row:
-                raise TransactionsSendFailed(extra=dict(sequence=from_sequence, from_addr=from_addr))
-            # Do transaction
+            acc_models = await transfer.acc_models(conn, *{addr for _op in op for addr in (_op['from'], _op['to'])})
+            # Do transaction, `from_sequence` is checked under the row lock
             await self.bulk_transaction(
                 conn=conn, op=op, transaction_model=transaction_model, txn_hash=txn_hash, from_addr=from_addr,
-                from_sequence=from_sequence, memo=memo, create_at=create_at, redis=redis
+                from_sequence=from_sequence, memo=memo, create_at=create_at, redis=redis, acc_models=acc_models
             )
+            await acc_cache.invalidate(*acc_models)
             # After transaction
             select_txn = transaction_model.select().where(transaction_model.c.hash == txn_hash)
             txn_row = await conn.fetch_one(select_txn)
@@ -390,8 +236,15 @@ class BulkTransactionView(HTTPMethodView):
 
     async def post(self, request: Request):
         op, from_addr, from_sequence, memo, txn_hash, create_at = self.valid_request(request)
-        txn_row = await self.bulk_conn(txn_hash, from_addr, from_sequence, op, memo, create_at, request.app.ctx.redis)
-        return json(TransactionRow.to_json(txn_row), dumps=json_dumps, cls=MyEncoder)
+
+        async def create():
+            txn_row = await self.bulk_conn(
+                txn_hash, from_addr, from_sequence, op, memo, create_at, request.app.ctx.redis)
+            return json(TransactionRow.to_json(txn_row), dumps=dumps)
+
+        if request.json.get('hash'):
+            return await idempotency.once(txn_hash, create)
+        return await create()
 
 
 transactions_v1_bp.add_route(BulkTransactionView.as_view(), '/bulk')
@@ -399,18 +252,70 @@ transactions_v1_bp.add_route(CreateTxnView.as_view(), '/')
 
 
 
+search_txn_schema = Schema({
+    "start": And(Use(int), Use(Arrow.fromtimestamp)),
+    "end": And(Use(int), Use(Arrow.fromtimestamp)),
+    OptionalSchema("from"): And(str, Keypair.from_public_key),
+    OptionalSchema("to"): And(str, Keypair.from_public_key),
+    OptionalSchema("asset"): str,
+    OptionalSchema("limit", default=30): And(Use(int), Use(lambda n: min(max(n, 1), settings.AMS_TXN_PAGE_MAX_LIMIT))),
+    OptionalSchema("order", default=Order.DESC): Use(lambda x: Order[x]),
+    OptionalSchema("cursor"): str,
+})
+
+
+@transactions_v1_bp.get('/search')
+async def search_transactions(request: Request):
+    """Transactions created in [start, end) (unix timestamps), optionally filtered by `from`, `to` and `asset`.
+
+    Paged like account history: the next page's cursor is in the `X-AMS-Next-Cursor` header.
+    """
+    try:
+        d = search_txn_schema.validate({k: v[0] for k, v in request.args.items()})
+    except SchemaError as e:
+        raise InvalidUsage(message=f"Wrong args: {e}")
+    if d['end'] <= d['start'] or (d['end'] - d['start']).days > settings.AMS_TXN_SEARCH_MAX_DAYS:
+        raise InvalidUsage(message=f"Wrong args <start>/<end>, at most {settings.AMS_TXN_SEARCH_MAX_DAYS} days")
+
+    try:
+        cursor = AMSCore.search_txn_cursor(d.get('cursor'), d['start'], d['end'])
+    except ValueError:
+        raise InvalidUsage(message=f"Wrong args <cursor>: {d.get('cursor')}")
+
+    async with AMSCore.read_conn(replicas.wants_primary(request)) as conn:
+        rows, next_cursor = await AMSCore.search_txns(
+            conn, d['start'], d['end'], d['limit'], desc=d['order'] is Order.DESC, cursor=cursor,
+            from_addr=d.get('from'), to_addr=d.get('to'), asset=d.get('asset')
+        )
+    return json(
+        [TransactionRow.to_json(row, replace_id_with_hash=True) for row in rows],
+        headers={"X-AMS-Next-Cursor": next_cursor} if next_cursor else None,
+        dumps=dumps
+    )
+
+
+async def fetch_txn(tx_hash: str, primary: bool) -> Optional[Row]:
+    async with AMSCore.read_conn(primary) as conn:
+        transaction_model = await AMSCore.txn_model(txn_hash=tx_hash, conn=conn, create=False)
+        if transaction_model is None:
+            return None
+        return await conn.fetch_one(transaction_model.select().where(transaction_model.c.hash == tx_hash))
+
+
 @transactions_v1_bp.get('/<tx_hash:str>')
-async def get_transaction_by_hash(_: Request, tx_hash: str):
-    async with AMSCore.conn() as conn:
-        transaction_model = await AMSCore.txn_model(txn_hash=tx_hash, conn=conn)
-        select_txn = transaction_model.select().where(transaction_model.c.hash == tx_hash)
-        txn_row = await conn.fetch_one(select_txn)
+async def get_transaction_by_hash(request: Request, tx_hash: str):
+    primary = replicas.wants_primary(request)
+    txn_row = await fetch_txn(tx_hash, primary)
+    if not txn_row and not primary:
+        # may be too new for the replica: polled right after it was sent
+        txn_row = await fetch_txn(tx_hash, primary=True)
     if not txn_row:
         raise TransactionNotFound(extra=dict(tx_hash=tx_hash))
 
-    await AMSCore.validate_txn_row(txn_row)
+    if settings.AMS_VERIFY_ON_READ:
+        await AMSCore.validate_txn_row(txn_row)
 
-    return json(TransactionRow.to_json(txn_row), dumps=json_dumps, cls=MyEncoder)
+    return json(TransactionRow.to_json(txn_row), dumps=dumps)
 
 
 @transactions_v1_bp.post('/hash')
@@ -431,4 +336,4 @@ async def bulk_create_transaction_hash(request: Request):
         "op": op,
         "memo": memo,
         "hash": txn_hash
-    }), dumps=json_dumps, cls=MyEncoder)
+    }), dumps=dumps)
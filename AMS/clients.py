@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Dict
 
 import redis.asyncio as redis
 from databases import Database
@@ -13,14 +14,26 @@ redis_client = redis.Redis.from_url(settings.REDIS_URL)
 db_url = f'mysql+aiomysql://{settings.DB_USER}:{settings.DB_PASSWD}@' \
          f'{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}'
 
-database = Database(
-    db_url,
-    ssl=False,
-    echo='error',
-    min_size=settings.DB_MIN_CONN,
-    max_size=settings.DB_MAX_CONN,
-    pool_recycle=settings.DB_RECYCLE_SECONDS
-)
+
+def new_database(url: str) -> Database:
+    return Database(
+        url,
+        ssl=False,
+        echo='error',
+        min_size=settings.DB_MIN_CONN,
+        max_size=settings.DB_MAX_CONN,
+        pool_recycle=settings.DB_RECYCLE_SECONDS
+    )
+
+
+database = new_database(db_url)
+# a pool per MySQL instance, account shards are mapped to them by `AMS_DB_SHARD_MAP`
+databases: Dict[str, Database] = {
+    'default': database,
+    **{name: new_database(url) for name, url in settings.AMS_DB_BACKENDS.items()}
+}
+# read replicas of those, by the name of their primary
+replica_databases: Dict[str, Database] = {name: new_database(url) for name, url in settings.AMS_DB_REPLICAS.items()}
 
 
 @lru_cache(maxsize=1)
@@ -1,9 +1,14 @@
+import asyncio
+import base64
+import calendar
 import hashlib
 import json
+from collections import OrderedDict
 from copy import deepcopy
-from datetime import timedelta
+from datetime import timedelta, datetime
 from decimal import Decimal
-from typing import Optional, Type
+from types import SimpleNamespace
+from typing import Optional, Type, Tuple, Dict, List, Iterable, Union
 
 from arrow import Arrow
 from databases import Database
@@ -11,17 +16,34 @@ from databases.core import Connection
 from sanic import Sanic
 from sanic.exceptions import SanicException
 from sanic.log import logger
-from sqlalchemy import Table, select, update
+from sqlalchemy import Table, select, update, or_, and_, bindparam
 from sqlalchemy.engine import Row
 from sqlalchemy.sql.ddl import CreateTable, CreateIndex
 from stellar_sdk import Keypair
 
-from AMS.app.model import Transaction, Account
+from AMS.app.model import Transaction, Account, AccountTransaction, AccountBalance
 from AMS.app.telegram import send_msg, AMSWarningLevel
 from AMS.config import settings
+from AMS.core import executor, replicas, statements
+from AMS.core.sharding import ShardedConnection, connection, table_backend, DEFAULT_BACKEND
 from AMS.core.encoder import MyEncoder
+from AMS.core.metrics import metrics
 from AMS.exceptions import TransactionsBuildFailed, TransactionsExpired, InvalidTransaction, InvalidAccount
 
+ACC_HASH_V1 = 1
+ACC_HASH_V2 = 2
+AMOUNT_EXP = Decimal('0.0000000')   # DECIMAL(23,7)
+ASSET_MAX_LENGTH = AccountBalance.c.asset.type.length    # and `Transaction.asset`
+
+ACC_VERIFY_FIELDS = ('address', 'sequence', 'secret', 'mnemonic', 'balances', 'transactions',
+                     'hash', 'hash_version', 'prev_hash', 'hash_delta')
+# what `AccountRow.to_json` shows by default
+ACC_PUBLIC_FIELDS = ('address', 'sequence', 'balances', 'created_at', 'updated_at')
+LEGACY_ACC_SHARDS = 5
+RESHARD_COPY, RESHARD_SWITCH, RESHARD_DONE = 'copy', 'switch', 'done'
+SHARDED_MODELS = (Account, AccountTransaction, AccountBalance, Transaction)
+_verified_accs: "OrderedDict[tuple, None]" = OrderedDict()    # `AMSCore.acc_verify_key`s of verified rows, LRU
+
 
 class AMSCoreClass:
     index = [5, 0, 1, 8, 4, 6, 2, 3, 9, 7]
@@ -32,7 +54,8 @@ class AMSCoreClass:
     def __init__(self):
         self.TABLE_SPLIT_FMT = '%Y_%m'
         self.model_mapping = {}
-        self.acc_table_num = 5
+        self.acc_table_num = settings.AMS_ACC_SHARDS
+        self.reshard: Optional[dict] = None    # {"from", "to", "state", "since"} while resharding, see `reshard`
 
     @classmethod
     def db(cls) -> Database:
@@ -41,14 +64,32 @@ class AMSCoreClass:
 
     @classmethod
     def conn(cls):
-        return cls.db().connection()
+        """Connection routing every statement to the MySQL instance of its tables, see `sharding`"""
+        return connection(Sanic.get_app(settings.APP_NAME).ctx.databases)
+
+    @classmethod
+    def read_conn(cls, primary: bool = False):
+        """`conn()` for reads that may miss the latest writes: on the read replicas within
+        `AMS_REPLICA_MAX_LAG_SECONDS`, the primaries for the others. `primary` for reads that must see them.
+        """
+        ctx = Sanic.get_app(settings.APP_NAME).ctx
+        return connection(ctx.databases if primary else replicas.route(ctx.databases, ctx.replicas))
 
     @classmethod
-    def format_query(cls, query: str, values: dict):
-        for k, v in values.items():
-            query = query.replace(f":{k}", str(v))
+    def new_conn(cls, like=None) -> Connection:
+        """A pooled connection of its own (default backend), `conn()` is shared by everything in the same
+        task context. `like`: of that connection's pools (a replica's, see `read_conn`).
+        """
+        if like is None:
+            return Connection(cls.db()._backend)
+        if isinstance(like, ShardedConnection):
+            return Connection(like.databases[DEFAULT_BACKEND]._backend)
+        return Connection(like._backend)
 
-        return query
+    @classmethod
+    async def table_conn(cls, conn, table_name: str) -> Connection:
+        """The connection for raw SQL about `table_name` (`SHOW`, DDL)"""
+        return await conn.on(table_backend(table_name)) if isinstance(conn, ShardedConnection) else conn
 
     @classmethod
     def build_txn_hash(cls, asset, from_addr, to_addr, amount, from_sequence, create_at, op=None):
@@ -96,36 +137,136 @@ class AMSCoreClass:
     @classmethod
     def build_acc_hash(cls, address: str, sequence: int, secret: str, balances: list, mnemonic: str,
                        transactions: list):
+        """v1: the whole row, `transactions` included"""
         acc_raw = {
             "address": address, "sequence": sequence, "secret": secret,
             "balances": balances, "mnemonic": mnemonic,
             "transactions": transactions,
         }
         origin_hash: str = hashlib.blake2s(json.dumps(acc_raw, separators=(',', ':')).encode()).hexdigest()
+        return acc_raw, cls.rotate_acc_hash(origin_hash), origin_hash
+
+    @classmethod
+    def build_acc_hash_v2(cls, prev_hash: Optional[str], address: str, sequence: int, secret: str, mnemonic: str,
+                          balances: list, delta: Optional[dict]):
+        """v2: chained from the previous hash and the delta that was applied to get this state.
+
+        Covers everything but the history, so its cost doesn't grow with the account, and it only needs
+        values a writer already holds: no re-read of the row.
+        """
+        acc_raw = {
+            "version": ACC_HASH_V2, "prev_hash": prev_hash or '',
+            "address": address, "sequence": sequence, "secret": secret, "mnemonic": mnemonic,
+            "balances": [{"asset": b['asset'], "balance": cls.format_amount(b['balance'])} for b in balances],
+            "delta": delta,
+        }
+        # MySQL re-orders JSON object keys, `sort_keys` keeps the read back `hash_delta` stable
+        origin_hash: str = hashlib.blake2s(
+            json.dumps(acc_raw, separators=(',', ':'), sort_keys=True).encode()).hexdigest()
+        return acc_raw, cls.rotate_acc_hash(origin_hash), origin_hash
+
+    @classmethod
+    def format_amount(cls, amount) -> str:
+        """`DECIMAL(23,7)` text without exponent, i.e. zero is '0.0000000' and not '0E-7'"""
+        return format(Decimal(amount).quantize(AMOUNT_EXP), 'f')
+
+    @classmethod
+    def acc_delta(cls, txn_hash: Optional[str], *changes: Tuple[str, Decimal]) -> dict:
+        """The `delta` of `build_acc_hash_v2`: applied transaction and its signed (asset, amount) changes"""
+        return {
+            "txn": txn_hash,
+            "changes": [{"asset": asset, "amount": cls.format_amount(amount)} for asset, amount in changes]
+        }
 
-        _hash = origin_hash[-(len(origin_hash) - cls.acc_hash_split_index):] + origin_hash[:cls.acc_hash_split_index]
-        return acc_raw, _hash, origin_hash
+    @classmethod
+    def rotate_acc_hash(cls, origin_hash: str) -> str:
+        return origin_hash[-(len(origin_hash) - cls.acc_hash_split_index):] + origin_hash[:cls.acc_hash_split_index]
 
     @classmethod
     def parse_acc_hash(cls, acc_hash: str) -> str:
         return acc_hash[-cls.acc_hash_split_index:] + acc_hash[:len(acc_hash) - cls.acc_hash_split_index]
 
     @classmethod
-    async def validate_acc_row(cls, row: Row):
-        try:
+    def _freeze(cls, value):
+        if isinstance(value, dict):
+            return tuple((k, cls._freeze(v)) for k, v in sorted(value.items()))
+        if isinstance(value, list):
+            return tuple(cls._freeze(v) for v in value)
+        return value
+
+    @classmethod
+    def acc_verify_key(cls, row: Row, balances: Optional[list] = None) -> tuple:
+        """Memo key of a verified row: its identity, and a digest of every value the hash covers.
+
+        The digest is Python's `hash()` (SipHash, keyed per process), so no JSON and no blake2s: a row changed
+        in any covered value gets another key and is verified again.
+        """
+        if row.hash_version == ACC_HASH_V2:
+            covered = (row.prev_hash, row.secret, row.mnemonic, cls._freeze(row.hash_delta),
+                       cls._freeze(row.balances if balances is None else balances))
+        else:
+            covered = (row.secret, row.mnemonic, cls._freeze(row.balances), tuple(row.transactions or ()))
+        return row.address, row.sequence, row.hash, row.hash_version, hash(covered)
+
+    @classmethod
+    def check_acc_row(cls, row: Row, balances: Optional[list] = None):
+        """`balances` as read by `acc_balances`, v1 rows are always checked against their legacy JSON.
+
+        Rows already verified in this process are looked up in a bounded memo instead of being re-hashed.
+        """
+        key = cls.acc_verify_key(row, balances)
+        if cls._acc_verified(key):
+            return
+        cls._check_acc_row(row, balances)
+        cls._add_acc_verified(key)
+
+    @classmethod
+    def _acc_verified(cls, key: tuple) -> bool:
+        if key in _verified_accs:
+            _verified_accs.move_to_end(key)
+            metrics.inc('acc_verify.memo_hit')
+            return True
+        return False
+
+    @classmethod
+    def _add_acc_verified(cls, key: tuple):
+        metrics.inc('acc_verify.hashed')
+        _verified_accs[key] = None
+        if len(_verified_accs) > settings.AMS_ACC_VERIFY_MEMO_SIZE:
+            _verified_accs.popitem(last=False)
+
+    @classmethod
+    def _check_acc_row(cls, row: Row, balances: Optional[list] = None):
+        if row.hash_version == ACC_HASH_V2:
+            cls.validate_acc_hash_v2(
+                acc_hash=row.hash, prev_hash=row.prev_hash, addr=row.address, sequence=row.sequence,
+                secret=row.secret, mnemonic=row.mnemonic, delta=row.hash_delta,
+                balances=row.balances if balances is None else balances
+            )
+        else:
             cls.validate_acc_hash(
                 acc_hash=row.hash, addr=row.address, sequence=row.sequence,
                 secret=row.secret, balances=row.balances, mnemonic=row.mnemonic,
                 transactions=row.transactions
             )
+
+    @classmethod
+    async def validate_acc_row(cls, row: Row, balances: Optional[list] = None):
+        """`check_acc_row`, large rows (v1 with a long `transactions`) are hashed in the process pool"""
+        try:
+            key = cls.acc_verify_key(row, balances)
+            if not cls._acc_verified(key):
+                # v2 rows come without `transactions` (see `with_acc_history`), their hash doesn't cover it
+                covered = SimpleNamespace(**{name: getattr(row, name, None) for name in ACC_VERIFY_FIELDS})
+                size = len(row.transactions or ()) if row.hash_version != ACC_HASH_V2 else 0
+                await executor.in_process(cls._check_acc_row, covered, balances, size=size)
+                cls._add_acc_verified(key)
         except InvalidAccount as e:
             await send_msg(f"Account: {row.hash}", level=AMSWarningLevel.invalid_account)
             raise e
 
-    @classmethod
-    async def validate_acc(cls, conn: Connection, address: str, model: Table):
-        row: Optional[Row] = await conn.fetch_one(select(model).where(model.c.address == address))
-        await cls.validate_acc_row(row)
+    async def validate_acc(self, conn: Connection, address: str, model: Table):
+        await self.fetch_acc(conn, model, address)
 
     @classmethod
     def build_acc_hash_raw(cls, row: Row) -> str:
@@ -135,12 +276,53 @@ class AMSCoreClass:
         )[1]
 
     @classmethod
-    async def acc_rehash(cls, conn: Connection, model: Table, address: str):
-        row: Optional[Row] = await conn.fetch_one(query=select(model).where(model.c.address == address))
+    def acc_hash_columns(cls, model: Table) -> list:
+        """Everything a v2 hash covers, i.e. the row without the legacy `transactions` blob"""
+        return [c for c in model.c if c.name != 'transactions']
+
+    @classmethod
+    def acc_read_columns(cls, model: Table, fields: Optional[Iterable[str]] = None, validate: bool = False) -> list:
+        """`model`'s columns to read for `fields`, `address` and `balances` included (see `acc_balances`), and what a
+        hash check needs if `validate` (but `transactions`, see `with_acc_history`). `None`: all but `transactions`
+        """
+        if fields is None:
+            return cls.acc_hash_columns(model)
+        names = {'address', 'balances', *fields}
+        if validate:
+            names.update(name for name in ACC_VERIFY_FIELDS if name != 'transactions')
+        return [c for c in model.c if c.name in names]
+
+    async def with_acc_history(self, conn: Connection, model: Table, row: Row):
+        """`row`, read without `transactions`, as a hash check needs it: v1 hashes cover the blob, it's read for
+        the accounts still hashed v1 only (upgraded to v2 on their next write)
+        """
+        if row.hash_version == ACC_HASH_V2 or 'transactions' in row._fields:
+            return row
+        transactions = await conn.fetch_val(select(model.c.transactions).where(model.c.address == row.address))
+        return SimpleNamespace(**row._mapping, transactions=transactions)
+
+    @classmethod
+    def chain_acc_hash_values(cls, row, sequence: int, balances: list, delta: Optional[dict]) -> dict:
+        """Column values for the next v2 state of `row` (which holds the current state)"""
+        _, _hash, _ = cls.build_acc_hash_v2(
+            prev_hash=row.hash, address=row.address, sequence=sequence, secret=row.secret, mnemonic=row.mnemonic,
+            balances=balances, delta=delta
+        )
+        return dict(hash=_hash, prev_hash=row.hash, hash_delta=delta, hash_version=ACC_HASH_V2)
+
+    async def acc_rehash(self, conn: Connection, model: Table, address: str, delta: Optional[dict] = None):
+        """Chain the hash of an already updated row, `delta` being what the update applied.
+
+        The row is locked by that update, and its `hash` is still the pre-update one. v1 rows are upgraded to v2
+        here, callers have validated them before writing.
+        """
+        row: Optional[Row] = await conn.fetch_one(
+            query=select(self.acc_hash_columns(model)).where(model.c.address == address))
+        balances = await self.acc_balances(conn, model, row)
         await conn.execute(
             update(model).
             where(model.c.address == address).
-            values(hash=cls.build_acc_hash_raw(row))
+            values(**self.chain_acc_hash_values(row, row.sequence, balances, delta))
         )
 
     @classmethod
@@ -152,6 +334,14 @@ class AMSCoreClass:
         if _target_origin_hash != _built_origin_hash:
             raise InvalidAccount(extra=dict(addr=addr))
 
+    @classmethod
+    def validate_acc_hash_v2(cls, acc_hash: str, prev_hash: Optional[str], addr: str, sequence: int, secret: str,
+                             mnemonic: str, balances: list, delta: Optional[dict]):
+        _target_origin_hash = cls.parse_acc_hash(acc_hash)
+        _, _, _built_origin_hash = cls.build_acc_hash_v2(prev_hash, addr, sequence, secret, mnemonic, balances, delta)
+        if _target_origin_hash != _built_origin_hash:
+            raise InvalidAccount(extra=dict(addr=addr))
+
     @classmethod
     async def validate_txn_row(cls, row: Row):
         try:
@@ -193,9 +383,65 @@ class AMSCoreClass:
     async def get_acc_model(self, address: str, conn: Connection) -> Table:
         return await self.acc_model(address, conn)
 
-    async def check_tables(self, table_name: str, conn: Connection, model: Table):
-        row: Optional[Row] = await conn.fetch_one(f"SHOW tables like '{table_name}';")
+    def register_model(self, table_name: str, model: Table) -> Table:
+        if self.model_mapping.get(table_name) is None:
+            new_model = deepcopy(model)
+            new_model.name = table_name
+            self.model_mapping[table_name] = new_model
+        return self.model_mapping[table_name]
+
+    async def prewarm(self, conn: Connection):
+        """Register every existing shard table of every sharded model with one `information_schema` query,
+        so requests don't run `SHOW tables` on first use
+        """
+        origins = {model.name: model for model in SHARDED_MODELS}
+        if isinstance(conn, ShardedConnection):
+            backends = {backend: await conn.on(backend) for backend in conn.databases}
+        else:
+            backends = {None: conn}
+        for backend, backend_conn in backends.items():
+            rows = await backend_conn.fetch_all(
+                r"SELECT TABLE_NAME FROM information_schema.TABLES "
+                r"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE '%\_\_%'"
+            )
+            for row in rows:
+                origin_name, _, suffix = row[0].partition('__')
+                origin = origins.get(origin_name)
+                # a table left on another instance than the one it's mapped to is not used
+                if origin is not None and suffix and backend in (None, table_backend(row[0])):
+                    self.register_model(row[0], origin)
+
+    def upcoming_tables(self) -> List[Tuple[str, Table]]:
+        """(table name, model) of every account shard (of both shard counts while resharding), and of this
+        and next month's transaction tables
+        """
+        suffixes = self.acc_shard_suffixes()
+        if self.reshard:
+            suffixes += [s for s in self.acc_shard_suffixes(self.reshard['to']) if s not in suffixes]
+        tables = [
+            (f"{model.name}__{suffix}", model)
+            for suffix in suffixes
+            for model in (Account, AccountTransaction, AccountBalance)
+        ]
+        now = Arrow.now()
+        for month in (now, now.shift(months=1)):
+            tables.append((f"{Transaction.name}__{month.strftime(self.TABLE_SPLIT_FMT)}", Transaction))
+        return tables
+
+    async def create_upcoming_tables(self, conn: Connection):
+        """DDL ahead of time, only the tables missing from `model_mapping` are checked, see `prewarm`"""
+        for table_name, model in self.upcoming_tables():
+            if self.model_mapping.get(table_name) is None:
+                await self.check_tables(table_name=table_name, conn=conn, model=model)
+
+    async def check_tables(self, table_name: str, conn: Connection, model: Table, create: bool = True):
+        conn = await self.table_conn(conn, table_name)
+        # bound, `_` escaped: `LIKE` would match `Account__1` against `Account_X1` too
+        row: Optional[Row] = await conn.fetch_one(
+            "SHOW TABLES LIKE :table_name", values=dict(table_name=table_name.replace('_', r'\_')))
         if not row:
+            if not create:
+                return
             new_model = deepcopy(model)
             new_model.name = table_name
             logger.info(f"Create Table: {CreateTable(new_model, if_not_exists=True)}")
@@ -206,10 +452,7 @@ class AMSCoreClass:
                     await conn.execute(CreateIndex(index))
             self.model_mapping[table_name] = new_model
         else:
-            if self.model_mapping.get(table_name) is None:
-                new_model = deepcopy(model)
-                new_model.name = table_name
-                self.model_mapping[table_name] = new_model
+            self.register_model(table_name, model)
 
     @classmethod
     def origin_table_name(cls, model):
@@ -222,19 +465,335 @@ class AMSCoreClass:
         local_dt_str = local_dt.strftime(self.TABLE_SPLIT_FMT)
         return f"{self.origin_table_name(model)}__{local_dt_str}", local_dt
 
-    async def txn_model(self, txn_hash: str, conn: Connection) -> Table:
+    async def txn_model(self, txn_hash: str, conn: Connection, create: bool = True) -> Optional[Table]:
+        """`None` if the month's table doesn't exist and `create` is off (reads don't run DDL)"""
         table_name, local_dt = self.__txn_table_name(txn_hash=txn_hash)
         if self.model_mapping.get(table_name) is None:
-            await self.check_tables(table_name=table_name, conn=conn, model=Transaction)
+            await self.check_tables(table_name=table_name, conn=conn, model=Transaction, create=create)
         return self.model_mapping.get(table_name)
 
-    async def acc_model(self, address: str, conn: Connection) -> Table:
+    def acc_table_no(self, address: str, shards: Optional[int] = None) -> int:
+        shards = shards or self.acc_table_num
+        return int(hashlib.blake2s(address.encode()).hexdigest(), 16) % shards + 1  # starts from 1
+
+    @classmethod
+    def acc_shard_suffix(cls, table_no: int, shards: int) -> str:
+        """Routing is versioned by the shard count: `Account__3` in the original 5 shards, `Account__32_3` in 32"""
+        return str(table_no) if shards == LEGACY_ACC_SHARDS else f"{shards}_{table_no}"
+
+    def acc_shard_suffixes(self, shards: Optional[int] = None) -> List[str]:
+        shards = shards or self.acc_table_num
+        return [self.acc_shard_suffix(table_no, shards) for table_no in range(1, shards + 1)]
+
+    def acc_table_name(self, address: str, shards: Optional[int] = None) -> str:
+        shards = shards or self.acc_table_num
+        return f"{self.origin_table_name(Account)}__{self.acc_shard_suffix(self.acc_table_no(address, shards), shards)}"
+
+    def acc_routes(self, address: str) -> Tuple[str, Optional[str]]:
+        """(primary, mirror) `Account__*` table names of `address`.
+
+        Reads go to the primary, writes to both (in one db transaction) while resharding:
+        `copy` reads the old shards, `switch` the new ones, `done` drops the old ones.
+        """
+        if not self.reshard:
+            return self.acc_table_name(address), None
+        old = self.acc_table_name(address, self.reshard['from'])
+        new = self.acc_table_name(address, self.reshard['to'])
+        if self.reshard['state'] == RESHARD_COPY:
+            return old, new
+        if self.reshard['state'] == RESHARD_SWITCH:
+            return new, old
+        return new, None
+
+    def acc_reshard_names(self, address: str) -> Optional[Tuple[str, str]]:
+        """(old, new) `Account__*` table names of `address` while both are written"""
+        if not self.reshard or self.reshard['state'] not in (RESHARD_COPY, RESHARD_SWITCH) \
+                or address == settings.AMS_FINANCE_ADDR:
+            return None
+        return self.acc_table_name(address, self.reshard['from']), self.acc_table_name(address, self.reshard['to'])
+
+    def _acc_mirror_name(self, address: str, acc_model: Table) -> Optional[str]:
+        # Finance is pinned to `Account__1` and never resharded
+        primary, mirror = self.acc_routes(address)
+        if mirror is None or acc_model.name != primary or address == settings.AMS_FINANCE_ADDR:
+            return None
+        return mirror
+
+    async def acc_mirror_model(self, address: str, acc_model: Table, conn: Connection) -> Optional[Table]:
+        """The table `acc_model`'s writes of `address` are mirrored to, if `acc_model` is its routed primary"""
+        mirror = self._acc_mirror_name(address, acc_model)
+        if mirror is None:
+            return None
+        if self.model_mapping.get(mirror) is None:
+            await self.check_tables(table_name=mirror, conn=conn, model=Account)
+        return self.model_mapping.get(mirror)
+
+    async def txn_rows(self, txn_hashes: List[str], conn: Connection) -> Dict[str, Row]:
+        """Fetch transactions by hash with one `hash IN (...)` per monthly table.
+
+        The first table is read on `conn`, the others concurrently on connections of their own.
+        """
+        hashes_by_model: Dict[Table, List[str]] = {}
+        for txn_hash in txn_hashes:
+            txn_model = await self.txn_model(txn_hash, conn=conn, create=False)
+            if txn_model is not None:
+                hashes_by_model.setdefault(txn_model, []).append(txn_hash)
+
+        async def fetch(txn_model: Table, hashes: List[str], conn_: Optional[Connection] = None) -> List[Row]:
+            query = select(txn_model).where(txn_model.c.hash.in_(hashes))
+            if conn_ is not None:
+                return await conn_.fetch_all(query)
+            async with self.new_conn(like=conn) as new_conn:
+                return await new_conn.fetch_all(query)
+
+        if not hashes_by_model:
+            return {}
+        tasks = [fetch(txn_model, hashes, conn if i == 0 else None)
+                 for i, (txn_model, hashes) in enumerate(hashes_by_model.items())]
+        return {row.hash: row for rows in await asyncio.gather(*tasks) for row in rows}
+
+    async def acc_model(self, address: str, conn: Connection, create: bool = True) -> Optional[Table]:
+        """`None` if the shard table doesn't exist and `create` is off (reads don't run DDL, a replica's read only)"""
         assert Keypair.from_public_key(address)
-        table_no = int(hashlib.blake2s(address.encode()).hexdigest(), 16) % self.acc_table_num + 1  # starts from 1
-        table_name = f"{self.origin_table_name(Account)}__{table_no}"
+        table_name, _ = self.acc_routes(address)
+        if self.model_mapping.get(table_name) is None:
+            await self.check_tables(table_name=table_name, conn=conn, model=Account, create=create)
+        return self.model_mapping.get(table_name)
+
+    @classmethod
+    def shard_suffix(cls, model: Table) -> str:
+        return model.name.split('__', 1)[1]
+
+    async def acc_txn_model(self, acc_model: Table, conn: Connection, create: bool = True) -> Optional[Table]:
+        """`AccountTransaction__N` index table living next to `Account__N`, `create` as for `acc_model`"""
+        table_name = f"{self.origin_table_name(AccountTransaction)}__{self.shard_suffix(acc_model)}"
+        if self.model_mapping.get(table_name) is None:
+            await self.check_tables(table_name=table_name, conn=conn, model=AccountTransaction, create=create)
+        return self.model_mapping.get(table_name)
+
+    async def acc_balance_model(self, acc_model: Table, conn: Connection, create: bool = True) -> Optional[Table]:
+        """`AccountBalance__N` living next to `Account__N`, `create` as for `acc_model`"""
+        table_name = f"{self.origin_table_name(AccountBalance)}__{self.shard_suffix(acc_model)}"
         if self.model_mapping.get(table_name) is None:
-            await self.check_tables(table_name=table_name, conn=conn, model=Account)
+            await self.check_tables(table_name=table_name, conn=conn, model=AccountBalance, create=create)
         return self.model_mapping.get(table_name)
 
+    async def acc_balances(self, conn: Connection, acc_model: Table, row) -> List[dict]:
+        """`row`'s balances as `[{"asset", "balance"}]` in trust order.
+
+        Read from `AccountBalance__N`, or from the legacy `balances` JSON while the account hasn't been moved.
+        No DDL: without the table (no trust line in the shard yet) there is none.
+        """
+        if row.balances is not None:
+            return [{"asset": b['asset'], "balance": self.format_amount(b['balance'])} for b in row.balances]
+        balance_model = await self.acc_balance_model(acc_model, conn=conn, create=False)
+        if balance_model is None:
+            return []
+        rows = await conn.fetch_all(
+            select(balance_model.c.asset, balance_model.c.balance).
+            where(balance_model.c.address == row.address).
+            order_by(balance_model.c.id)
+        )
+        return [{"asset": r.asset, "balance": self.format_amount(r.balance)} for r in rows]
+
+    async def fetch_acc(self, conn: Connection, acc_model: Table, address: str, validate: bool = True,
+                        fields: Optional[Iterable[str]] = None) -> Tuple[Optional[Row], List[dict]]:
+        """An account row and its balances, hash validated.
+
+        Only `fields` are read (see `acc_read_columns`), never the legacy `transactions` blob unless a v1 hash
+        needs it. While resharding, an account missing from its primary table is read from the mirror (not copied
+        yet).
+        """
+        columns = self.acc_read_columns(acc_model, fields, validate)
+        row: Optional[Row] = await conn.fetch_one(select(columns).where(acc_model.c.address == address))
+        if not row:
+            mirror = self.model_mapping.get(self._acc_mirror_name(address, acc_model))
+            if mirror is None:
+                return None, []
+            acc_model = mirror
+            row = await conn.fetch_one(
+                select(self.acc_read_columns(acc_model, fields, validate)).where(acc_model.c.address == address))
+            if not row:
+                return None, []
+        balances = await self.acc_balances(conn, acc_model, row)
+        if validate:
+            await self.validate_acc_row(await self.with_acc_history(conn, acc_model, row), balances)
+        return row, balances
+
+    async def add_acc_txn(self, conn: Connection, txn_hash: str, *accounts: Tuple[str, Table]):
+        """Append `txn_hash` to the history index of every (address, acc_model), already indexed ones are ignored.
+
+        One multi-row `INSERT IGNORE` per index table, cost does not depend on the account's history size.
+        While resharding, the index next to the mirror table is written too.
+        """
+        await self.add_acc_txns(conn, [(txn_hash, address, acc_model) for address, acc_model in accounts])
+
+    async def add_acc_txns(self, conn: Connection, entries: Iterable[Tuple[str, str, Table]]):
+        """`add_acc_txn` of several transactions: (txn_hash, address, acc_model) entries"""
+        values: Dict[Table, Dict[Tuple[str, str], dict]] = {}
+        for txn_hash, address, acc_model in entries:
+            _, create_at = self.parse_hash(txn_hash)
+            created_at = Arrow.fromtimestamp(create_at).to('utc').datetime
+            mirror = await self.acc_mirror_model(address, acc_model, conn=conn)
+            for model in (acc_model, mirror) if mirror is not None else (acc_model, ):
+                txn_idx_model = await self.acc_txn_model(model, conn=conn)
+                values.setdefault(txn_idx_model, {})[(address, txn_hash)] = {
+                    "address": address, "hash": txn_hash, "created_at": created_at
+                }
+        for txn_idx_model, rows in values.items():
+            await conn.execute(statements.template(
+                (txn_idx_model.name, 'add_acc_txns', len(rows)),
+                lambda: txn_idx_model.insert().prefix_with('IGNORE').values([
+                    {column: bindparam(f"{column}{i}", type_=txn_idx_model.c[column].type)
+                     for column in ('address', 'hash', 'created_at')}
+                    for i in range(len(rows))
+                ])
+            ).bind(**{f"{column}{i}": value for i, row in enumerate(rows.values()) for column, value in row.items()}))
+
+    @classmethod
+    def encode_acc_txn_cursor(cls, created_at: datetime, id_: int) -> str:
+        raw = f"{calendar.timegm(created_at.timetuple())}:{id_}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode_acc_txn_cursor(cls, cursor: str) -> Tuple[datetime, int]:
+        """`ValueError` on anything `encode_acc_txn_cursor` didn't make, out of range timestamps included"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            ts, id_ = raw.split(':')
+            return datetime.utcfromtimestamp(int(ts)), int(id_)
+        except (ValueError, OverflowError, OSError) as e:
+            raise ValueError(f"invalid cursor {cursor!r}") from e
+
+    @classmethod
+    def acc_txn_cursor(cls, cursor: Optional[str]) -> Union[None, str, Tuple[datetime, int]]:
+        """A history cursor as `acc_txn_hashes` takes it: a transaction hash (74 chars) as is, a keyset cursor
+        decoded (`ValueError` if it doesn't decode)
+        """
+        if not cursor or len(cursor) == 74:
+            return cursor or None
+        return cls.decode_acc_txn_cursor(cursor)
+
+    async def acc_txn_hashes(self, conn: Connection, address: str, acc_model: Table, limit: int,
+                             cursor: Union[None, str, Tuple[datetime, int]] = None,
+                             desc: bool = True) -> Tuple[List[str], Optional[str]]:
+        """One page of `address`'s transaction hashes ordered by (created_at, id), and the next page's cursor.
+
+        `cursor` (see `acc_txn_cursor`) is either the keyset cursor returned with the previous page or, for old
+        clients, the last hash of the previous page (looked up through the (address, hash) unique index).
+        Both seek straight into the (address, created_at, id) index, deep pages cost the same as the first.
+        """
+        txn_idx_model = await self.acc_txn_model(acc_model, conn=conn, create=False)
+        if txn_idx_model is None:
+            return [], None
+        created_at, id_ = txn_idx_model.c.created_at, txn_idx_model.c.id
+        query = select(txn_idx_model.c.hash, created_at, id_).where(txn_idx_model.c.address == address)
+        if cursor:
+            if isinstance(cursor, str):
+                cursor_row: Optional[Row] = await conn.fetch_one(
+                    select(created_at, id_).where(txn_idx_model.c.address == address, txn_idx_model.c.hash == cursor))
+                if not cursor_row:
+                    return [], None
+                cursor_created_at, cursor_id = cursor_row.created_at, cursor_row.id
+            else:
+                cursor_created_at, cursor_id = cursor
+            query = query.where(self.keyset_after(created_at, id_, cursor_created_at, cursor_id, desc))
+        rows = await conn.fetch_all(query.order_by(*self.keyset_order(created_at, id_, desc)).limit(limit))
+        next_cursor = self.encode_acc_txn_cursor(rows[-1].created_at, rows[-1].id) if len(rows) == limit else None
+        return [row.hash for row in rows], next_cursor
+
+    @classmethod
+    def keyset_after(cls, created_at, id_, cursor_created_at: datetime, cursor_id: int, desc: bool):
+        """Rows after the cursor in (created_at, id) order, an expanded row comparison MySQL turns into index ranges"""
+        if desc:
+            return or_(created_at < cursor_created_at, and_(created_at == cursor_created_at, id_ < cursor_id))
+        return or_(created_at > cursor_created_at, and_(created_at == cursor_created_at, id_ > cursor_id))
+
+    @classmethod
+    def keyset_order(cls, created_at, id_, desc: bool) -> tuple:
+        return (created_at.desc(), id_.desc()) if desc else (created_at, id_)
+
+    def txn_table_names(self, start: Arrow, end: Arrow, desc: bool = True) -> List[str]:
+        """`Transaction__YYYY_MM` names of the months [start, end) spans, as `txn_model` picks them (local time)"""
+        names = [
+            f"{self.origin_table_name(Transaction)}__{month.strftime(self.TABLE_SPLIT_FMT)}"
+            for month in Arrow.range('month', start.to('local').floor('month'), end.to('local').shift(seconds=-1))
+        ]
+        return names[::-1] if desc else names
+
+    @classmethod
+    def search_txn_cursor(cls, cursor: Optional[str], start: Arrow, end: Arrow) -> Optional[Tuple[datetime, int]]:
+        """A search cursor as `search_txns` takes it, `ValueError` if it doesn't decode to a time in [start, end]"""
+        if not cursor:
+            return None
+        created_at, id_ = cls.decode_acc_txn_cursor(cursor)
+        if not start <= Arrow.fromdatetime(created_at, tzinfo='utc') <= end:
+            raise ValueError(f"cursor {cursor!r} out of [{start}, {end}]")
+        return created_at, id_
+
+    async def search_txns(self, conn: Connection, start: Arrow, end: Arrow, limit: int, desc: bool = True,
+                          cursor: Optional[Tuple[datetime, int]] = None, from_addr: Optional[str] = None,
+                          to_addr: Optional[str] = None, asset: Optional[str] = None
+                          ) -> Tuple[List[Row], Optional[str]]:
+        """One page of the transactions created in [start, end) matching the filters, ordered by (created_at, id),
+        and the next page's cursor.
+
+        The monthly tables don't overlap in time, so merging them in order is reading them one after the other:
+        up to `AMS_TXN_SEARCH_CONCURRENCY` tables are queried at once on connections of their own, results are
+        taken in table order, and no table is started once `limit` rows are in. Queries already running are
+        awaited, not cancelled: a cancelled query leaves its pooled connection unusable.
+        Bulk transactions have no `to`, they match on `from` only. `cursor`: see `search_txn_cursor`.
+        """
+        if cursor:
+            cursor_created_at, cursor_id = cursor
+            cursor_at = Arrow.fromdatetime(cursor_created_at, tzinfo='utc')
+            # tables past the cursor's month are done
+            if desc:
+                end = min(end, cursor_at.shift(seconds=1))
+            else:
+                start = max(start, cursor_at)
+        if start >= end:
+            return [], None
+
+        models = []
+        for table_name in self.txn_table_names(start, end, desc):
+            if self.model_mapping.get(table_name) is None:
+                await self.check_tables(table_name=table_name, conn=conn, model=Transaction, create=False)
+            if self.model_mapping.get(table_name) is not None:
+                models.append(self.model_mapping[table_name])
+
+        def query(txn_model: Table):
+            c = txn_model.c
+            q = select(txn_model).where(c.created_at >= start.to('utc').naive, c.created_at < end.to('utc').naive)
+            if from_addr:
+                q = q.where(c['from'] == from_addr)
+            if to_addr:
+                q = q.where(c.to == to_addr)
+            if asset:
+                q = q.where(c.asset == asset)
+            if cursor:
+                q = q.where(self.keyset_after(c.created_at, c.id, cursor_created_at, cursor_id, desc))
+            return q.order_by(*self.keyset_order(c.created_at, c.id, desc)).limit(limit)
+
+        async def fetch(txn_model: Table) -> List[Row]:
+            async with self.new_conn(like=conn) as new_conn:
+                return await new_conn.fetch_all(query(txn_model))
+
+        rows: List[Row] = []
+        pending = [asyncio.create_task(fetch(m)) for m in models[:settings.AMS_TXN_SEARCH_CONCURRENCY]]
+        started = len(pending)
+        try:
+            while pending and len(rows) < limit:
+                rows.extend(await pending.pop(0))
+                if started < len(models) and len(rows) < limit:
+                    pending.append(asyncio.create_task(fetch(models[started])))
+                    started += 1
+        finally:
+            await asyncio.gather(*pending, return_exceptions=True)
+        metrics.inc('txn_search.tables', started)
+
+        rows = rows[:limit]
+        next_cursor = self.encode_acc_txn_cursor(rows[-1].created_at, rows[-1].id) if len(rows) == limit else None
+        return rows, next_cursor
 
 AMSCore = AMSCoreClass()
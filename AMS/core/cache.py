@@ -0,0 +1,135 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from AMS.app.model import AccountRow
+from AMS.clients import redis_client
+from AMS.config import settings
+from AMS.core import AMSCore, ACC_PUBLIC_FIELDS
+from AMS.core.encoder import dumps
+from AMS.core.metrics import metrics
+
+VERSION_TTL_SECONDS = 24 * 3600    # far longer than any entry lives, a version never goes back while it's used
+
+
+class AccountCache:
+    """Read-through cache of verified public account reads (`AccountRow.to_json`), keyed by address.
+
+    Each worker keeps an LRU, optionally backed by a Redis copy shared by all workers. Entries are tagged
+    with the account's version, a Redis counter every write path bumps after it commits, so one `MGET`
+    tells whether the local copy is still the current state. Without Redis, reads go to MySQL.
+    """
+
+    def __init__(self, size: int, ttl: int, shared: bool):
+        self.size = size
+        self.ttl = ttl
+        self.shared = shared
+        self._entries: OrderedDict[str, Tuple[int, float, dict]] = OrderedDict()
+
+    @staticmethod
+    def version_key(address: str) -> str:
+        return settings.AMS_ACC_CACHE_VERSION_NAME.format(address=address)
+
+    @staticmethod
+    def entry_key(address: str) -> str:
+        return settings.AMS_ACC_CACHE_ENTRY_NAME.format(address=address)
+
+    def _put(self, address: str, version: int, entry: dict):
+        self._entries[address] = (version, time.monotonic() + self.ttl, entry)
+        self._entries.move_to_end(address)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            metrics.inc('acc_cache.evict')
+
+    async def get(self, address: str) -> Tuple[Optional[dict], Optional[int]]:
+        """The cached entry if it's current, and the version to tag a freshly read one with (`None`: don't)"""
+        keys = [self.version_key(address), self.entry_key(address)] if self.shared else [self.version_key(address)]
+        try:
+            values = await redis_client.mget(keys)
+        except RedisError as e:
+            logger.warning(f"acc cache: {e}")
+            metrics.inc('acc_cache.error')
+            return None, None
+        version = int(values[0] or 0)
+
+        cached = self._entries.get(address)
+        if cached and cached[0] == version and cached[1] > time.monotonic():
+            self._entries.move_to_end(address)
+            metrics.inc('acc_cache.hit')
+            return cached[2], version
+        if self.shared and values[1]:
+            shared = json.loads(values[1])
+            if shared['version'] == version:
+                self._put(address, version, shared['entry'])
+                metrics.inc('acc_cache.hit_shared')
+                return shared['entry'], version
+        metrics.inc('acc_cache.miss')
+        return None, version
+
+    async def set(self, address: str, version: int, entry: dict):
+        self._put(address, version, entry)
+        if self.shared:
+            try:
+                await redis_client.set(
+                    self.entry_key(address), dumps({"version": version, "entry": entry}),
+                    ex=self.ttl
+                )
+            except RedisError as e:
+                logger.warning(f"acc cache: {e}")
+                metrics.inc('acc_cache.error')
+
+    async def invalidate(self, *addresses: str):
+        """Bump the versions of `addresses`, to be called once their writes are committed"""
+        for address in addresses:
+            self._entries.pop(address, None)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for address in addresses:
+                    pipe.incr(self.version_key(address))
+                    pipe.expire(self.version_key(address), VERSION_TTL_SECONDS)
+                    if self.shared:
+                        pipe.delete(self.entry_key(address))
+                await pipe.execute()
+        except RedisError as e:
+            # other workers serve their copy until it expires
+            logger.error(f"acc cache: invalidate {addresses} failed, {e}")
+            metrics.inc('acc_cache.error')
+        else:
+            metrics.inc('acc_cache.invalidate', len(addresses))
+
+    async def account(self, address: str, primary: bool = False) -> Optional[dict]:
+        """`AccountRow.to_json` of a verified account, `None` if it doesn't exist.
+
+        A miss is read from the primary when it's cached: the entry is tagged with the current version, a lagging
+        replica's state would be served as current until the next write. Read from a replica (unless `primary`)
+        when it isn't, without Redis.
+        """
+        entry, version = await self.get(address)
+        if entry is not None:
+            return entry
+        async with AMSCore.conn() if version is not None else AMSCore.read_conn(primary) as conn:
+            acc_model = await AMSCore.acc_model(address, conn=conn, create=False)
+            if acc_model is None:
+                return None
+            row, balances = await AMSCore.fetch_acc(
+                conn, acc_model, address, validate=settings.AMS_VERIFY_ON_READ, fields=ACC_PUBLIC_FIELDS)
+        if not row:
+            return None
+        entry = AccountRow.to_json(row, balances=balances)
+        if version is not None:
+            await self.set(address, version, entry)
+        return entry
+
+    def stats(self) -> dict:
+        hits = metrics.counters['acc_cache.hit'] + metrics.counters['acc_cache.hit_shared']
+        total = hits + metrics.counters['acc_cache.miss']
+        return {"hit_rate": hits / total if total else 0., "entries": len(self._entries)}
+
+
+acc_cache = AccountCache(
+    size=settings.AMS_ACC_CACHE_SIZE, ttl=settings.AMS_ACC_CACHE_TTL, shared=settings.AMS_ACC_CACHE_SHARED
+)
@@ -5,14 +5,17 @@
 # coding=utf-8
 # __author__ = 'Mio'
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from enum import Enum
+from functools import lru_cache
 from json import JSONEncoder
-from typing import Union, Optional
+from typing import Union, Optional, Tuple, Iterable, Mapping
 from uuid import UUID
 
 from arrow import Arrow
+from dateutil import tz
+from sqlalchemy.engine import Row
 
 unicode_type = str
 _TO_UNICODE_TYPES = (unicode_type, type(None))
@@ -53,3 +56,37 @@ class MyEncoder(JSONEncoder):
             return str(o)
 
         return JSONEncoder.default(self, o)
+
+
+# `tz.gettz()` once, not per timestamp
+LOCAL_TZ = tz.gettz()
+
+_encoder = MyEncoder()
+
+
+def dumps(obj) -> str:
+    """`json.dumps(obj, cls=MyEncoder)`, one encoder for every response"""
+    return _encoder.encode(obj)
+
+
+@lru_cache(maxsize=8192)
+def _utc_times(dt: datetime) -> Tuple[int, str]:
+    dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()), dt.astimezone(LOCAL_TZ).isoformat()
+
+
+def utc_times(dt: datetime) -> Tuple[int, str]:
+    """Unix seconds and local ISO 8601 text of the UTC `dt`, what
+    `Arrow.fromdatetime(dt, tzinfo=tz.tzutc()).to(tz.gettz())` gives as `int(.timestamp())` and JSON.
+
+    Rows of one page share their seconds, conversions are cached.
+    """
+    # the wall clock is what's UTC, like `Arrow.fromdatetime` with a `tzinfo` (an aware dt would hash by instant)
+    return _utc_times(dt.replace(tzinfo=None) if dt.tzinfo is not None else dt)
+
+
+def row_items(row: Union[Row, Mapping]) -> Tuple[Tuple[str, ...], Iterable]:
+    """Column names and values of a row, positionally (without `dict(row)`'s lookup per key)"""
+    if isinstance(row, Row):
+        return row._fields, row
+    return tuple(row), row.values()
@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Optional, TypeVar
+
+from AMS.config import settings
+from AMS.core.metrics import metrics
+
+T = TypeVar('T')
+
+_threads: Optional[ThreadPoolExecutor] = None
+_processes: Optional[ProcessPoolExecutor] = None
+
+
+def threads() -> ThreadPoolExecutor:
+    """For calls that release the GIL: hashlib over large buffers, pycryptodome, libsodium"""
+    global _threads
+    if _threads is None:
+        _threads = ThreadPoolExecutor(max_workers=settings.AMS_EXECUTOR_THREADS, thread_name_prefix='ams')
+    return _threads
+
+
+def processes() -> ProcessPoolExecutor:
+    """For pure Python work, arguments and results have to pickle"""
+    global _processes
+    if _processes is None:
+        _processes = ProcessPoolExecutor(max_workers=settings.AMS_EXECUTOR_PROCESSES)
+    return _processes
+
+
+def shutdown():
+    global _threads, _processes
+    for pool in (_threads, _processes):
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    _threads, _processes = None, None
+
+
+async def _run(pool: Executor, name: str, fn: Callable[..., T], *args, **kwargs) -> T:
+    gauge = f"executor.{name}.pending"
+    metrics.gauge(gauge, metrics.gauges.get(gauge, 0) + 1)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, partial(fn, *args, **kwargs))
+    finally:
+        metrics.gauge(gauge, metrics.gauges[gauge] - 1)
+        metrics.inc(f"executor.{name}.calls")
+
+
+async def in_thread(fn: Callable[..., T], *args, size: Optional[int] = None, **kwargs) -> T:
+    """`fn(*args, **kwargs)` in the thread pool, or inline when `size` is under `AMS_EXECUTOR_INLINE_SIZE`"""
+    if size is not None and size < settings.AMS_EXECUTOR_INLINE_SIZE:
+        return fn(*args, **kwargs)
+    return await _run(threads(), 'thread', fn, *args, **kwargs)
+
+
+async def in_process(fn: Callable[..., T], *args, size: Optional[int] = None, **kwargs) -> T:
+    """`fn(*args, **kwargs)` in the process pool, or inline when `size` is under `AMS_EXECUTOR_INLINE_SIZE`"""
+    if size is not None and size < settings.AMS_EXECUTOR_INLINE_SIZE:
+        return fn(*args, **kwargs)
+    return await _run(processes(), 'process', fn, *args, **kwargs)
@@ -0,0 +1,147 @@
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, List, Set, Tuple, Iterator
+
+from arrow import Arrow
+from databases.core import Connection
+from loguru import logger
+from sanic.exceptions import SanicException
+from sqlalchemy import Table, select, update
+
+from AMS.config import settings
+from AMS.core import AMSCore, transfer
+from AMS.core.group_commit import Job, Batcher
+from AMS.core.metrics import metrics
+from AMS.exceptions import TransactionsSendFailed
+
+
+@dataclass
+class PayoutJob(Job):
+    """One `POST /faucet/`, its models resolved (no DDL inside a batch)"""
+    finance_model: Table
+    models: Dict[str, Table]
+    to_addr: str
+    asset: str
+    amount: Decimal
+    memo: str
+
+    @property
+    def addresses(self) -> Set[str]:
+        return {self.to_addr}
+
+
+class FaucetEngine(Batcher):
+    """Faucet payouts of one worker paid together behind one lock of the `Finance` row.
+
+    The batch takes `Finance`'s row `FOR UPDATE`, hands out its next sequences, in order, to the payouts that
+    go through, and moves the sequence once. Concurrent batches (of other workers too) queue on that row
+    instead of racing on a guarded `UPDATE`. A payout failing on its own (asset not trusted) fails alone,
+    a failed batch (unknown recipient, deadlock) is retried one payout at a time.
+    """
+
+    async def commit(self, batch: List[PayoutJob]):
+        try:
+            async with AMSCore.conn() as conn:
+                async with conn.transaction():
+                    paid = await self.pay(conn, batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].resolve(error=e)
+                return
+            logger.warning(f"faucet: batch of {len(batch)} failed, paying one by one, {e}")
+            metrics.inc('faucet.fallback')
+            for job in batch:
+                if not job.future.done():
+                    await self.commit([job])
+            return
+        for job, txn_row in paid:
+            job.resolve(txn_row)
+
+    @staticmethod
+    async def pay(conn: Connection, batch: List[PayoutJob]) -> List[Tuple[PayoutJob, dict]]:
+        """The payouts of `batch` inside the caller's db transaction, jobs failing on their own are resolved"""
+        from_addr = settings.AMS_FINANCE_ADDR
+        finance_model = batch[0].finance_model
+        sequence = (await conn.fetch_one(
+            select(finance_model.c.sequence).where(finance_model.c.address == from_addr).with_for_update()
+        )).sequence
+        models = {}
+        for job in batch:
+            models.update(job.models)
+        states = await transfer.lock_accounts(conn, models)
+
+        payouts = []
+        for job in batch:
+            try:
+                states[job.to_addr].apply(job.asset, job.amount)
+            except SanicException as e:
+                job.resolve(error=e)
+                continue
+            txn_hash, create_at = AMSCore.validate_hash(
+                txn_hash='', asset=job.asset, from_addr=from_addr, to_addr=job.to_addr, amount=job.amount,
+                from_sequence=sequence)
+            payouts.append((job, txn_hash, create_at, sequence))
+            sequence += 1
+        if not payouts:
+            return []
+
+        await conn.execute(
+            update(finance_model).where(finance_model.c.address == from_addr).values(sequence=sequence))
+        await transfer.write_accounts(
+            conn, [states[job.to_addr] for job, *_ in payouts],
+            {job.to_addr: txn_hash for job, txn_hash, *_ in payouts})
+        # one multi-row INSERT per transaction table, this and next month's exist ahead of time
+        records: Dict[Table, List[Tuple[PayoutJob, dict]]] = {}
+        for job, txn_hash, create_at, from_sequence in payouts:
+            transaction_model = await AMSCore.txn_model(txn_hash=txn_hash, conn=conn, create=False)
+            if transaction_model is None:
+                raise TransactionsSendFailed(extra=dict(txn_hash=txn_hash))
+            records.setdefault(transaction_model, []).append((job, {
+                "hash": txn_hash,
+                "asset": job.asset,
+                "from": from_addr,
+                "to": job.to_addr,
+                "amount": job.amount,
+                "from_sequence": from_sequence,
+                "is_success": True,
+                "memo": job.memo,
+                "is_bulk": False,
+                "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
+            }))
+        paid = []
+        for transaction_model, jobs in records.items():
+            txn_rows = await transfer.insert_txns(conn, transaction_model, [values for _, values in jobs])
+            paid.extend((job, txn_row) for (job, _), txn_row in zip(jobs, txn_rows))
+        await AMSCore.add_acc_txns(conn, [
+            entry for job, txn_hash, *_ in payouts
+            for entry in ((txn_hash, from_addr, finance_model), (txn_hash, job.to_addr, job.models[job.to_addr]))
+        ])
+        return paid
+
+
+def chunks(jobs: List[PayoutJob], size: int) -> Iterator[List[PayoutJob]]:
+    """`jobs` grouped by recipient shard table, in chunks of at most `size` distinct recipients.
+
+    A recipient paid n times is in n chunks (its account hash chains one transaction per write), in order.
+    """
+    payouts: Dict[str, int] = {}
+    keyed = []
+    for job in jobs:
+        n = payouts[job.to_addr] = payouts.get(job.to_addr, -1) + 1
+        keyed.append(((n, job.models[job.to_addr].name), job))
+    keyed.sort(key=lambda i: i[0])
+    chunk, chunk_key = [], None
+    for key, job in keyed:
+        if chunk and (key != chunk_key or len(chunk) >= size):
+            yield chunk
+            chunk = []
+        chunk.append(job)
+        chunk_key = key
+    if chunk:
+        yield chunk
+
+
+faucet_engine = FaucetEngine(
+    window=settings.AMS_FAUCET_WINDOW_MS / 1000, max_batch=settings.AMS_FAUCET_MAX_BATCH,
+    max_pending=settings.AMS_FAUCET_MAX_PENDING, metric='faucet'
+)
@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+from abc import ABC, abstractmethod
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Dict, List, Optional, Set
+
+from loguru import logger
+from pymysql import IntegrityError
+from sanic.exceptions import SanicException
+from sqlalchemy import Table
+
+from AMS.clients import databases
+from AMS.config import settings
+from AMS.core import AMSCore, transfer
+from AMS.core.metrics import metrics
+
+
+@dataclass
+class Job:
+    """A request waiting for its batch, `future` is resolved with its result or error"""
+    future: asyncio.Future = field(init=False)
+
+    def __post_init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def addresses(self) -> Set[str]:
+        """Accounts the job writes, two jobs sharing one never run in the same batch"""
+        return set()
+
+    def resolve(self, result=None, error: Optional[BaseException] = None):
+        # the request may have gone away (cancelled) meanwhile
+        if self.future.done():
+            return
+        if error is None:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(error)
+
+
+class Batcher(ABC):
+    """Jobs of one worker collected for `window` seconds (or until `max_batch` are pending) and handed to
+    `commit` together, by one flusher task. A job sharing an account with an earlier pending one waits for
+    a later batch, so jobs on one account run in arrival order.
+    """
+
+    def __init__(self, window: float, max_batch: int, max_pending: int, metric: str):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.metric = metric
+        self._pending: List[Job] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def full(self) -> bool:
+        if len(self._pending) >= self.max_pending:
+            metrics.inc(f"{self.metric}.overflow")
+            return True
+        return False
+
+    async def submit(self, job: Job):
+        """`job`'s result once its batch committed, or the error it failed with"""
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            # in a context of its own: not sharing the submitting request's db connection
+            self._flusher = contextvars.Context().run(asyncio.create_task, self._flush_forever())
+        self._pending.append(job)
+        self._wakeup.set()
+        return await job.future
+
+    async def stop(self):
+        """The batch being committed finishes (a cancelled one would leave its requests waiting), then the jobs
+        still pending are committed one by one
+        """
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await flusher
+            finally:
+                self._stopping = False
+        # not batched yet: committed one by one
+        pending, self._pending = self._pending, []
+        for job in pending:
+            await self.commit([job])
+
+    def _next_batch(self) -> List[Job]:
+        """The first pending jobs on disjoint accounts, the rest stay queued in order"""
+        batch, rest, taken = [], [], set()
+        for job in self._pending:
+            if job.future.done():
+                continue
+            if len(batch) < self.max_batch and not job.addresses & taken:
+                batch.append(job)
+            else:
+                rest.append(job)
+            # a later job on the accounts of a deferred one stays behind it
+            taken |= job.addresses
+        self._pending = rest
+        return batch
+
+    async def _flush_forever(self):
+        """Until `stop`, which it leaves the pending jobs to"""
+        while not self._stopping:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.window)
+                if self._stopping:
+                    break
+            batch = self._next_batch()
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                await self.commit(batch)
+            except Exception as e:
+                logger.error(f"{self.metric}: {e}")
+                for job in batch:
+                    job.resolve(error=e)
+            metrics.inc(f"{self.metric}.batches")
+            metrics.inc(f"{self.metric}.jobs", len(batch))
+            metrics.gauge(f"{self.metric}.last_batch", len(batch))
+            metrics.gauge(f"{self.metric}.last_batch_ms", int((time.monotonic() - started) * 1000))
+
+    @abstractmethod
+    async def commit(self, batch: List[Job]):
+        """Run `batch`, resolving every job"""
+
+
+@dataclass
+class TransferJob(Job):
+    """One `POST /transactions/`, its models resolved (no DDL inside a batch)"""
+    txn_model: Table
+    models: Dict[str, Table]
+    txn_hash: str
+    asset: str
+    from_addr: str
+    to_addr: str
+    amount: Decimal
+    from_sequence: int
+    memo: str
+    create_at: int
+
+    @property
+    def addresses(self) -> Set[str]:
+        return {self.from_addr, self.to_addr}
+
+    async def run(self, conn) -> dict:
+        return await transfer.transfer(
+            conn, self.txn_model, self.models, self.txn_hash, self.asset, self.from_addr, self.to_addr,
+            self.amount, self.from_sequence, self.memo, self.create_at
+        )
+
+
+class GroupCommit(Batcher):
+    """Single transfers of one worker committed together: a batch runs in one db transaction on one
+    connection, each transfer in a savepoint.
+
+    A transfer failing on its own (funds, sequence, duplicate hash) rolls back to its savepoint and fails its
+    request alone; the others wait for the commit. When the batch itself fails (deadlock, lost connection,
+    commit error), its remaining transfers are retried one transaction each. Off, or with more than one MySQL
+    instance (savepoints don't nest in an XA transaction), every request commits its own transaction.
+    """
+
+    def __init__(self, enabled: bool, window: float, max_batch: int, max_pending: int):
+        super().__init__(window, max_batch, max_pending, metric='group_commit')
+        self.enabled = enabled
+
+    def accepts(self) -> bool:
+        """Whether the next transfer should go through a batch, per-request commits otherwise"""
+        return self.enabled and len(databases) == 1 and not self.full()
+
+    async def commit(self, batch: List[TransferJob]):
+        done: List[tuple] = []
+        try:
+            async with AMSCore.new_conn() as conn:
+                async with conn.transaction():
+                    for job in batch:
+                        try:
+                            async with conn.transaction():
+                                done.append((job, await job.run(conn)))
+                        except (SanicException, IntegrityError) as e:
+                            job.resolve(error=e)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].resolve(error=e)
+                return
+            # the whole transaction is gone, so are the savepoints of the jobs that went through
+            logger.warning(f"group commit: batch of {len(batch)} failed, committing one by one, {e}")
+            metrics.inc('group_commit.fallback')
+            await asyncio.gather(*(self.commit([job]) for job in batch if not job.future.done()))
+            return
+        for job, txn_row in done:
+            job.resolve(txn_row)
+
+
+group_commit = GroupCommit(
+    enabled=settings.AMS_GROUP_COMMIT, window=settings.AMS_GROUP_COMMIT_WINDOW_MS / 1000,
+    max_batch=settings.AMS_GROUP_COMMIT_MAX_BATCH, max_pending=settings.AMS_GROUP_COMMIT_MAX_PENDING
+)
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+from loguru import logger
+from redis.exceptions import RedisError
+from sanic import HTTPResponse
+
+from AMS.clients import redis_client
+from AMS.config import settings
+from AMS.core.metrics import metrics
+from AMS.exceptions import TransactionInProgress
+
+PENDING = 'pending:'
+
+# KEYS: the record, ARGV: the claim. Drops the record if it's still that claim.
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_release = redis_client.register_script(RELEASE)
+
+
+def record_key(txn_hash: str) -> str:
+    return settings.AMS_IDEMPOTENCY_NAME.format(txn_hash=txn_hash)
+
+
+def _replay(raw: str) -> HTTPResponse:
+    stored = json.loads(raw)
+    return HTTPResponse(stored['body'], status=stored['status'], content_type=stored['content_type'],
+                        headers={"X-AMS-Idempotent-Replay": "true"})
+
+
+async def _claim(txn_hash: str, claim: str) -> Optional[HTTPResponse]:
+    """`None` once `claim` holds the hash's record, the stored response if the first attempt completed meanwhile.
+
+    Waits up to `AMS_IDEMPOTENCY_WAIT_SECONDS` for an attempt in flight, `TransactionInProgress` after.
+    """
+    key, started = record_key(txn_hash), time.monotonic()
+    while True:
+        if await redis_client.set(key, claim, nx=True, ex=settings.AMS_IDEMPOTENCY_PENDING_SECONDS):
+            return None
+        raw = await redis_client.get(key)
+        if raw is not None and not raw.decode().startswith(PENDING):
+            metrics.inc('idempotency.replayed')
+            return _replay(raw.decode())
+        if raw is not None and time.monotonic() - started > settings.AMS_IDEMPOTENCY_WAIT_SECONDS:
+            metrics.inc('idempotency.in_progress')
+            raise TransactionInProgress(extra=dict(txn_hash=txn_hash))
+        # in flight, or released by a failed attempt: claimed again on the next round
+        await asyncio.sleep(settings.AMS_LOCK_POLL_SECONDS)
+
+
+async def once(txn_hash: str, handler: Callable[[], Awaitable[HTTPResponse]]) -> HTTPResponse:
+    """`handler()`'s response, run once per client built `txn_hash`.
+
+    The first attempt claims the hash in Redis, a duplicate waits for it and gets its stored response without
+    touching MySQL. Responses are kept `TXN_EXPIRED_SECONDS`: the hash is refused as expired after that anyway.
+    A failed attempt releases the claim, so a retry runs again. Without Redis, every attempt runs.
+    """
+    key, claim = record_key(txn_hash), f"{PENDING}{uuid4().hex}"
+    try:
+        stored = await _claim(txn_hash, claim)
+    except RedisError as e:
+        logger.warning(f"idempotency: {e}")
+        metrics.inc('idempotency.error')
+        return await handler()
+    if stored is not None:
+        return stored
+
+    try:
+        response = await handler()
+    except BaseException:
+        try:
+            await _release(keys=[key], args=[claim])
+        except RedisError as e:
+            # retries wait for the claim to lapse, `AMS_IDEMPOTENCY_PENDING_SECONDS`
+            logger.warning(f"idempotency: {e}")
+        raise
+    try:
+        await redis_client.set(key, json.dumps({
+            "status": response.status, "body": response.body.decode(), "content_type": response.content_type
+        }), ex=settings.TXN_EXPIRED_SECONDS)
+    except RedisError as e:
+        logger.warning(f"idempotency: {e}")
+        metrics.inc('idempotency.error')
+    return response
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from typing import Iterable, List, Optional
+from uuid import uuid4
+
+from loguru import logger
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+
+from AMS.config import settings
+from AMS.core.metrics import metrics
+
+# KEYS: ticket counter, then per lock name: the lock, its wait queue (score: ticket), its waiters' deadlines
+# ARGV: token, lease ms, waiter ttl ms
+# A waiter is queued once under a global ticket, so every queue orders waiters the same way (no cycles), and is
+# dropped from the queues when it stops polling. All the names are taken at once, by the waiter at the head of
+# every queue, or none.
+ACQUIRE = """
+local n = (#KEYS - 1) / 3
+local token, lease, ttl = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local ticket = nil
+local free = true
+for i = 1, n do
+    local lock, queue, deadlines = KEYS[1 + i], KEYS[1 + n + i], KEYS[1 + 2 * n + i]
+    for _, stale in ipairs(redis.call('zrangebyscore', deadlines, '-inf', now)) do
+        redis.call('zrem', queue, stale)
+        redis.call('zrem', deadlines, stale)
+    end
+    if not redis.call('zscore', queue, token) then
+        ticket = ticket or redis.call('incr', KEYS[1])
+        redis.call('zadd', queue, ticket, token)
+    end
+    redis.call('zadd', deadlines, now + ttl, token)
+    redis.call('pexpire', queue, ttl)
+    redis.call('pexpire', deadlines, ttl)
+    local holder = redis.call('get', lock)
+    if (holder and holder ~= token) or redis.call('zrange', queue, 0, 0)[1] ~= token then
+        free = false
+    end
+end
+if not free then
+    return 0
+end
+for i = 1, n do
+    redis.call('set', KEYS[1 + i], token, 'px', lease)
+    redis.call('zrem', KEYS[1 + n + i], token)
+    redis.call('zrem', KEYS[1 + 2 * n + i], token)
+end
+return 1
+"""
+
+# KEYS: the locks, ARGV: token, lease ms. Number of locks still held (and extended).
+RENEW = """
+local held = 0
+for i = 1, #KEYS do
+    if redis.call('get', KEYS[i]) == ARGV[1] then
+        redis.call('pexpire', KEYS[i], ARGV[2])
+        held = held + 1
+    end
+end
+return held
+"""
+
+# KEYS: the locks, then their queues and deadlines. Releases what's held and leaves the queues.
+RELEASE = """
+local n = #KEYS / 3
+for i = 1, n do
+    if redis.call('get', KEYS[i]) == ARGV[1] then
+        redis.call('del', KEYS[i])
+    end
+    redis.call('zrem', KEYS[n + i], ARGV[1])
+    redis.call('zrem', KEYS[2 * n + i], ARGV[1])
+end
+return 1
+"""
+
+
+class MultiLock:
+    """All or none of several Redis locks, taken in one script call with a fair (FIFO) wait, renewed while held,
+    released in one call.
+
+    `LockError` if they can't be taken within `blocking_timeout` seconds.
+    """
+
+    def __init__(self, redis: Redis, names: Iterable[str], lease: float, blocking_timeout: float,
+                 metric: str = 'lock'):
+        self.redis = redis
+        self.names: List[str] = sorted(set(names))    # canonical order, the keys of one script call
+        self.lease = lease
+        self.blocking_timeout = blocking_timeout
+        self.metric = metric
+        self.token = uuid4().hex
+        self._renewal: Optional[asyncio.Task] = None
+        self._acquire, self._renew_script, self._release_script = (
+            redis.register_script(script) for script in (ACQUIRE, RENEW, RELEASE))
+
+    @property
+    def _queue_keys(self) -> List[str]:
+        return [f"{name}::queue" for name in self.names] + [f"{name}::deadlines" for name in self.names]
+
+    async def acquire(self):
+        keys = [settings.AMS_LOCK_TICKET_NAME, *self.names, *self._queue_keys]
+        poll = settings.AMS_LOCK_POLL_SECONDS
+        # a waiter missing polls for a second is dropped from the queues
+        args = [self.token, int(self.lease * 1000), int(max(poll * 5, 1.) * 1000)]
+        started = time.monotonic()
+        while not await self._acquire(keys=keys, args=args):
+            if time.monotonic() - started + poll > self.blocking_timeout:
+                await self._release()
+                metrics.inc(f"{self.metric}.timeout")
+                raise LockError(f"{self.names} not acquired in {self.blocking_timeout}s")
+            await asyncio.sleep(poll)
+        waited = time.monotonic() - started
+        metrics.inc(f"{self.metric}.acquired")
+        metrics.inc(f"{self.metric}.wait_ms", int(waited * 1000))
+        metrics.gauge(f"{self.metric}.last_wait_ms", int(waited * 1000))
+        self._renewal = asyncio.create_task(self._renew())
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            held = await self._renew_script(keys=self.names, args=[self.token, int(self.lease * 1000)])
+            if held != len(self.names):
+                # the lease ran out (event loop or redis stalled), someone else may hold them now
+                logger.error(f"lock: lost {len(self.names) - held} of {self.names}")
+                metrics.inc(f"{self.metric}.lost")
+                return
+
+    async def _release(self):
+        await self._release_script(keys=[*self.names, *self._queue_keys], args=[self.token])
+
+    async def release(self):
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+        await self._release()
+
+    async def __aenter__(self) -> "MultiLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
@@ -0,0 +1,23 @@
+import os
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """In-process counters and gauges, one set per worker"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, float] = {}
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def snapshot(self) -> dict:
+        return {"pid": os.getpid(), "counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+
+metrics = Metrics()
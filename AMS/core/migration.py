@@ -0,0 +1,248 @@
+from typing import Optional, List, Dict
+
+from arrow import Arrow
+from databases import Database
+from databases.core import Connection
+from loguru import logger
+from sqlalchemy import Table, select, update, func, null
+from sqlalchemy.dialects import mysql
+from sqlalchemy.engine import Row
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from AMS.app.model import Account, AccountBalance, Transaction
+from AMS.core import AMSCore, ACC_HASH_V2, ASSET_MAX_LENGTH
+from AMS.core.reshard import RESHARD_COMMANDS
+from AMS.core.sharding import connection
+from AMS.exceptions import InvalidAccount
+
+
+async def _acc_models(conn: Connection) -> List[Table]:
+    models = []
+    for suffix in AMSCore.acc_shard_suffixes():
+        table_name = f"{AMSCore.origin_table_name(Account)}__{suffix}"
+        await AMSCore.check_tables(table_name=table_name, conn=conn, model=Account)
+        models.append(AMSCore.get_model(table_name))
+    return models
+
+
+async def _migrate_account_transactions(conn: Connection, acc_model: Table, address: str, chunk_size: int) -> bool:
+    async with conn.transaction():
+        row: Optional[Row] = await conn.fetch_one(
+            select(acc_model).where(acc_model.c.address == address).with_for_update())
+        if not row or not row.transactions:
+            return True
+
+        txn_idx_model = await AMSCore.acc_txn_model(acc_model, conn=conn)
+        values = []
+        for txn_hash in row.transactions:
+            try:
+                _, create_at = AMSCore.parse_hash(txn_hash)
+            except Exception as e:
+                logger.error(f"{acc_model.name} {address}: skip malformed transaction {txn_hash!r} {e}")
+                continue
+            values.append({
+                "address": address, "hash": txn_hash,
+                "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
+            })
+        for i in range(0, len(values), chunk_size):
+            await conn.execute(txn_idx_model.insert().prefix_with('IGNORE').values(values[i:i + chunk_size]))
+
+        try:
+            AMSCore.check_acc_row(row)
+        except InvalidAccount:
+            # never rehash an account that doesn't validate, only its history index is filled
+            logger.warning(f"{acc_model.name} {address}: invalid hash, `transactions` kept")
+            return False
+
+        await conn.execute(update(acc_model).where(acc_model.c.address == address).values(transactions=[]))
+        if row.hash_version != ACC_HASH_V2:
+            # v1 covers `transactions`, chain it into v2 which doesn't
+            await AMSCore.acc_rehash(conn=conn, model=acc_model, address=address)
+    return True
+
+
+async def migrate_account_transactions(databases: Dict[str, Database], batch_size: int = 500, chunk_size: int = 1000):
+    """Move every `Account__N.transactions` JSON array into `AccountTransaction__N`.
+
+    Safe to run online and to re-run: each account is migrated under its row lock and index rows are
+    `INSERT IGNORE`d, writes that landed in the index meanwhile keep their order through `created_at`.
+    """
+    async with connection(databases) as conn:
+        acc_models = await _acc_models(conn)
+        for acc_model in acc_models:
+            last_id, migrated, kept = 0, 0, 0
+            while True:
+                rows = await conn.fetch_all(
+                    select(acc_model.c.id, acc_model.c.address).where(
+                        acc_model.c.id > last_id,
+                        func.json_length(acc_model.c.transactions) > 0
+                    ).order_by(acc_model.c.id).limit(batch_size)
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    if await _migrate_account_transactions(conn, acc_model, row.address, chunk_size):
+                        migrated += 1
+                    else:
+                        kept += 1
+                last_id = rows[-1].id
+            logger.info(f"{acc_model.name}: {migrated} accounts migrated, {kept} kept")
+
+
+async def _add_missing_columns(conn: Connection, model: Table, *column_names: str):
+    """`ALTER TABLE ... ADD COLUMN` for the model columns the table doesn't have yet (appended, so INSTANT)"""
+    conn = await AMSCore.table_conn(conn, model.name)
+    rows = await conn.fetch_all(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table",
+        values={"table": model.name}
+    )
+    existing = {row[0] for row in rows}
+    missing = [CreateColumn(model.c[name]).compile(dialect=mysql.dialect()) for name in column_names
+               if name not in existing]
+    if missing:
+        ddl = f"ALTER TABLE `{model.name}` " + ', '.join(f"ADD COLUMN {column}" for column in missing)
+        logger.info(ddl)
+        await conn.execute(ddl)
+
+
+async def _add_missing_indexes(conn: Connection, model: Table, *index_names: str):
+    """`CREATE INDEX` for the model indexes the table doesn't have yet (online DDL)"""
+    conn = await AMSCore.table_conn(conn, model.name)
+    rows = await conn.fetch_all(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table",
+        values={"table": model.name}
+    )
+    existing = {row[0] for row in rows}
+    for index in model.indexes:
+        if index.name in index_names and index.name not in existing:
+            logger.info(f"{model.name}: {CreateIndex(index)}")
+            await conn.execute(CreateIndex(index))
+
+
+async def migrate_txn_search_indexes(databases: Dict[str, Database]):
+    """Add the time range search indexes to the existing `Transaction__YYYY_MM` tables, new ones are created
+    with them
+    """
+    async with connection(databases) as conn:
+        await AMSCore.prewarm(conn)
+        for table_name in sorted(AMSCore.model_mapping):
+            if table_name.startswith(f"{Transaction.name}__"):
+                await _add_missing_indexes(
+                    conn, AMSCore.model_mapping[table_name], 'Transaction_created_at_id_index',
+                    'Transaction_from_created_at_id_index', 'Transaction_to_created_at_id_index'
+                )
+
+
+async def _migrate_acc_hash_v2(conn: Connection, acc_model: Table, address: str) -> bool:
+    async with conn.transaction():
+        row: Optional[Row] = await conn.fetch_one(
+            select(acc_model).where(acc_model.c.address == address).with_for_update())
+        if not row or row.hash_version == ACC_HASH_V2:
+            return True
+        try:
+            AMSCore.check_acc_row(row)
+        except InvalidAccount:
+            logger.warning(f"{acc_model.name} {address}: invalid v1 hash, kept")
+            return False
+        await conn.execute(
+            update(acc_model).where(acc_model.c.address == address).values(
+                **AMSCore.chain_acc_hash_values(row, row.sequence, row.balances, delta=None)))
+    return True
+
+
+async def migrate_acc_hash_v2(databases: Dict[str, Database], batch_size: int = 500):
+    """Add the v2 hash columns to every `Account__N`, then chain every valid v1 hash into a v2 one.
+
+    Run it before rolling out code that reads the new columns. Writes upgrade v1 rows lazily too,
+    re-run it later to convert the rest.
+    """
+    async with connection(databases) as conn:
+        acc_models = await _acc_models(conn)
+        for acc_model in acc_models:
+            await _add_missing_columns(conn, acc_model, 'hash_version', 'prev_hash', 'hash_delta')
+            last_id, migrated, kept = 0, 0, 0
+            while True:
+                rows = await conn.fetch_all(
+                    select(acc_model.c.id, acc_model.c.address).where(
+                        acc_model.c.id > last_id, acc_model.c.hash_version != ACC_HASH_V2
+                    ).order_by(acc_model.c.id).limit(batch_size)
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    if await _migrate_acc_hash_v2(conn, acc_model, row.address):
+                        migrated += 1
+                    else:
+                        kept += 1
+                last_id = rows[-1].id
+            logger.info(f"{acc_model.name}: {migrated} accounts chained to hash v2, {kept} kept")
+
+
+async def _migrate_account_balances(conn: Connection, acc_model: Table, address: str) -> bool:
+    async with conn.transaction():
+        row: Optional[Row] = await conn.fetch_one(
+            select(acc_model).where(acc_model.c.address == address).with_for_update())
+        if not row or row.balances is None:
+            return True
+        try:
+            AMSCore.check_acc_row(row)
+        except InvalidAccount:
+            logger.warning(f"{acc_model.name} {address}: invalid hash, `balances` kept")
+            return False
+        too_long = [b['asset'] for b in row.balances if len(b['asset']) > ASSET_MAX_LENGTH]
+        if too_long:
+            logger.warning(f"{acc_model.name} {address}: assets {too_long} longer than {ASSET_MAX_LENGTH} chars, "
+                           f"`balances` kept")
+            return False
+
+        balances = [{"asset": b['asset'], "balance": AMSCore.format_amount(b['balance'])} for b in row.balances]
+        if balances:
+            balance_model = await AMSCore.acc_balance_model(acc_model, conn=conn)
+            # one statement, ids follow the JSON array order
+            await conn.execute(balance_model.insert().values([
+                {"address": address, "asset": b['asset'], "balance": b['balance']} for b in balances
+            ]))
+        values = dict(balances=null())
+        if row.hash_version != ACC_HASH_V2:
+            # v1 covers the JSON itself, a v2 hash covers the same balances wherever they are stored
+            values.update(AMSCore.chain_acc_hash_values(row, row.sequence, balances, delta=None))
+        await conn.execute(update(acc_model).where(acc_model.c.address == address).values(**values))
+    return True
+
+
+async def migrate_account_balances(databases: Dict[str, Database], batch_size: int = 500):
+    """Move every `Account__N.balances` JSON array into `AccountBalance__N` rows, leaving `balances` NULL.
+
+    Safe to run online and to re-run: each account is moved under its row lock, and writes move the
+    accounts they touch on their own.
+    """
+    async with connection(databases) as conn:
+        acc_models = await _acc_models(conn)
+        for acc_model in acc_models:
+            await AMSCore.acc_balance_model(acc_model, conn=conn)
+            last_id, migrated, kept = 0, 0, 0
+            while True:
+                rows = await conn.fetch_all(
+                    select(acc_model.c.id, acc_model.c.address).where(
+                        acc_model.c.id > last_id, acc_model.c.balances.isnot(None)
+                    ).order_by(acc_model.c.id).limit(batch_size)
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    if await _migrate_account_balances(conn, acc_model, row.address):
+                        migrated += 1
+                    else:
+                        kept += 1
+                last_id = rows[-1].id
+            logger.info(f"{acc_model.name}: {migrated} accounts moved to {AccountBalance.name}, {kept} kept")
+
+
+MIGRATIONS = {
+    "account_transactions": migrate_account_transactions,
+    "acc_hash_v2": migrate_acc_hash_v2,
+    "account_balances": migrate_account_balances,
+    "txn_search_indexes": migrate_txn_search_indexes,
+    **RESHARD_COMMANDS,
+}
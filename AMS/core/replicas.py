@@ -0,0 +1,99 @@
+import math
+import time
+from typing import Dict, Tuple
+
+from databases import Database
+from loguru import logger
+from sanic import Request
+from sqlalchemy import select, literal_column
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.sql.ddl import CreateTable
+
+from AMS.app.model import Heartbeat
+from AMS.config import settings
+from AMS.core.metrics import metrics
+
+PRIMARY_HEADER = 'X-AMS-Read-Primary'
+HEARTBEAT_ID = 1
+
+_lags: Dict[str, Tuple[float, float]] = {}    # backend -> (replica lag in seconds, when it was measured)
+
+
+def wants_primary(request: Request) -> bool:
+    """The client needs to see its own writes: `X-AMS-Read-Primary: true`"""
+    return request.headers.get(PRIMARY_HEADER, '').lower() in ('1', 'true')
+
+
+def lag(backend: str) -> float:
+    """Last measured lag of `backend`'s replica, `inf` if unknown or not measured lately"""
+    measured = _lags.get(backend)
+    if measured is None or time.monotonic() - measured[1] > 3 * settings.AMS_REPLICA_HEARTBEAT_SECONDS:
+        return math.inf
+    return measured[0]
+
+
+def route(databases: Dict[str, Database], replicas: Dict[str, Database]) -> Dict[str, Database]:
+    """`databases` with the replicas within `AMS_REPLICA_MAX_LAG_SECONDS` in place of their primary"""
+    routed = {}
+    for name, database in databases.items():
+        if name in replicas and lag(name) <= settings.AMS_REPLICA_MAX_LAG_SECONDS:
+            routed[name] = replicas[name]
+            metrics.inc('replica.read')
+        else:
+            routed[name] = database
+            if name in replicas:
+                metrics.inc('replica.fallback')
+    return routed
+
+
+async def setup(databases: Dict[str, Database], replicas: Dict[str, Database]):
+    """`Heartbeat` on every primary with a replica, and the replicas' pools. A replica down at start is only logged,
+    reads stay on its primary until `measure` reaches it.
+    """
+    for name, replica in replicas.items():
+        async with databases[name].connection() as conn:
+            await conn.execute(CreateTable(Heartbeat, if_not_exists=True))
+        try:
+            await replica.connect()
+        except Exception as e:
+            logger.error(f"replica: {name} connect failed, {e}")
+        logger.info(f'db: {name} replica connection {replica.is_connected}')
+
+
+async def measure(databases: Dict[str, Database], replicas: Dict[str, Database]):
+    """Measure every replica's lag, then beat.
+
+    Lag is the primary's `beat` minus the one its replica has applied, both the primary's clock (no skew between
+    hosts). The replica is read first: one that's caught up is at 0, one that's d behind at most a heartbeat off d.
+    """
+    for name, replica in replicas.items():
+        query = select(Heartbeat.c.beat).where(Heartbeat.c.id == HEARTBEAT_ID)
+        beat = literal_column('UTC_TIMESTAMP(6)')
+        try:
+            if not replica.is_connected:
+                await replica.connect()
+            async with replica.connection() as conn:
+                replica_beat = await conn.fetch_val(query)
+            async with databases[name].connection() as conn:
+                primary_beat = await conn.fetch_val(query)
+                await conn.execute(
+                    insert(Heartbeat).values(id=HEARTBEAT_ID, beat=beat).on_duplicate_key_update(beat=beat))
+        except Exception as e:
+            logger.warning(f"replica: {name} not measured, {e}")
+            metrics.inc('replica.error')
+            _lags.pop(name, None)
+            continue
+        if primary_beat is None or replica_beat is None:
+            # no beat yet, or not replicated
+            _lags.pop(name, None)
+            continue
+        lag_ = max((primary_beat - replica_beat).total_seconds(), 0.)
+        _lags[name] = (lag_, time.monotonic())
+        metrics.gauge(f'replica.{name}.lag', lag_)
+
+
+async def disconnect(replicas: Dict[str, Database]):
+    for name, replica in replicas.items():
+        if replica.is_connected:
+            await replica.disconnect()
+        logger.info(f'db: {name} replica connection {replica.is_connected}')
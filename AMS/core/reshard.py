@@ -0,0 +1,237 @@
+import asyncio
+import time
+from typing import Optional, List, Dict
+
+from databases import Database
+from databases.core import Connection
+from loguru import logger
+from redis.exceptions import RedisError
+from sqlalchemy import Table, select, delete, func
+
+from AMS.app.model import Account
+from AMS.clients import redis_client
+from AMS.config import settings
+from AMS.core import AMSCore, RESHARD_COPY, RESHARD_SWITCH, RESHARD_DONE
+from AMS.core.sharding import table_backend, connection
+
+
+async def load_state() -> Optional[dict]:
+    """The resharding state shared by every worker, `None` when not resharding"""
+    raw = await redis_client.hgetall(settings.AMS_RESHARD_STATE_NAME)
+    if not raw:
+        return None
+    raw = {k.decode(): v.decode() for k, v in raw.items()}
+    return {"from": int(raw['from']), "to": int(raw['to']), "state": raw['state'], "since": float(raw['since'])}
+
+
+async def refresh():
+    """Pick up state changes made by the `reshard_*` commands, run periodically in every worker"""
+    try:
+        state = await load_state()
+    except RedisError as e:
+        # keep routing with the state we know
+        logger.warning(f"reshard: {e}")
+        return
+    if state != AMSCore.reshard:
+        logger.info(f"reshard: {state}")
+    AMSCore.reshard = state
+
+
+async def _set_state(state: str, from_: int, to: int):
+    await redis_client.hset(settings.AMS_RESHARD_STATE_NAME, mapping={
+        "from": from_, "to": to, "state": state, "since": time.time()
+    })
+    AMSCore.reshard = await load_state()
+    logger.info(f"reshard: {AMSCore.reshard}")
+
+
+async def _wait_grace():
+    """Until every worker has refreshed to the current state"""
+    wait = AMSCore.reshard['since'] + settings.AMS_RESHARD_GRACE_SECONDS - time.time()
+    if wait > 0:
+        logger.info(f"reshard: waiting {wait:.0f}s for the workers to pick up {AMSCore.reshard['state']}")
+        await asyncio.sleep(wait)
+
+
+async def _models(conn: Connection, table_name: str):
+    await AMSCore.check_tables(table_name=table_name, conn=conn, model=Account)
+    acc_model = AMSCore.get_model(table_name)
+    return (acc_model, await AMSCore.acc_balance_model(acc_model, conn=conn),
+            await AMSCore.acc_txn_model(acc_model, conn=conn))
+
+
+async def _copy(conn: Connection, target: Table, source: Table, address: str, *order_by: str, ignore=False):
+    """`INSERT INTO target SELECT ... FROM source` of `address`'s rows, ids are the target's own.
+
+    Read, then inserted, when the tables live on different MySQL instances.
+    """
+    columns = [c.name for c in source.c if c.name != 'id']
+    query = select([source.c[name] for name in columns]).where(source.c.address == address)
+    if order_by:
+        query = query.order_by(*[source.c[name] for name in order_by])
+    if table_backend(target.name) == table_backend(source.name):
+        insert = target.insert().from_select(columns, query)
+    else:
+        rows = await conn.fetch_all(query)
+        if not rows:
+            return
+        insert = target.insert().values([dict(row) for row in rows])
+    await conn.execute(insert.prefix_with('IGNORE') if ignore else insert)
+
+
+async def _balances(conn: Connection, acc_model: Table, address: str) -> List[dict]:
+    row = await conn.fetch_one(select(acc_model.c.address, acc_model.c.balances).where(acc_model.c.address == address))
+    return await AMSCore.acc_balances(conn, acc_model, row) if row else []
+
+
+async def copy_account(conn: Connection, address: str, verify: bool = False) -> bool:
+    """Bring `address`'s rows in the new shards up to its rows in the old ones, inside the caller's db transaction.
+
+    The old account row is locked first (`FOR UPDATE`), by the copy pass and by every dual-writing transfer,
+    so both serialize on it. Rows that are missing or differ (sequence, hash; balances and history size too
+    with `verify`) are re-copied. `True` if anything was copied.
+    """
+    names = AMSCore.acc_reshard_names(address)
+    if names is None:
+        return False
+    old, new = AMSCore.get_model(names[0]), AMSCore.get_model(names[1])
+    old_balance, new_balance = [await AMSCore.acc_balance_model(m, conn=conn) for m in (old, new)]
+    old_txn, new_txn = [await AMSCore.acc_txn_model(m, conn=conn) for m in (old, new)]
+
+    old_row = await conn.fetch_one(
+        select(old.c.sequence, old.c.hash).where(old.c.address == address).with_for_update())
+    if not old_row:
+        return False
+    new_row = await conn.fetch_one(
+        select(new.c.sequence, new.c.hash).where(new.c.address == address).with_for_update())
+    same = new_row is not None and (new_row.sequence, new_row.hash) == (old_row.sequence, old_row.hash)
+    if same and verify:
+        same = await _balances(conn, old, address) == await _balances(conn, new, address)
+    if same and not verify:
+        return False
+
+    if same:
+        # history is append only (`INSERT IGNORE`), a short one just misses entries
+        counts = [
+            await conn.fetch_val(select(func.count()).select_from(m).where(m.c.address == address))
+            for m in (old_txn, new_txn)
+        ]
+        if counts[0] == counts[1]:
+            return False
+    else:
+        await conn.execute(delete(new_balance).where(new_balance.c.address == address))
+        await conn.execute(delete(new).where(new.c.address == address))
+        await _copy(conn, new, old, address)
+        await _copy(conn, new_balance, old_balance, address, 'id')
+    await _copy(conn, new_txn, old_txn, address, 'created_at', 'id', ignore=True)
+    return True
+
+
+async def copy_pass(databases: Dict[str, Database], verify: bool = False):
+    """Stream every account of the old shards into the new ones, one db transaction per account"""
+    reshard = AMSCore.reshard
+    async with connection(databases) as conn:
+        for suffix in AMSCore.acc_shard_suffixes(reshard['to']):
+            await _models(conn, f"{Account.name}__{suffix}")
+        for suffix in AMSCore.acc_shard_suffixes(reshard['from']):
+            old, _, _ = await _models(conn, f"{Account.name}__{suffix}")
+            last_id, copied, total = 0, 0, 0
+            while True:
+                rows = await conn.fetch_all(
+                    select(old.c.id, old.c.address).where(old.c.id > last_id).
+                    order_by(old.c.id).limit(settings.AMS_RESHARD_BATCH_SIZE)
+                )
+                if not rows:
+                    break
+                started = time.monotonic()
+                for row in rows:
+                    if row.address == settings.AMS_FINANCE_ADDR:
+                        continue
+                    async with conn.transaction():
+                        copied += await copy_account(conn, row.address, verify=verify)
+                total += len(rows)
+                last_id = rows[-1].id
+                # throttle to AMS_RESHARD_ROWS_PER_SEC
+                await asyncio.sleep(
+                    max(0., len(rows) / settings.AMS_RESHARD_ROWS_PER_SEC - (time.monotonic() - started)))
+            logger.info(f"reshard: {old.name} {total} accounts, {copied} {'fixed' if verify else 'copied'}")
+
+
+async def _require(*states: Optional[str]) -> bool:
+    AMSCore.reshard = await load_state()
+    current = AMSCore.reshard['state'] if AMSCore.reshard else None
+    if current not in states:
+        logger.error(f"reshard: state is {current}, expected one of {states}")
+        return False
+    return True
+
+
+async def reshard_start(databases: Dict[str, Database]):
+    """Create the `AMS_RESHARD_TO` shard tables and start dual-writing to them"""
+    if not await _require(None):
+        return
+    from_, to = AMSCore.acc_table_num, settings.AMS_RESHARD_TO
+    if not to or to == from_:
+        logger.error(f"reshard: AMS_RESHARD_TO {to} has to differ from AMS_ACC_SHARDS {from_}")
+        return
+    async with connection(databases) as conn:
+        for suffix in AMSCore.acc_shard_suffixes(to):
+            await _models(conn, f"{Account.name}__{suffix}")
+    await _set_state(RESHARD_COPY, from_, to)
+
+
+async def reshard_copy(databases: Dict[str, Database]):
+    """Copy every account into the new shards, then verify them. Re-runnable"""
+    if not await _require(RESHARD_COPY):
+        return
+    await _wait_grace()
+    await copy_pass(databases)
+    await copy_pass(databases, verify=True)
+
+
+async def reshard_switch(databases: Dict[str, Database]):
+    """Verify, then read from the new shards (still writing both)"""
+    if not await _require(RESHARD_COPY):
+        return
+    await _wait_grace()
+    await copy_pass(databases, verify=True)
+    await _set_state(RESHARD_SWITCH, AMSCore.reshard['from'], AMSCore.reshard['to'])
+
+
+async def reshard_done(_: Dict[str, Database]):
+    """Stop writing the old shards, deploy `AMS_ACC_SHARDS = AMS_RESHARD_TO` next"""
+    if not await _require(RESHARD_SWITCH):
+        return
+    await _set_state(RESHARD_DONE, AMSCore.reshard['from'], AMSCore.reshard['to'])
+
+
+async def reshard_clear(_: Dict[str, Database]):
+    """Drop the state once every worker runs with the new `AMS_ACC_SHARDS`.
+
+    The old tables are left to be dropped by hand, but `Account__1` and its tables: Finance lives there.
+    """
+    if not await _require(RESHARD_DONE):
+        return
+    if AMSCore.acc_table_num != AMSCore.reshard['to']:
+        logger.error(f"reshard: AMS_ACC_SHARDS is {AMSCore.acc_table_num}, deploy {AMSCore.reshard['to']} first")
+        return
+    await redis_client.delete(settings.AMS_RESHARD_STATE_NAME)
+    AMSCore.reshard = None
+
+
+async def reshard_abort(_: Dict[str, Database]):
+    """Back to the old shards alone, they have been written all along"""
+    if not await _require(RESHARD_COPY, RESHARD_SWITCH):
+        return
+    await redis_client.delete(settings.AMS_RESHARD_STATE_NAME)
+    AMSCore.reshard = None
+
+
+RESHARD_COMMANDS = {
+    "reshard_start": reshard_start,
+    "reshard_copy": reshard_copy,
+    "reshard_switch": reshard_switch,
+    "reshard_done": reshard_done,
+    "reshard_clear": reshard_clear,
+    "reshard_abort": reshard_abort,
+}
@@ -0,0 +1,212 @@
+import time
+from typing import Dict, Optional, Union, Set
+from uuid import uuid4
+
+from databases import Database
+from databases.core import Connection
+from loguru import logger
+from redis.exceptions import LockError
+from sqlalchemy import Table
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.util import find_tables
+
+from AMS.app.model import Account, AccountTransaction, AccountBalance
+from AMS.clients import redis_client
+from AMS.config import settings
+from AMS.core.metrics import metrics
+from AMS.core.statements import Prepared
+
+DEFAULT_BACKEND = 'default'
+XID_PREFIX = 'ams-'
+ACC_SHARD_ORIGINS = {Account.name, AccountTransaction.name, AccountBalance.name}
+
+
+def table_backend(table_name: str) -> str:
+    """Backend of a table: account shards (and the tables next to them) as mapped by `AMS_DB_SHARD_MAP`,
+    everything else, `Transaction__YYYY_MM` included, on the default one
+    """
+    origin, _, suffix = table_name.partition('__')
+    if origin in ACC_SHARD_ORIGINS and suffix:
+        return settings.AMS_DB_SHARD_MAP.get(suffix, DEFAULT_BACKEND)
+    return DEFAULT_BACKEND
+
+
+def connection(databases: Dict[str, Database]) -> Union[Connection, "ShardedConnection"]:
+    """The default database's connection when there is only one backend, a `ShardedConnection` otherwise"""
+    if len(databases) == 1:
+        return databases[DEFAULT_BACKEND].connection()
+    return ShardedConnection(databases)
+
+
+class ShardedConnection:
+    """One connection per backend, acquired on first use, with the `databases.Connection` query API.
+
+    Statements go to the backend of the tables they touch (one backend per statement), raw SQL goes to
+    `backend`, the default one unless given. `transaction()` spans every backend used inside it.
+    """
+
+    def __init__(self, databases: Dict[str, Database]):
+        self.databases = databases
+        self._conns: Dict[str, Connection] = {}
+        self._xa: Optional[XATransaction] = None
+
+    async def __aenter__(self) -> "ShardedConnection":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        conns, self._conns = self._conns, {}
+        for conn in conns.values():
+            await conn.__aexit__(*exc_info)
+
+    async def on(self, backend: str) -> Connection:
+        """`backend`'s connection, joined to the running transaction"""
+        conn = self._conns.get(backend)
+        if conn is None:
+            conn = self._conns[backend] = self.databases[backend].connection()
+            await conn.__aenter__()
+        if self._xa is not None:
+            await self._xa.join(backend, conn)
+        return conn
+
+    @classmethod
+    def backend_of(cls, query) -> str:
+        if isinstance(query, (str, TextClause)):
+            return DEFAULT_BACKEND
+        if isinstance(query, Prepared):
+            query = query.statement
+        backends = {table_backend(table.name) for table in find_tables(query, check_columns=True, include_crud=True)
+                    if isinstance(table, Table)}
+        if len(backends) > 1:
+            raise ValueError(f"query spans backends {backends}: {query}")
+        return backends.pop() if backends else DEFAULT_BACKEND
+
+    async def fetch_all(self, query, values: Optional[dict] = None, backend: Optional[str] = None):
+        return await (await self.on(backend or self.backend_of(query))).fetch_all(query, values)
+
+    async def fetch_one(self, query, values: Optional[dict] = None, backend: Optional[str] = None):
+        return await (await self.on(backend or self.backend_of(query))).fetch_one(query, values)
+
+    async def fetch_val(self, query, values: Optional[dict] = None, column=0, backend: Optional[str] = None):
+        return await (await self.on(backend or self.backend_of(query))).fetch_val(query, values, column)
+
+    async def execute(self, query, values: Optional[dict] = None, backend: Optional[str] = None):
+        return await (await self.on(backend or self.backend_of(query))).execute(query, values)
+
+    async def execute_many(self, query, values: list, backend: Optional[str] = None):
+        return await (await self.on(backend or self.backend_of(query))).execute_many(query, values)
+
+    def transaction(self) -> "XATransaction":
+        return XATransaction(self)
+
+
+class XATransaction:
+    """A MySQL XA transaction, with one branch on every backend a statement runs on.
+
+    One branch commits in one phase. Several are prepared, the commit decision is logged in redis, then
+    every branch commits: a worker dying in between leaves prepared branches that `recover` resolves
+    with that log (commit if decided, rollback otherwise).
+    """
+
+    def __init__(self, conn: ShardedConnection):
+        self.conn = conn
+        self.xid = f"{XID_PREFIX}{int(time.time() * 1000)}-{uuid4().hex}"
+        self.branches: Dict[str, Connection] = {}
+        self._ended = False
+
+    async def join(self, backend: str, conn: Connection):
+        if backend not in self.branches:
+            await conn.execute("XA START :xid", values=dict(xid=self.xid))
+            self.branches[backend] = conn
+
+    async def __aenter__(self) -> "XATransaction":
+        if self.conn._xa is not None:
+            raise RuntimeError("nested transactions are not supported across backends")
+        self.conn._xa = self
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.conn._xa = None
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+
+    async def _end(self):
+        self._ended = True
+        for conn in self.branches.values():
+            await conn.execute("XA END :xid", values=dict(xid=self.xid))
+
+    async def commit(self):
+        if not self.branches:
+            return
+        try:
+            await self._end()
+            if len(self.branches) == 1:
+                await next(iter(self.branches.values())).execute(
+                    "XA COMMIT :xid ONE PHASE", values=dict(xid=self.xid))
+                return
+            for conn in self.branches.values():
+                await conn.execute("XA PREPARE :xid", values=dict(xid=self.xid))
+            await redis_client.hset(settings.AMS_XA_DECISION_NAME, self.xid, int(time.time()))
+        except BaseException:
+            await self.rollback()
+            raise
+
+        metrics.inc('xa.two_phase')
+        for backend, conn in self.branches.items():
+            try:
+                await conn.execute("XA COMMIT :xid", values=dict(xid=self.xid))
+            except Exception as e:
+                # decided, `recover` commits it
+                logger.error(f"xa: {self.xid} commit on {backend} failed, {e}")
+                metrics.inc('xa.in_doubt')
+                return
+        await redis_client.hdel(settings.AMS_XA_DECISION_NAME, self.xid)
+
+    async def rollback(self):
+        if not self._ended:
+            try:
+                await self._end()
+            except Exception as e:
+                logger.warning(f"xa: {self.xid} end failed, {e}")
+        for backend, conn in self.branches.items():
+            try:
+                await conn.execute("XA ROLLBACK :xid", values=dict(xid=self.xid))
+            except Exception as e:
+                logger.error(f"xa: {self.xid} rollback on {backend} failed, {e}")
+
+
+def _xid_age(xid: str) -> float:
+    return time.time() - int(xid[len(XID_PREFIX):].split('-')[0]) / 1000
+
+
+async def recover(databases: Dict[str, Database]):
+    """Resolve XA branches left prepared by a worker that died between prepare and commit.
+
+    Only branches older than `AMS_XA_RECOVER_AFTER_SECONDS` are touched, younger ones may still be committing.
+    """
+    try:
+        async with redis_client.lock(settings.AMS_XA_RECOVER_LOCK_NAME, blocking_timeout=0, timeout=60):
+            decisions = {xid.decode() for xid in await redis_client.hkeys(settings.AMS_XA_DECISION_NAME)}
+            prepared: Set[str] = set()
+            for backend, database in databases.items():
+                async with database.connection() as conn:
+                    for row in await conn.fetch_all("XA RECOVER"):
+                        xid = row['data'].decode() if isinstance(row['data'], bytes) else row['data']
+                        if not xid.startswith(XID_PREFIX):
+                            continue
+                        prepared.add(xid)
+                        if _xid_age(xid) < settings.AMS_XA_RECOVER_AFTER_SECONDS:
+                            continue
+                        decision = 'COMMIT' if xid in decisions else 'ROLLBACK'
+                        logger.warning(f"xa: {decision} prepared {xid} on {backend}")
+                        await conn.execute(f"XA {decision} :xid", values=dict(xid=xid))
+                        metrics.inc(f"xa.recovered_{decision.lower()}")
+            # decisions without a prepared branch left are done
+            done = [xid for xid in decisions
+                    if xid not in prepared and _xid_age(xid) >= settings.AMS_XA_RECOVER_AFTER_SECONDS]
+            if done:
+                await redis_client.hdel(settings.AMS_XA_DECISION_NAME, *done)
+    except LockError:
+        # another worker is recovering
+        return
@@ -0,0 +1,83 @@
+from typing import Callable, Dict, Hashable
+
+from sqlalchemy.dialects.mysql import pymysql
+from sqlalchemy.engine import Compiled
+from sqlalchemy.sql import ClauseElement
+
+from AMS.config import settings
+from AMS.core.metrics import metrics
+
+# the dialect `databases` compiles with
+DIALECT = pymysql.dialect(paramstyle="pyformat")
+DIALECT.supports_native_decimal = True
+
+
+class Template:
+    """A statement built with `bindparam`s and compiled once"""
+    __slots__ = ('statement', 'compiled')
+
+    def __init__(self, statement: ClauseElement):
+        self.statement = statement
+        self.compiled: Compiled = statement.compile(dialect=DIALECT)
+
+    def bind(self, **values) -> "Prepared":
+        return Prepared(self, values)
+
+
+class Prepared:
+    """A template and one execution's values, run by `databases` like any statement: its `compile()` hands back
+    the compiled template, only the parameters are built per call
+    """
+    __slots__ = ('template', 'values')
+
+    def __init__(self, template: Template, values: dict):
+        self.template = template
+        self.values = values
+
+    @property
+    def statement(self) -> ClauseElement:
+        return self.template.statement
+
+    def compile(self, *_, **__) -> "_Bound":
+        return _Bound(self.template.compiled, self.values)
+
+
+def _forwarded(name: str) -> property:
+    return property(lambda self: getattr(self.compiled, name), doc=f"The template's `{name}`")
+
+
+class _Bound:
+    """What `databases` 0.5.5 reads off a compiled statement (`MySQLConnection._compile`): the template's SQL,
+    bind processors and result columns, this execution's parameters. Anything else is an `AttributeError`, a
+    `databases` reading more has to be looked at before it's let in (it's pinned in requirements.txt).
+    """
+    __slots__ = ('compiled', 'values')
+
+    string = _forwarded('string')
+    _bind_processors = _forwarded('_bind_processors')
+    _result_columns = _forwarded('_result_columns')
+    _ordered_columns = _forwarded('_ordered_columns')
+    _textual_ordered_columns = _forwarded('_textual_ordered_columns')
+    _loose_column_name_matching = _forwarded('_loose_column_name_matching')
+
+    def __init__(self, compiled: Compiled, values: dict):
+        self.compiled = compiled
+        self.values = values
+
+    def construct_params(self) -> dict:
+        return self.compiled.construct_params(self.values)
+
+
+_templates: Dict[Hashable, Template] = {}
+
+
+def template(key: Hashable, build: Callable[[], ClauseElement]) -> Template:
+    """The template of `key`: (table name(s), statement kind, shape), `build()` and compiled on first use"""
+    cached = _templates.get(key)
+    if cached is None:
+        if len(_templates) >= settings.AMS_STATEMENT_CACHE_SIZE:
+            # the oldest one, shapes of unusual sizes come and go
+            _templates.pop(next(iter(_templates)))
+        cached = _templates[key] = Template(build())
+        metrics.inc('statements.compiled')
+    return cached
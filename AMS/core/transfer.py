@@ -0,0 +1,373 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple, Iterable, Union
+
+from arrow import Arrow
+from databases.core import Connection
+from pymysql import IntegrityError
+from sanic.exceptions import InvalidUsage
+from sqlalchemy import Table, select, update, union_all, case, null, and_, or_, bindparam
+from sqlalchemy.engine import Row
+from sqlalchemy.sql import ClauseElement, Select
+
+from AMS.core import AMSCore, AMOUNT_EXP, ASSET_MAX_LENGTH, reshard, statements
+from AMS.core.sharding import table_backend
+from AMS.exceptions import AddressNotFound, AssetNotTrusted, InsufficientFunds, TransactionsSendFailed
+
+
+@dataclass
+class AccountState:
+    """An account row and its balance rows locked `FOR UPDATE`, and the changes applied to them in Python so far"""
+    model: Table
+    balance_model: Table
+    row: Row
+    sequence: int
+    balances: List[dict]
+    changes: List[Tuple[str, Decimal]] = field(default_factory=list)
+    trusted: List[str] = field(default_factory=list)
+    mirror: Optional[Table] = None    # written the same as `model` while resharding
+    balance_mirror: Optional[Table] = None
+
+    @classmethod
+    def from_row(cls, model: Table, balance_model: Table, row: Row, balances: List[dict],
+                 mirror: Optional[Table] = None, balance_mirror: Optional[Table] = None) -> "AccountState":
+        return cls(
+            model=model, balance_model=balance_model, row=row, sequence=row.sequence,
+            balances=[{"asset": b['asset'], "balance": Decimal(b['balance'])} for b in balances],
+            mirror=mirror, balance_mirror=balance_mirror
+        )
+
+    @property
+    def models(self) -> List[Table]:
+        return [self.model] if self.mirror is None else [self.model, self.mirror]
+
+    @property
+    def balance_models(self) -> List[Table]:
+        return [self.balance_model] if self.balance_mirror is None else [self.balance_model, self.balance_mirror]
+
+    @property
+    def legacy(self) -> bool:
+        """Balances still in the `Account.balances` JSON, they are moved to `AccountBalance__N` on write"""
+        return self.row.balances is not None
+
+    @property
+    def address(self) -> str:
+        return self.row.address
+
+    def balance(self, asset: str) -> Optional[Decimal]:
+        """`None` if `asset` is not trusted"""
+        for b in self.balances:
+            if b['asset'] == asset:
+                return b['balance']
+        return None
+
+    def apply(self, asset: str, amount: Decimal):
+        """Add the signed `amount` of `asset`, a debit must be covered"""
+        for b in self.balances:
+            if b['asset'] == asset:
+                if b['balance'] + amount < 0:
+                    raise InsufficientFunds(extra=dict(amount=-amount, addr=self.address))
+                b['balance'] += amount
+                self.changes.append((asset, amount))
+                return
+        raise AssetNotTrusted(extra=dict(asset=asset, addr=self.address))
+
+    def trust(self, asset: str) -> bool:
+        """Add a zero balance of `asset` if it isn't trusted yet, every new trust line takes a sequence"""
+        if self.balance(asset) is not None:
+            return False
+        self.balances.append({"asset": asset, "balance": Decimal(0)})
+        self.changes.append((asset, Decimal(0)))
+        self.trusted.append(asset)
+        self.sequence += 1
+        return True
+
+    def deltas(self) -> Dict[str, Decimal]:
+        """Net change per already trusted asset, i.e. what `UPDATE ... SET balance = balance + ?` has to add"""
+        deltas: Dict[str, Decimal] = {}
+        for asset, amount in self.changes:
+            if asset not in self.trusted:
+                deltas[asset] = deltas.get(asset, Decimal(0)) + amount
+        return {asset: amount for asset, amount in deltas.items() if amount}
+
+    def new_balances(self) -> List[dict]:
+        """`AccountBalance__N` rows to insert: new trust lines, or every balance of a legacy account"""
+        too_long = [b['asset'] for b in self.balances if len(b['asset']) > ASSET_MAX_LENGTH] if self.legacy else []
+        if too_long:
+            # left in the legacy JSON by `migrate_account_balances`, a row can't hold them
+            raise InvalidUsage(message=f"Account {self.address} holds assets {too_long} longer than "
+                                       f"{ASSET_MAX_LENGTH} chars, its balances can't be moved")
+        return [
+            {"address": self.address, "asset": b['asset'], "balance": b['balance']}
+            for b in self.balances if self.legacy or b['asset'] in self.trusted
+        ]
+
+    def values(self, txn_hash: Optional[str]) -> dict:
+        """New account column values: sequence and the v2 hash chained with this state's changes"""
+        balances = [{"asset": b['asset'], "balance": AMSCore.format_amount(b['balance'])} for b in self.balances]
+        delta = AMSCore.acc_delta(txn_hash, *self.changes)
+        values = dict(sequence=self.sequence, **AMSCore.chain_acc_hash_values(self.row, self.sequence, balances, delta))
+        if self.legacy:
+            values['balances'] = null()
+        return values
+
+
+async def acc_models(conn: Connection, *addresses: str) -> Dict[str, Table]:
+    """Resolve account tables and the tables next to them (their mirrors too while resharding) before a db
+    transaction starts, creating a table is DDL (an implicit commit)
+    """
+    models = {}
+    for address in addresses:
+        models[address] = await AMSCore.acc_model(address, conn=conn)
+        mirror = await AMSCore.acc_mirror_model(address, models[address], conn=conn)
+        for model in (models[address], mirror) if mirror is not None else (models[address], ):
+            await AMSCore.acc_balance_model(model, conn=conn)
+            await AMSCore.acc_txn_model(model, conn=conn)
+    return models
+
+
+def _union(queries: list):
+    return queries[0] if len(queries) == 1 else union_all(*queries)
+
+
+def _addresses(model: Table, n: int, prefix: str) -> list:
+    return [bindparam(f"{prefix}{j}", type_=model.c.address.type) for j in range(n)]
+
+
+async def _fetch_locked(conn: Connection, kind: str, addresses_by_model: Dict[Table, List[str]],
+                        build: Callable[[Table, list], Select]) -> List[Row]:
+    """One `UNION ALL` of `build(model, address params)` per MySQL instance, instances in name order: a global
+    lock order across them (a deadlock spanning two instances is never detected, only timed out)
+    """
+    by_backend: Dict[str, List[Tuple[Table, List[str]]]] = {}
+    for model, addresses in addresses_by_model.items():
+        by_backend.setdefault(table_backend(model.name), []).append((model, sorted(addresses)))
+    rows = []
+    for backend in sorted(by_backend):
+        models = by_backend[backend]
+        query = statements.template(
+            (kind, tuple((model.name, len(addresses)) for model, addresses in models)),
+            lambda: _union([build(model, _addresses(model, len(addresses), f"a{i}_"))
+                            for i, (model, addresses) in enumerate(models)])
+        ).bind(**{f"a{i}_{j}": address
+                  for i, (_, addresses) in enumerate(models) for j, address in enumerate(addresses)})
+        rows.extend(await conn.fetch_all(query))
+    return rows
+
+
+async def lock_accounts(conn: Connection, models: Dict[str, Table]) -> Dict[str, AccountState]:
+    """`SELECT ... FOR UPDATE` every account in one statement (without the legacy `transactions` blob), then
+    their balance rows in another, validating their hashes.
+
+    Rows are locked in (table, address) order, so concurrent transfers over the same accounts queue
+    instead of deadlocking. While resharding, old shard rows are locked (and copied) first, in address order.
+    """
+    for address in sorted(models):
+        if AMSCore.acc_reshard_names(address) is not None:
+            await reshard.copy_account(conn, address)
+    addresses_by_model: Dict[Table, List[str]] = {}
+    for address, model in models.items():
+        addresses_by_model.setdefault(model, []).append(address)
+    addresses_by_model = dict(sorted(addresses_by_model.items(), key=lambda i: i[0].name))
+    balance_models = {model: await AMSCore.acc_balance_model(model, conn=conn) for model in addresses_by_model}
+
+    rows = await _fetch_locked(
+        conn, 'lock_accounts', addresses_by_model,
+        lambda model, params: select(AMSCore.acc_hash_columns(model)).where(model.c.address.in_(params)).
+        order_by(model.c.address).with_for_update()
+    )
+    balance_rows = await _fetch_locked(
+        conn, 'lock_balances',
+        {balance_model: addresses_by_model[model] for model, balance_model in balance_models.items()},
+        lambda balance_model, params: select(balance_model.c.address, balance_model.c.asset, balance_model.c.balance).
+        where(balance_model.c.address.in_(params)).
+        order_by(balance_model.c.address, balance_model.c.id).with_for_update()
+    )
+    balances_by_address: Dict[str, List[dict]] = {}
+    for r in balance_rows:
+        balances_by_address.setdefault(r.address, []).append(
+            {"asset": r.asset, "balance": AMSCore.format_amount(r.balance)})
+
+    states = {}
+    rows_by_address = {row.address: row for row in rows}
+    for address, model in models.items():
+        row = rows_by_address.get(address)
+        if not row:
+            raise AddressNotFound(extra=dict(address=address))
+        if row.balances is not None:
+            balances = [{"asset": b['asset'], "balance": AMSCore.format_amount(b['balance'])} for b in row.balances]
+        else:
+            balances = balances_by_address.get(address, [])
+        await AMSCore.validate_acc_row(await AMSCore.with_acc_history(conn, model, row), balances)
+        mirror = await AMSCore.acc_mirror_model(address, model, conn=conn)
+        balance_mirror = await AMSCore.acc_balance_model(mirror, conn=conn) if mirror is not None else None
+        states[address] = AccountState.from_row(model, balance_models[model], row, balances, mirror, balance_mirror)
+    return states
+
+
+async def write_balances(conn: Connection, states: Iterable[AccountState]):
+    """Per balance table: one multi-row `INSERT` for new rows, one `UPDATE ... SET balance = balance + ?`
+    for changed ones (`CASE` over (address, asset) when there are several)
+    """
+    inserts: Dict[Table, List[dict]] = {}
+    updates: Dict[Table, List[Tuple[str, str, Decimal]]] = {}
+    for state in states:
+        for balance_model in state.balance_models:
+            inserts.setdefault(balance_model, []).extend(state.new_balances())
+            if not state.legacy:
+                updates.setdefault(balance_model, []).extend(
+                    (state.address, asset, amount) for asset, amount in state.deltas().items())
+
+    for balance_model, values in inserts.items():
+        if values:
+            await conn.execute(balance_model.insert().values(values))
+    for balance_model, changes in updates.items():
+        if not changes:
+            continue
+        query = statements.template(
+            (balance_model.name, 'add_balances', len(changes)), lambda: _add_balances(balance_model, len(changes))
+        ).bind(**{f"{name}{i}": value for i, change in enumerate(changes)
+                  for name, value in zip(('address', 'asset', 'amount'), change)})
+        if await conn.execute(query) != len(changes):
+            raise TransactionsSendFailed(extra=dict(balances=[change[:2] for change in changes]))
+
+
+def _add_balances(balance_model: Table, n: int) -> ClauseElement:
+    c = balance_model.c
+    conditions = [and_(c.address == bindparam(f"address{i}", type_=c.address.type),
+                       c.asset == bindparam(f"asset{i}", type_=c.asset.type)) for i in range(n)]
+    amounts = [bindparam(f"amount{i}", type_=c.balance.type) for i in range(n)]
+    amount = amounts[0] if n == 1 else case(*zip(conditions, amounts))
+    return update(balance_model).where(or_(*conditions)).values(balance=c.balance + amount)
+
+
+async def write_accounts(conn: Connection, states: Iterable[AccountState],
+                         txn_hash: Union[Optional[str], Dict[str, str]]):
+    """Write the balances, then one `UPDATE` per account table, several rows of a table are written
+    with `CASE address`. `txn_hash` is chained into every account's hash, or one per address.
+    """
+    def chained(state: AccountState) -> dict:
+        return state.values(txn_hash[state.address] if isinstance(txn_hash, dict) else txn_hash)
+
+    states = list(states)
+    await write_balances(conn, states)
+    states_by_model: Dict[Table, List[AccountState]] = {}
+    for state in states:
+        for model in state.models:
+            states_by_model.setdefault(model, []).append(state)
+
+    for model, model_states in states_by_model.items():
+        values_by_address = [(state.address, chained(state)) for state in model_states]
+        # the shape: columns set per row, SQL expressions (`null()`) are part of the statement
+        shape = tuple(
+            tuple((column, str(value) if isinstance(value, ClauseElement) else None)
+                  for column, value in values.items())
+            for _, values in values_by_address
+        )
+        query = statements.template(
+            (model.name, 'write_accounts', shape), lambda: _write_accounts(model, values_by_address)
+        ).bind(**{
+            name: value for i, (address, values) in enumerate(values_by_address)
+            for name, value in ((f"address{i}", address), *(
+                (f"{column}{i}", value) for column, value in values.items()
+                if not isinstance(value, ClauseElement)))
+        })
+        if not await conn.execute(query):
+            raise TransactionsSendFailed(extra=dict(accounts=[state.address for state in model_states]))
+
+
+def _write_accounts(model: Table, values_by_address: List[Tuple[str, dict]]) -> ClauseElement:
+    def param(column: str, value, i: int):
+        """SQL expressions (`null()`, the column itself) as they are"""
+        if isinstance(value, ClauseElement):
+            return value
+        return bindparam(f"{column}{i}", type_=model.c[column].type)
+
+    addresses = [bindparam(f"address{i}", type_=model.c.address.type) for i in range(len(values_by_address))]
+    if len(values_by_address) == 1:
+        _, values = values_by_address[0]
+        return update(model).where(model.c.address == addresses[0]).values(
+            {column: param(column, value, 0) for column, value in values.items()})
+    columns = {column for _, values in values_by_address for column in values}
+    return update(model).where(model.c.address.in_(addresses)).values({
+        column: case(
+            *[(model.c.address == addresses[i], param(column, values.get(column, model.c[column]), i))
+              for i, (_, values) in enumerate(values_by_address)],
+        ) for column in sorted(columns)
+    })
+
+
+def _with_updated_at(values: dict) -> dict:
+    """`values` and an explicit `updated_at`: the returned row has to be the stored one, not the DB clock's"""
+    return {**values, "updated_at": datetime.now(timezone.utc).replace(microsecond=0)}
+
+
+async def insert_txn(conn: Connection, txn_model: Table, values: dict) -> dict:
+    """Insert the transaction record, returning it the way it reads back from `txn_model`"""
+    values = _with_updated_at(values)
+    query = statements.template(
+        (txn_model.name, 'insert', tuple(values)),
+        lambda: txn_model.insert().values({
+            column: bindparam(f"v_{column}", type_=txn_model.c[column].type) for column in values})
+    ).bind(**{f"v_{column}": value for column, value in values.items()})
+    try:
+        insert_id = await conn.execute(query)
+    except IntegrityError as e:
+        raise TransactionsSendFailed(extra=dict(e=e))
+    if not insert_id:
+        raise TransactionsSendFailed(extra=dict(txn=values['hash']))
+    return _txn_row(txn_model, values, insert_id)
+
+
+async def insert_txns(conn: Connection, txn_model: Table, values: List[dict]) -> List[dict]:
+    """One multi-row `INSERT` of transaction records, returned like `insert_txn` without their ids"""
+    values = [_with_updated_at(v) for v in values]
+    try:
+        await conn.execute(txn_model.insert().values(values))
+    except IntegrityError as e:
+        raise TransactionsSendFailed(extra=dict(e=e))
+    return [_txn_row(txn_model, v, None) for v in values]
+
+
+def _txn_row(txn_model: Table, values: dict, id_: Optional[int]) -> dict:
+    row = {c.name: values.get(c.name) for c in txn_model.c}
+    row['id'] = id_
+    row['created_at'] = row['created_at'].replace(tzinfo=None)
+    row['updated_at'] = row['updated_at'].replace(tzinfo=None)
+    if row['amount'] is not None:
+        row['amount'] = Decimal(row['amount']).quantize(AMOUNT_EXP)
+    return row
+
+
+async def transfer(conn: Connection, txn_model: Table, models: Dict[str, Table], txn_hash: str, asset: str,
+                   from_addr: str, to_addr: str, amount: Decimal, from_sequence: int, memo: str,
+                   create_at: int) -> dict:
+    """A single transfer, to be run inside a db transaction.
+
+    Lock both accounts, check and compute the new states in Python, then write both accounts,
+    the transaction record and the history index: no re-reads in between.
+    """
+    states = await lock_accounts(conn, models)
+    from_state, to_state = states[from_addr], states[to_addr]
+    if from_state.sequence != from_sequence:
+        raise TransactionsSendFailed(extra=dict(sequence=from_sequence))
+    from_state.apply(asset, -amount)
+    from_state.sequence += 1
+    to_state.apply(asset, amount)
+
+    await write_accounts(conn, (from_state, to_state), txn_hash)
+    txn_row = await insert_txn(conn, txn_model, {
+        "hash": txn_hash,
+        "asset": asset,
+        "from": from_addr,
+        "to": to_addr,
+        "amount": amount,
+        "from_sequence": from_sequence,
+        "is_success": True,
+        "memo": memo,
+        "is_bulk": False,
+        "created_at": Arrow.fromtimestamp(create_at).to('utc').datetime
+    })
+    await AMSCore.add_acc_txn(conn, txn_hash, (from_addr, models[from_addr]), (to_addr, models[to_addr]))
+    return txn_row
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from databases.core import Connection
+from loguru import logger
+from redis.exceptions import LockError
+from sqlalchemy import Table, select
+
+from AMS.app.model import Account, Transaction
+from AMS.app.telegram import send_msg, AMSWarningLevel
+from AMS.clients import redis_client
+from AMS.config import settings
+from AMS.core import AMSCore
+from AMS.core.metrics import metrics
+from AMS.exceptions import InvalidAccount, InvalidTransaction
+
+DONE = b'done'
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=settings.AMS_VERIFIER_PROCESSES)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def verify_accounts(rows: List[Tuple[dict, list]]) -> List[str]:
+    """Hashes of the invalid account rows, run in the process pool (no memo, every row is hashed)"""
+    invalid = []
+    for row, balances in rows:
+        try:
+            AMSCore._check_acc_row(SimpleNamespace(**row), balances)
+        except InvalidAccount:
+            invalid.append(row['hash'])
+    return invalid
+
+
+def verify_transactions(rows: List[dict]) -> List[str]:
+    """Hashes of the invalid transaction rows, run in the process pool"""
+    invalid = []
+    for row in rows:
+        try:
+            AMSCore.validate_hash(
+                txn_hash=row['hash'], asset=row['asset'], from_addr=row['from'], to_addr=row['to'],
+                amount=row['amount'], from_sequence=row['from_sequence'], op=row['op'],
+                exception=InvalidTransaction, raise_expire=False
+            )
+        except InvalidTransaction:
+            invalid.append(row['hash'])
+    return invalid
+
+
+async def shard_models(conn: Connection) -> List[Tuple[Table, Table]]:
+    """(origin model, model) of every existing `Account__N` and `Transaction__YYYY_MM`"""
+    await AMSCore.prewarm(conn)
+    return [
+        (origin, AMSCore.model_mapping[table_name])
+        for table_name in sorted(AMSCore.model_mapping)
+        for origin in (Account, Transaction)
+        if table_name.startswith(f"{origin.name}__")
+    ]
+
+
+async def _account_batch(conn: Connection, model: Table, rows: list) -> List[Tuple[dict, list]]:
+    """Rows with the balances their hash covers, `AccountBalance__N` read with one `IN` per batch"""
+    balances = {row.address: [] for row in rows if row.balances is None}
+    if balances:
+        balance_model = await AMSCore.acc_balance_model(model, conn=conn)
+        for r in await conn.fetch_all(
+                select(balance_model.c.address, balance_model.c.asset, balance_model.c.balance).
+                where(balance_model.c.address.in_(list(balances))).
+                order_by(balance_model.c.address, balance_model.c.id)):
+            balances[r.address].append({"asset": r.asset, "balance": AMSCore.format_amount(r.balance)})
+    return [(dict(row), balances.get(row.address)) for row in rows]
+
+
+async def verify_table(conn: Connection, origin: Table, model: Table, deadline: float) -> bool:
+    """Verify `model` from its checkpoint on, until it's done (`True`) or `deadline` is reached"""
+    checkpoint = settings.AMS_VERIFIER_CHECKPOINT_NAME
+    last_id = await redis_client.hget(checkpoint, model.name)
+    if last_id == DONE:
+        return True
+    last_id = int(last_id or 0)
+    loop = asyncio.get_running_loop()
+
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        rows = await conn.fetch_all(
+            select(model).where(model.c.id > last_id).order_by(model.c.id).limit(settings.AMS_VERIFIER_BATCH_SIZE))
+        if not rows:
+            await redis_client.hset(checkpoint, model.name, DONE)
+            return True
+
+        if origin is Account:
+            invalid = await loop.run_in_executor(pool(), verify_accounts, await _account_batch(conn, model, rows))
+            level, kind = AMSWarningLevel.invalid_account, "Account"
+        else:
+            invalid = await loop.run_in_executor(pool(), verify_transactions, [dict(row) for row in rows])
+            level, kind = AMSWarningLevel.invalid_transaction, "Transaction"
+        for _hash in invalid:
+            logger.error(f"verifier: {model.name} invalid {_hash}")
+            await send_msg(f"{kind}: {_hash}", level=level)
+
+        last_id = rows[-1].id
+        await redis_client.hset(checkpoint, model.name, last_id)
+        metrics.inc('verifier.rows', len(rows))
+        metrics.inc('verifier.invalid', len(invalid))
+        # throttle to AMS_VERIFIER_ROWS_PER_SEC
+        await asyncio.sleep(max(0., len(rows) / settings.AMS_VERIFIER_ROWS_PER_SEC - (time.monotonic() - started)))
+    return False
+
+
+async def run():
+    """One slice of the verification pass, resumed from the checkpoint by the next run.
+
+    Only one worker runs at a time. When every table is done, the checkpoint is dropped and the next run
+    starts a new pass.
+    """
+    if not settings.AMS_VERIFIER_ROWS_PER_SEC:
+        return
+    try:
+        async with redis_client.lock(settings.AMS_VERIFIER_LOCK_NAME, blocking_timeout=0,
+                                     timeout=settings.AMS_VERIFIER_RUN_SECONDS + 60):
+            deadline = time.monotonic() + settings.AMS_VERIFIER_RUN_SECONDS
+            async with AMSCore.conn() as conn:
+                for origin, model in await shard_models(conn):
+                    if not await verify_table(conn, origin, model, deadline):
+                        return
+            await redis_client.delete(settings.AMS_VERIFIER_CHECKPOINT_NAME)
+            metrics.inc('verifier.passes')
+            logger.info("verifier: pass done")
+    except LockError:
+        # another worker holds the verifier
+        return
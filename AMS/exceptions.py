@@ -103,3 +103,11 @@ class InvalidAccount(SanicException):
     @property
     def message(self):
         return f"Invalid Account: {self.extra.get('addr')}"
+
+
+class TransactionInProgress(SanicException):
+    status_code = 40013
+
+    @property
+    def message(self):
+        return f"Transaction {self.extra.get('txn_hash')} is in progress, retry later"
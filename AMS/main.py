@@ -7,16 +7,21 @@ from sanic import Sanic, Blueprint
 from sanic.handlers import ErrorHandler
 from sqlalchemy.sql.ddl import DropTable, CreateTable, CreateIndex
 from loguru import logger
+from redis.exceptions import LockError
 from sanic_scheduler import SanicScheduler, task
 from telethon import TelegramClient
 
 from AMS.app.account.api import accounts_v1_bp
+from AMS.app.metrics.api import metrics_v1_bp
 from AMS.app.transaction.api import transactions_v1_bp
-from AMS.app.model import Transaction, Account
+from AMS.app.model import Transaction, Account, AccountTransaction, AccountBalance
 from AMS.app.telegram import send_from_redis_to_telegram
 from AMS.app.transaction.faucet import transactions_faucet_v1_bp
-from AMS.clients import database, redis_client
+from AMS.clients import database, databases, replica_databases, redis_client
 from AMS.config import settings
+from AMS.core import AMSCore, verifier, executor, reshard, sharding, replicas
+from AMS.core.faucet import faucet_engine
+from AMS.core.group_commit import group_commit
 from AMS.core.log import LOGGING_CONFIG, fmt
 
 logger.remove(0)    # remove default stderr sink
@@ -30,7 +35,7 @@ logger.add(
 app = Sanic(settings.APP_NAME, log_config=LOGGING_CONFIG)
 app.config.FALLBACK_ERROR_FORMAT = "json"
 
-bp = Blueprint.group(accounts_v1_bp, transactions_v1_bp, transactions_faucet_v1_bp, url_prefix='/ams')
+bp = Blueprint.group(accounts_v1_bp, transactions_v1_bp, transactions_faucet_v1_bp, metrics_v1_bp, url_prefix='/ams')
 app.blueprint(bp)
 scheduler = SanicScheduler(app)
 
@@ -38,12 +43,18 @@ scheduler = SanicScheduler(app)
 @app.before_server_start
 async def setup_db(app_, _):
     logger.info('db: connecting ...')
-    await database.connect()
-    logger.info(f'db: connection {database.is_connected}')
+    for name, database_ in databases.items():
+        await database_.connect()
+        logger.info(f'db: {name} connection {database_.is_connected}')
+    await replicas.setup(databases, replica_databases)
     app_.ctx.database = database
+    app_.ctx.databases = databases
+    app_.ctx.replicas = replica_databases
     async with database.connection() as conn:
         if settings.RECREATE_TABLES:
             await conn.execute(DropTable(Transaction, if_exists=True))
+            await conn.execute(DropTable(AccountTransaction, if_exists=True))
+            await conn.execute(DropTable(AccountBalance, if_exists=True))
             await conn.execute(DropTable(Account, if_exists=True))
             print(CreateTable(Account))
             print(CreateTable(Transaction))
@@ -55,14 +66,51 @@ async def setup_db(app_, _):
             if Transaction.indexes:
                 for index in Transaction.indexes:
                     await conn.execute(CreateIndex(index))
+            await conn.execute(CreateTable(AccountTransaction, if_not_exists=True))
+            for index in AccountTransaction.indexes:
+                await conn.execute(CreateIndex(index))
+            await conn.execute(CreateTable(AccountBalance, if_not_exists=True))
+            for index in AccountBalance.indexes:
+                await conn.execute(CreateIndex(index))
+
+
+async def upcoming_tables(blocking_timeout: float):
+    """Create the upcoming shard tables under a lock (one worker runs the DDL), then register what exists"""
+    async with sharding.connection(databases) as conn:
+        try:
+            async with redis_client.lock(settings.AMS_DDL_LOCK_NAME, timeout=60, blocking_timeout=blocking_timeout):
+                await AMSCore.create_upcoming_tables(conn)
+        except LockError:
+            logger.info('tables: another worker is creating them')
+        await AMSCore.prewarm(conn)
+
+
+@app.before_server_start
+async def prewarm_tables(*_):
+    # routing first, the upcoming tables include the target shards of a running reshard
+    await reshard.refresh()
+    async with sharding.connection(databases) as conn:
+        await AMSCore.prewarm(conn)
+    await upcoming_tables(blocking_timeout=60)
+    logger.info(f'tables: {len(AMSCore.model_mapping)} shard tables registered')
+
+
+@app.before_server_stop
+async def stop_batchers(*_):
+    await group_commit.stop()
+    await faucet_engine.stop()
 
 
 @app.after_server_stop
 async def stop_db(app_, _):
     logger.info('db: disconnecting ...')
-    await database.disconnect()
-    logger.info(f'db: connection {database.is_connected}')
+    for name, database_ in databases.items():
+        await database_.disconnect()
+        logger.info(f'db: {name} connection {database_.is_connected}')
+    await replicas.disconnect(replica_databases)
     app_.ctx.database = None
+    app_.ctx.databases = None
+    app_.ctx.replicas = None
 
 
 @app.before_server_start
@@ -100,6 +148,40 @@ async def add_bot_sender(_):
     await send_from_redis_to_telegram()
 
 
+@task(timedelta(hours=1), start=timedelta(minutes=1))
+async def create_upcoming_tables(_):
+    # next month's transaction table exists weeks before the first transfer needs it
+    await upcoming_tables(blocking_timeout=0)
+
+
+@task(timedelta(seconds=settings.AMS_RESHARD_REFRESH_SECONDS), start=timedelta(seconds=5))
+async def refresh_reshard(_):
+    await reshard.refresh()
+
+
+@task(timedelta(seconds=settings.AMS_XA_RECOVER_INTERVAL_SECONDS), start=timedelta(seconds=10))
+async def recover_xa(_):
+    if len(databases) > 1:
+        await sharding.recover(databases)
+
+
+@task(timedelta(seconds=settings.AMS_REPLICA_HEARTBEAT_SECONDS), start=timedelta(seconds=1))
+async def measure_replicas(_):
+    if replica_databases:
+        await replicas.measure(databases, replica_databases)
+
+
+@task(timedelta(seconds=settings.AMS_VERIFIER_INTERVAL_SECONDS), start=timedelta(seconds=30))
+async def verify_integrity(_):
+    await verifier.run()
+
+
+@app.after_server_stop
+async def stop_pools(*_):
+    verifier.shutdown()
+    executor.shutdown()
+
+
 class AMSErrorHandler(ErrorHandler):
     def default(self, request, exception):
         self.log(request, exception)
@@ -0,0 +1,28 @@
+import asyncio
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path().absolute().parent))
+
+from loguru import logger
+
+from AMS.clients import databases
+from AMS.core.migration import MIGRATIONS
+
+
+async def migrate(name: str):
+    logger.info(f'migrate: {name} ...')
+    for database in databases.values():
+        await database.connect()
+    try:
+        await MIGRATIONS[name](databases)
+    finally:
+        for database in databases.values():
+            await database.disconnect()
+    logger.info(f'migrate: {name} done')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print(f"usage: python migrate.py <{'|'.join(MIGRATIONS)}>")
+        sys.exit(1)
+    asyncio.run(migrate(sys.argv[1]))
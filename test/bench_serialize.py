@@ -0,0 +1,77 @@
+"""One 1k row history page as JSON: `dict(row)`, Arrow and `json.dumps(cls=MyEncoder)` as it was per row vs.
+`TransactionRow.to_json` and `AMS.core.encoder.dumps`. Checks both give the same bytes first.
+
+No MySQL needed: rows come from an in-memory SQLite copy of `Transaction` (same columns, same Python types).
+
+    cd AMS && python ../test/bench_serialize.py
+    cd AMS && TZ=America/New_York python ../test/bench_serialize.py
+"""
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'AMS')]
+
+import sqlalchemy  # noqa: E402
+from arrow import Arrow  # noqa: E402
+from dateutil import tz  # noqa: E402
+
+import AMS.core  # noqa: E402, F401
+from AMS.app.model import Transaction, TransactionRow  # noqa: E402
+from AMS.core.encoder import MyEncoder, dumps  # noqa: E402
+
+PAGE = 1000
+
+
+def legacy_to_json(row, replace_id_with_hash=False):
+    """`TransactionRow.to_json` before the row driven version"""
+    d_row = dict(row)
+    d_row.pop('id', None)
+    d_row['op'] = json.loads(d_row['op']) if isinstance(d_row['op'], str) else d_row['op']
+    d_row['is_bulk'] = bool(d_row['is_bulk'])
+    d_row['created_at_dt'] = Arrow.fromdatetime(d_row['created_at'], tzinfo=tz.tzutc()).to(tz.gettz())
+    d_row['created_at'] = int(d_row['created_at_dt'].timestamp())
+    d_row['updated_at_dt'] = Arrow.fromdatetime(d_row['updated_at'], tzinfo=tz.tzutc()).to(tz.gettz())
+    d_row['updated_at'] = int(d_row['updated_at_dt'].timestamp())
+    d_row['is_success'] = bool(d_row['is_success'])
+    if replace_id_with_hash:
+        d_row['id'] = d_row['hash']
+    return d_row
+
+
+def page():
+    engine = sqlalchemy.create_engine('sqlite://')
+    model = sqlalchemy.Table('Transaction', sqlalchemy.MetaData(), *(
+        sqlalchemy.Column(c.name, sqlalchemy.DateTime() if c.name.endswith('_at') else c.type) for c in Transaction.c
+    ))
+    model.metadata.create_all(engine)
+    start = datetime(2024, 3, 10, 5, 59, 58, 250000)   # crosses US DST, and microseconds on some rows
+    engine.execute(model.insert(), [{
+        "id": i, "hash": f"{i:074x}", "asset": None if i % 10 == 0 else 'USDT', "from": 'GA' + 'A' * 54,
+        "to": None if i % 10 == 0 else 'GB' + 'B' * 54, "is_bulk": i % 10 == 0,
+        "op": [{"to": 'GC' + 'C' * 54, "asset": 'USDT', "amount": '1.5000000'}] if i % 10 == 0 else None,
+        "amount": None if i % 10 == 0 else Decimal(i) / 7, "from_sequence": i, "is_success": True,
+        "memo": 'ünïcode' if i % 3 == 0 else '', "created_at": start + timedelta(seconds=i // 4),
+        "updated_at": (start + timedelta(seconds=i // 4)).replace(microsecond=0),
+    } for i in range(PAGE)])
+    return engine.execute(model.select().order_by(model.c.id)).fetchall()
+
+
+def main(number: int = 20):
+    rows = page()
+    before = lambda: json.dumps([legacy_to_json(r, True) for r in rows], cls=MyEncoder)  # noqa: E731
+    after = lambda: dumps([TransactionRow.to_json(r, True) for r in rows])  # noqa: E731
+    assert before() == after(), "output differs"
+    for row in rows[:5]:
+        assert json.dumps(legacy_to_json(row), cls=MyEncoder) == dumps(TransactionRow.to_json(row))
+    for name, fn in (('dict + Arrow + MyEncoder', before), ('row driven', after)):
+        seconds = min(timeit.repeat(fn, number=number, repeat=3))
+        print(f"{name:>24}: {seconds / number * 1e3:8.2f} ms per {PAGE} row page")
+
+
+if __name__ == '__main__':
+    main()
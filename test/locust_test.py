@@ -21,4 +21,26 @@ class WebsiteUser(FastHttpUser):
 
     # @task
     # def stats(self):
-    #     self.client.get("/stats/requests")
\ No newline at end of file
+    #     self.client.get("/stats/requests")
+
+
+class AccountUser(FastHttpUser):
+    """
+    Mixed account load: creating accounts (keypair, AES, hashing) next to cheap reads,
+    compare the reads' p99 with and without the executor offloading
+    """
+
+    host = "http://127.0.0.1:8000"
+    addresses = []
+
+    @task(1)
+    def create_account(self):
+        with self.client.post("/v1/ams/accounts", catch_response=True) as resp:
+            if resp.status_code == 201:
+                self.addresses.append(resp.json()['address'])
+
+    @task(10)
+    def sequence(self):
+        if self.addresses:
+            self.client.get(f"/v1/ams/accounts/{self.addresses[-1]}/sequence",
+                            name="/v1/ams/accounts/[address]/sequence")
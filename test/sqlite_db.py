@@ -0,0 +1,117 @@
+"""The part of a `databases` connection the core uses, over in-memory SQLite: for tests of code written against
+MySQL, without a MySQL.
+
+Tables are copies of the models SQLite can create (integer primary keys auto-incrementing, a UTC+8
+`CURRENT_TIMESTAMP` in place of MySQL's `ON UPDATE` defaults), registered in `AMSCore.model_mapping` under the
+names the code looks up. Statements run through SQLAlchemy Core, `statements.Prepared` ones with their bound
+values, `check_tables`' `SHOW TABLES LIKE` on `sqlite_master`.
+"""
+from contextlib import asynccontextmanager
+import sqlalchemy
+from sqlalchemy import Column, MetaData, Table, UniqueConstraint, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import Insert
+
+from AMS.core import AMSCore, statements
+
+
+@compiles(Insert, 'sqlite')
+def _insert_ignore(insert, compiler, **kw):
+    """MySQL's `INSERT IGNORE`"""
+    return compiler.visit_insert(insert, **kw).replace('INSERT IGNORE', 'INSERT OR IGNORE', 1)
+
+
+def _column(column: Column) -> Column:
+    if column.primary_key:
+        return Column(column.name, sqlalchemy.Integer, primary_key=True)
+    server_default = column.server_default.arg if column.server_default is not None else None
+    if column.name.endswith('_at'):
+        # the session's local time, as MySQL's `CURRENT_TIMESTAMP` (a UTC+8 session)
+        server_default = text("(datetime(CURRENT_TIMESTAMP, '+8 hours'))")
+    return Column(column.name, column.type, nullable=column.nullable, server_default=server_default,
+                  default=column.default.arg if column.default is not None else None)
+
+
+class SQLiteConnection:
+    """One SQLite connection, shared by every `async with` of it. `sync` is there for the tests' own reads"""
+
+    def __init__(self):
+        engine = sqlalchemy.create_engine('sqlite://', future=True, poolclass=StaticPool, isolation_level='AUTOCOMMIT')
+        self.sync = engine.connect()
+        self.metadata = MetaData()
+        self._depth = 0
+        statements._templates.clear()
+
+    def table(self, model: Table, name: str) -> Table:
+        """`model` as table `name`, created and registered"""
+        table = Table(name, self.metadata, *(_column(c) for c in model.c), *(
+            UniqueConstraint(*(c.name for c in constraint.columns))
+            for constraint in model.constraints if isinstance(constraint, UniqueConstraint)
+        ))
+        table.create(self.sync)
+        AMSCore.model_mapping[name] = table
+        return table
+
+    def close(self):
+        """Unregisters the tables, created here or found by `check_tables`"""
+        for name in self.sync.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars():
+            AMSCore.model_mapping.pop(name, None)
+        statements._templates.clear()
+        self.sync.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    @staticmethod
+    def _statement(query, values=None):
+        if isinstance(query, statements.Prepared):
+            return query.statement, query.values
+        if isinstance(query, str):
+            if query.startswith('SHOW TABLES LIKE'):
+                query = r"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :table_name ESCAPE '\'"
+            return text(query), values or {}
+        return (query.values(**values) if values else query), {}
+
+    def _run(self, query, values=None):
+        statement, params = self._statement(query, values)
+        return statement, self.sync.execute(statement, params)
+
+    async def fetch_all(self, query, values=None):
+        return self._run(query, values)[1].fetchall()
+
+    async def fetch_one(self, query, values=None):
+        return self._run(query, values)[1].first()
+
+    async def fetch_val(self, query, values=None, column=0):
+        row = self._run(query, values)[1].first()
+        return None if row is None else row[column]
+
+    async def execute(self, query, values=None):
+        """What aiomysql's cursor gives `databases`: the inserted id, or the number of rows"""
+        statement, result = self._run(query, values)
+        return result.lastrowid if isinstance(statement, Insert) and result.lastrowid else result.rowcount
+
+    @asynccontextmanager
+    async def transaction(self):
+        """A transaction, or a savepoint inside one, rolled back on error"""
+        if self._depth:
+            savepoint = f"sp{self._depth}"
+            begin, commit = f"SAVEPOINT {savepoint}", f"RELEASE SAVEPOINT {savepoint}"
+            rollback = (f"ROLLBACK TO SAVEPOINT {savepoint}", commit)
+        else:
+            begin, commit, rollback = 'BEGIN', 'COMMIT', ('ROLLBACK', )
+        self.sync.exec_driver_sql(begin)
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            for sql in rollback:
+                self.sync.exec_driver_sql(sql)
+            raise
+        self._depth -= 1
+        self.sync.exec_driver_sql(commit)
@@ -0,0 +1,62 @@
+"""History and search cursors: what a client sends is decoded or refused with `ValueError` (a 400), never a 500.
+
+    cd AMS && python -m pytest ../test
+"""
+import sys
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'AMS')]
+
+from arrow import Arrow  # noqa: E402
+
+from AMS.core import AMSCore  # noqa: E402
+
+
+class DecodeCursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        created_at = datetime(2024, 5, 6, 7, 8, 9)
+        cursor = AMSCore.encode_acc_txn_cursor(created_at, 42)
+        self.assertEqual(AMSCore.decode_acc_txn_cursor(cursor), (created_at, 42))
+        self.assertEqual(AMSCore.acc_txn_cursor(cursor), (created_at, 42))
+
+    def test_out_of_range_timestamp(self):
+        # base64 of "-99999999999999999999:1", `utcfromtimestamp` overflows
+        for cursor in ('LTk5OTk5OTk5OTk5OTk5OTk5OTk5OjE', 'OTk5OTk5OTk5OTk5OTk5OTk6MQ'):
+            with self.assertRaises(ValueError):
+                AMSCore.decode_acc_txn_cursor(cursor)
+
+    def test_garbage(self):
+        for cursor in ('!!!', 'bm9jb2xvbg', 'YTpi', '//79'):
+            with self.assertRaises(ValueError):
+                AMSCore.decode_acc_txn_cursor(cursor)
+
+    def test_hash_cursor_kept(self):
+        self.assertEqual(AMSCore.acc_txn_cursor('h' * 74), 'h' * 74)
+        self.assertIsNone(AMSCore.acc_txn_cursor(None))
+        self.assertIsNone(AMSCore.acc_txn_cursor(''))
+
+
+class SearchCursorTest(unittest.TestCase):
+    start, end = Arrow(2024, 1, 1), Arrow(2024, 2, 1)
+
+    def test_in_range(self):
+        created_at = datetime(2024, 1, 15, 12)
+        cursor = AMSCore.encode_acc_txn_cursor(created_at, 7)
+        self.assertEqual(AMSCore.search_txn_cursor(cursor, self.start, self.end), (created_at, 7))
+        self.assertIsNone(AMSCore.search_txn_cursor(None, self.start, self.end))
+
+    def test_out_of_range(self):
+        for created_at in (datetime(2023, 12, 31, 23, 59, 59), datetime(2024, 2, 1, 0, 0, 1)):
+            with self.assertRaises(ValueError):
+                AMSCore.search_txn_cursor(AMSCore.encode_acc_txn_cursor(created_at, 7), self.start, self.end)
+
+    def test_overflow(self):
+        with self.assertRaises(ValueError):
+            AMSCore.search_txn_cursor('LTk5OTk5OTk5OTk5OTk5OTk5OTk5OjE', self.start, self.end)
+
+
+if __name__ == '__main__':
+    unittest.main()
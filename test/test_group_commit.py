@@ -0,0 +1,136 @@
+"""`GroupCommit` on SQLite (see `sqlite_db`): a batch is one transaction with a savepoint per transfer, a failed
+batch is committed one transfer at a time, and batching is off with more than one MySQL instance.
+
+    cd AMS && python -m pytest ../test
+"""
+import asyncio
+import sys
+import unittest
+from decimal import Decimal
+from pathlib import Path
+from unittest.mock import patch
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'AMS')]
+
+from pymysql import OperationalError  # noqa: E402
+
+from AMS.core import AMSCore  # noqa: E402
+from AMS.core.group_commit import GroupCommit, TransferJob, databases  # noqa: E402
+from AMS.core.metrics import metrics  # noqa: E402
+from AMS.exceptions import InsufficientFunds, TransactionsSendFailed  # noqa: E402
+from test_transfer import ASSET, CREATE_AT, AccountTables  # noqa: E402
+
+
+class FailsAfterWriting(TransferJob):
+    """A transfer failing on its own once everything is written"""
+
+    async def run(self, conn) -> dict:
+        await super().run(conn)
+        raise TransactionsSendFailed(extra=dict(txn=self.txn_hash))
+
+
+class DeadlocksOnce(TransferJob):
+    """A transfer whose first attempt takes the whole db transaction down"""
+    attempts = 0
+
+    async def run(self, conn) -> dict:
+        DeadlocksOnce.attempts += 1
+        if DeadlocksOnce.attempts == 1:
+            raise OperationalError(1213, 'Deadlock found when trying to get lock')
+        return await super().run(conn)
+
+
+class HeldOpen(TransferJob):
+    """A transfer keeping its batch in `commit` until `release` is set"""
+    started: asyncio.Event
+    release: asyncio.Event
+
+    async def run(self, conn) -> dict:
+        HeldOpen.started.set()
+        await HeldOpen.release.wait()
+        return await super().run(conn)
+
+
+class GroupCommitTest(AccountTables):
+    def setUp(self):
+        super().setUp()
+        self.group_commit = GroupCommit(enabled=True, window=0.001, max_batch=8, max_pending=100)
+        self.new_conn = patch.object(AMSCore, 'new_conn', lambda like=None: self.conn)
+        self.new_conn.start()
+        DeadlocksOnce.attempts = 0
+
+    async def asyncTearDown(self):
+        await self.group_commit.stop()
+        self.new_conn.stop()
+
+    def job(self, from_addr: str, to_addr: str, amount: str, job_cls=TransferJob) -> TransferJob:
+        return job_cls(
+            txn_model=self.txns, models={from_addr: self.accounts, to_addr: self.accounts},
+            txn_hash=self.txn_hash(from_addr, to_addr, amount, 0), asset=ASSET, from_addr=from_addr, to_addr=to_addr,
+            amount=Decimal(amount), from_sequence=0, memo='', create_at=CREATE_AT
+        )
+
+    async def submit(self, *jobs: TransferJob) -> list:
+        """Submitted together, i.e. in one batch"""
+        return await asyncio.gather(*(self.group_commit.submit(job) for job in jobs), return_exceptions=True)
+
+    def balance(self, address: str) -> str:
+        return self.stored(address)[1][0]['balance']
+
+    async def test_savepoint_per_transfer(self):
+        a, b, c, d, e, f = (self.add_account(balance) for balance in ('100', '0', '5', '0', '50', '0'))
+        batches, fallbacks = metrics.counters['group_commit.batches'], metrics.counters['group_commit.fallback']
+        results = await self.submit(
+            self.job(a, b, '30'), self.job(c, d, '10'), self.job(e, f, '20', FailsAfterWriting))
+
+        self.assertEqual(results[0]['hash'], self.txn_hash(a, b, '30', 0))
+        self.assertIsInstance(results[1], InsufficientFunds)
+        self.assertIsInstance(results[2], TransactionsSendFailed)
+        # only `a -> b` is left: the failed transfers rolled back to their savepoints, nothing else
+        self.assertEqual([self.balance(address) for address in (a, b, c, d, e, f)],
+                         ['70.0000000', '30.0000000', '5.0000000', '0.0000000', '50.0000000', '0.0000000'])
+        self.assertEqual([self.stored(address)[0].sequence for address in (a, c, e)], [1, 0, 0])
+        self.assertEqual((self.count(self.txns), self.count(self.history)), (1, 2))
+        self.assertEqual(metrics.counters['group_commit.batches'], batches + 1)
+        self.assertEqual(metrics.counters['group_commit.fallback'], fallbacks)
+
+    async def test_one_by_one_after_batch_failed(self):
+        a, b, c, d = (self.add_account(balance) for balance in ('100', '0', '100', '0'))
+        fallbacks = metrics.counters['group_commit.fallback']
+        results = await self.submit(self.job(a, b, '30'), self.job(c, d, '10', DeadlocksOnce))
+
+        self.assertEqual([r['hash'] for r in results], [self.txn_hash(a, b, '30', 0), self.txn_hash(c, d, '10', 0)])
+        self.assertEqual([self.balance(address) for address in (a, b, c, d)],
+                         ['70.0000000', '30.0000000', '90.0000000', '10.0000000'])
+        self.assertEqual(self.count(self.txns), 2)
+        self.assertEqual(metrics.counters['group_commit.fallback'], fallbacks + 1)
+
+    async def test_stop_mid_commit(self):
+        a, b, c, d = (self.add_account(balance) for balance in ('100', '0', '100', '0'))
+        HeldOpen.started, HeldOpen.release = asyncio.Event(), asyncio.Event()
+        in_flight = asyncio.ensure_future(self.group_commit.submit(self.job(a, b, '30', HeldOpen)))
+        await asyncio.wait_for(HeldOpen.started.wait(), 1)
+        queued = asyncio.ensure_future(self.group_commit.submit(self.job(c, d, '10')))
+        stopping = asyncio.ensure_future(self.group_commit.stop())
+        await asyncio.sleep(0.01)
+        self.assertFalse(stopping.done())
+
+        HeldOpen.release.set()
+        # the batch in `commit` finishes, the queued transfer is committed on its own
+        results = await asyncio.wait_for(asyncio.gather(in_flight, queued, stopping), 1)
+        self.assertEqual([r['hash'] for r in results[:2]],
+                         [self.txn_hash(a, b, '30', 0), self.txn_hash(c, d, '10', 0)])
+        self.assertEqual([self.balance(address) for address in (a, b, c, d)],
+                         ['70.0000000', '30.0000000', '90.0000000', '10.0000000'])
+
+    async def test_accepts(self):
+        self.assertTrue(self.group_commit.accepts())
+        with patch.dict(databases, {'shard1': databases[next(iter(databases))]}):
+            self.assertFalse(self.group_commit.accepts())
+        self.assertFalse(GroupCommit(enabled=False, window=0.001, max_batch=8, max_pending=100).accepts())
+        self.assertFalse(GroupCommit(enabled=True, window=0.001, max_batch=8, max_pending=0).accepts())
+
+
+if __name__ == '__main__':
+    unittest.main()
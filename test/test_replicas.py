@@ -0,0 +1,210 @@
+"""Read replicas: reads leave a lagging or unmeasured replica for its primary, a read the replica misses is
+retried on the primary, and a client asking for the primary never reads a replica.
+
+    cd AMS && python -m pytest ../test
+"""
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'AMS')]
+
+from arrow import Arrow  # noqa: E402
+from sanic import Sanic  # noqa: E402
+from stellar_sdk import Keypair  # noqa: E402
+
+from sqlalchemy import text  # noqa: E402
+
+from AMS.config import settings  # noqa: E402
+from AMS.core import AMSCore, ACC_HASH_V2, replicas  # noqa: E402
+from AMS.core.cache import acc_cache  # noqa: E402
+from AMS.core.metrics import metrics  # noqa: E402
+from AMS.core.sharding import DEFAULT_BACKEND  # noqa: E402
+from AMS.app.model import Account, Transaction  # noqa: E402
+from AMS.app.account.api import account_address_transactions  # noqa: E402
+from AMS.app.transaction.api import get_transaction_by_hash  # noqa: E402
+from AMS.exceptions import AddressNotFound, TransactionNotFound  # noqa: E402
+from sqlite_db import SQLiteConnection  # noqa: E402
+
+CREATE_AT = 1714978089
+
+
+class Database:
+    """A `databases.Database` handing out one SQLite connection, counting how often"""
+    is_connected = True
+
+    def __init__(self):
+        self.conn = SQLiteConnection()
+        self.connections = 0
+
+    def connection(self) -> SQLiteConnection:
+        self.connections += 1
+        return self.conn
+
+
+class Beats:
+    """A `databases.Database` of the `Heartbeat` table only: `beat` is what the row holds, `None` if unreachable"""
+    is_connected = True
+
+    def __init__(self, beat):
+        self.beat = beat
+
+    def connection(self):
+        if self.beat is None:
+            raise ConnectionError('unreachable')
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    async def fetch_val(self, _):
+        return self.beat
+
+    async def execute(self, _):
+        pass
+
+
+class RouteTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.primary, self.replica = object(), object()
+        replicas._lags.clear()
+
+    def tearDown(self):
+        replicas._lags.clear()
+
+    def route(self):
+        return replicas.route({DEFAULT_BACKEND: self.primary}, {DEFAULT_BACKEND: self.replica})[DEFAULT_BACKEND]
+
+    async def measure(self, primary_beat, replica_beat):
+        await replicas.measure({DEFAULT_BACKEND: Beats(primary_beat)}, {DEFAULT_BACKEND: Beats(replica_beat)})
+
+    async def test_caught_up(self):
+        beat = datetime.utcnow()
+        await self.measure(beat, beat - timedelta(seconds=settings.AMS_REPLICA_MAX_LAG_SECONDS / 2))
+        self.assertIs(self.route(), self.replica)
+
+    async def test_lagging(self):
+        fallbacks = metrics.counters['replica.fallback']
+        beat = datetime.utcnow()
+        await self.measure(beat, beat - timedelta(seconds=settings.AMS_REPLICA_MAX_LAG_SECONDS + 1))
+        self.assertIs(self.route(), self.primary)
+        self.assertEqual(metrics.counters['replica.fallback'], fallbacks + 1)
+
+    async def test_unreachable(self):
+        beat = datetime.utcnow()
+        await self.measure(beat, beat)
+        await self.measure(beat, None)
+        self.assertIs(self.route(), self.primary)
+
+    def test_not_measured_lately(self):
+        replicas._lags[DEFAULT_BACKEND] = (0., time.monotonic() - 4 * settings.AMS_REPLICA_HEARTBEAT_SECONDS)
+        self.assertIs(self.route(), self.primary)
+        self.assertEqual(replicas.lag('unknown'), float('inf'))
+
+
+class ReadTest(unittest.IsolatedAsyncioTestCase):
+    """`GET /transactions/<hash>` with the replica caught up, and a transaction it hasn't applied yet"""
+
+    def setUp(self):
+        self.primary, self.replica = Database(), Database()
+        table_name = f"Transaction__{Arrow.fromtimestamp(CREATE_AT).strftime(AMSCore.TABLE_SPLIT_FMT)}"
+        self.tables = {database: database.conn.table(Transaction, table_name)
+                       for database in (self.primary, self.replica)}
+        ctx = Sanic.get_app(settings.APP_NAME, force_create=True).ctx
+        ctx.databases, ctx.replicas = {DEFAULT_BACKEND: self.primary}, {DEFAULT_BACKEND: self.replica}
+        replicas._lags[DEFAULT_BACKEND] = (0., time.monotonic())
+
+        from_addr, to_addr = Keypair.random().public_key, Keypair.random().public_key
+        _, txn_hash = AMSCore.build_txn_hash('USDT', from_addr, to_addr, Decimal('1.5'), 0, CREATE_AT)
+        self.txn_hash = AMSCore.build_ts_hash(CREATE_AT, txn_hash)
+        self.txn = dict(hash=self.txn_hash, asset='USDT', to=to_addr, amount=Decimal('1.5'), from_sequence=0,
+                        is_success=True, is_bulk=False, memo='', created_at=datetime.utcfromtimestamp(CREATE_AT),
+                        **{"from": from_addr})
+
+    def tearDown(self):
+        replicas._lags.clear()
+        for database in (self.primary, self.replica):
+            database.conn.close()
+
+    def insert(self, database: Database):
+        database.conn.sync.execute(self.tables[database].insert().values(self.txn))
+
+    async def get(self, *, primary: bool = False):
+        request = SimpleNamespace(headers={replicas.PRIMARY_HEADER: 'true'} if primary else {})
+        return await get_transaction_by_hash(request, self.txn_hash)
+
+    async def test_replica_read(self):
+        self.insert(self.primary)
+        self.insert(self.replica)
+        self.assertEqual((await self.get()).status, 200)
+        self.assertEqual((self.replica.connections, self.primary.connections), (1, 0))
+
+    async def test_replica_miss_retried_on_primary(self):
+        self.insert(self.primary)
+        self.assertEqual((await self.get()).status, 200)
+        self.assertEqual((self.replica.connections, self.primary.connections), (1, 1))
+
+    async def test_not_found_anywhere(self):
+        with self.assertRaises(TransactionNotFound):
+            await self.get()
+        self.assertEqual((self.replica.connections, self.primary.connections), (1, 1))
+
+    async def test_primary_asked(self):
+        self.insert(self.primary)
+        self.assertEqual((await self.get(primary=True)).status, 200)
+        self.txn_hash = AMSCore.build_ts_hash(CREATE_AT, '0' * 64)
+        with self.assertRaises(TransactionNotFound):
+            await self.get(primary=True)
+        self.assertEqual((self.replica.connections, self.primary.connections), (0, 2))
+
+
+class NoDDLTest(unittest.IsolatedAsyncioTestCase):
+    """Reads of an account whose shard tables the replica doesn't have (yet): not found or empty, no `CREATE`"""
+
+    def setUp(self):
+        self.replica = Database()
+        ctx = Sanic.get_app(settings.APP_NAME, force_create=True).ctx
+        ctx.databases, ctx.replicas = {DEFAULT_BACKEND: Database()}, {DEFAULT_BACKEND: self.replica}
+        replicas._lags[DEFAULT_BACKEND] = (0., time.monotonic())
+        self.address = Keypair.random().public_key
+
+    def tearDown(self):
+        replicas._lags.clear()
+        self.replica.conn.close()
+
+    def tables(self) -> list:
+        query = text("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return self.replica.conn.sync.execute(query).scalars().all()
+
+    async def history(self):
+        request = SimpleNamespace(headers={}, args={})
+        return await account_address_transactions(request, self.address)
+
+    async def test_no_account_table(self):
+        self.assertIsNone(await acc_cache.account(self.address))
+        with self.assertRaises(AddressNotFound):
+            await self.history()
+        self.assertEqual(self.tables(), [])
+
+    async def test_no_history_table(self):
+        accounts = self.replica.conn.table(Account, AMSCore.acc_table_name(self.address))
+        values = dict(address=self.address, sequence=0, secret='secret', mnemonic='mnemonic')
+        _, values['hash'], _ = AMSCore.build_acc_hash_v2(prev_hash=None, delta=None, balances=[], **values)
+        self.replica.conn.sync.execute(accounts.insert().values(hash_version=ACC_HASH_V2, **values))
+
+        self.assertEqual((await acc_cache.account(self.address))['balances'], [])
+        response = await self.history()
+        self.assertEqual((response.status, response.body), (200, b'[]'))
+        self.assertEqual(self.tables(), [accounts.name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""`transfer.transfer` on SQLite (see `sqlite_db`): what a transfer leaves in the account, balance, transaction
+and history tables, and that a failed one leaves nothing.
+
+    cd AMS && python -m pytest ../test
+"""
+import sys
+import unittest
+from decimal import Decimal
+from pathlib import Path
+from unittest.mock import patch
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'AMS')]
+
+from sqlalchemy import delete, func, select  # noqa: E402
+from stellar_sdk import Keypair  # noqa: E402
+
+from AMS.core import AMSCore, ACC_HASH_V1, ACC_HASH_V2, transfer  # noqa: E402
+from AMS.app.model import Account, AccountBalance, AccountTransaction, Transaction  # noqa: E402
+from AMS.exceptions import TransactionsSendFailed  # noqa: E402
+from sqlite_db import SQLiteConnection  # noqa: E402
+
+ASSET = 'USDT'
+CREATE_AT = 1714978089
+
+
+class AccountTables(unittest.IsolatedAsyncioTestCase):
+    """`Account__1` and the tables next to it on SQLite, accounts holding `ASSET`"""
+
+    def setUp(self):
+        self.conn = SQLiteConnection()
+        self.accounts = self.conn.table(Account, 'Account__1')
+        self.balances = self.conn.table(AccountBalance, 'AccountBalance__1')
+        self.history = self.conn.table(AccountTransaction, 'AccountTransaction__1')
+        self.txns = self.conn.table(Transaction, 'Transaction__2024_05')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def add_account(self, balance: str, hash_version: int = ACC_HASH_V2) -> str:
+        """An account holding `balance` of `ASSET`, its balances in `AccountBalance__1`, or v1 in the legacy JSON"""
+        address = Keypair.random().public_key
+        values = dict(address=address, sequence=0, secret='secret', mnemonic='mnemonic')
+        balances = [{"asset": ASSET, "balance": AMSCore.format_amount(balance)}]
+        if hash_version == ACC_HASH_V2:
+            _, values['hash'], _ = AMSCore.build_acc_hash_v2(prev_hash=None, delta=None, balances=balances, **values)
+            self.conn.sync.execute(self.balances.insert().values(address=address, asset=ASSET, balance=balance))
+            values.update(balances=None, transactions=[], hash_version=ACC_HASH_V2)
+        else:
+            transactions = ['t' * 74]
+            _, values['hash'], _ = AMSCore.build_acc_hash(
+                balances=balances, transactions=transactions, **values)
+            values.update(balances=balances, transactions=transactions, hash_version=ACC_HASH_V1)
+        self.conn.sync.execute(self.accounts.insert().values(**values))
+        return address
+
+    @staticmethod
+    def txn_hash(from_addr: str, to_addr: str, amount: str, from_sequence: int) -> str:
+        _, txn_hash = AMSCore.build_txn_hash(ASSET, from_addr, to_addr, Decimal(amount), from_sequence, CREATE_AT)
+        return AMSCore.build_ts_hash(CREATE_AT, txn_hash)
+
+    def stored(self, address: str):
+        """The account row and its balances as `acc_balances` reads them"""
+        row = self.conn.sync.execute(select(self.accounts).where(self.accounts.c.address == address)).one()
+        balances = self.conn.sync.execute(
+            select(self.balances.c.asset, self.balances.c.balance).
+            where(self.balances.c.address == address).order_by(self.balances.c.id)
+        ).all()
+        return row, [{"asset": r.asset, "balance": AMSCore.format_amount(r.balance)} for r in balances]
+
+    def count(self, table) -> int:
+        return self.conn.sync.execute(select(func.count()).select_from(table)).scalar()
+
+
+class TransferTest(AccountTables):
+    async def send(self, from_addr: str, to_addr: str, amount: str, from_sequence: int) -> str:
+        txn_hash = self.txn_hash(from_addr, to_addr, amount, from_sequence)
+        models = {from_addr: self.accounts, to_addr: self.accounts}
+        async with self.conn.transaction():
+            self.txn_row = await transfer.transfer(self.conn, self.txns, models, txn_hash, ASSET, from_addr, to_addr,
+                                                   Decimal(amount), from_sequence, 'memo', CREATE_AT)
+        return txn_hash
+
+    async def test_balances_and_sequences(self):
+        a, b = self.add_account('100'), self.add_account('0')
+        txn_hash = await self.send(a, b, '30', 0)
+        await self.send(a, b, '0.5', 1)
+
+        row_a, balances_a = self.stored(a)
+        row_b, balances_b = self.stored(b)
+        self.assertEqual((row_a.sequence, balances_a), (2, [{"asset": ASSET, "balance": '69.5000000'}]))
+        self.assertEqual((row_b.sequence, balances_b), (0, [{"asset": ASSET, "balance": '30.5000000'}]))
+        txn = self.conn.sync.execute(select(self.txns).where(self.txns.c.hash == txn_hash)).one()
+        self.assertEqual((txn['from'], txn.to, txn.amount, txn.from_sequence), (a, b, Decimal(30), 0))
+        self.assertEqual(self.count(self.history), 4)
+
+    async def test_returned_row_is_stored(self):
+        a, b = self.add_account('100'), self.add_account('0')
+        txn_hash = await self.send(a, b, '30', 0)
+        stored = self.conn.sync.execute(select(self.txns).where(self.txns.c.hash == txn_hash)).one()
+        self.assertEqual(self.txn_row, dict(stored._mapping))
+
+    async def test_stale_sequence(self):
+        a, b = self.add_account('100'), self.add_account('0')
+        await self.send(a, b, '30', 0)
+        with self.assertRaises(TransactionsSendFailed):
+            await self.send(a, b, '30', 0)
+        self.assertEqual(self.stored(a)[1], [{"asset": ASSET, "balance": '70.0000000'}])
+        self.assertEqual(self.count(self.txns), 1)
+
+    async def test_hash_revalidates(self):
+        a, b = self.add_account('100'), self.add_account('0')
+        before = self.stored(a)[0]
+        txn_hash = await self.send(a, b, '30', 0)
+
+        for address in (a, b):
+            row, balances = self.stored(address)
+            AMSCore.check_acc_row(row, balances)
+        row, _ = self.stored(a)
+        self.assertEqual((row.prev_hash, row.hash_delta['txn']), (before.hash, txn_hash))
+
+    async def test_rowcount_mismatch_rolls_back(self):
+        a, b = self.add_account('100'), self.add_account('0')
+        before_a, before_b = self.stored(a), self.stored(b)
+        lock_accounts = transfer.lock_accounts
+
+        async def lock_and_lose_balance(conn, models):
+            # a writer ignoring the lock: `b`'s balance row is gone when the `UPDATE` runs
+            states = await lock_accounts(conn, models)
+            conn.sync.execute(delete(self.balances).where(self.balances.c.address == b))
+            return states
+
+        with patch.object(transfer, 'lock_accounts', lock_and_lose_balance):
+            with self.assertRaises(TransactionsSendFailed) as failed:
+                await self.send(a, b, '30', 0)
+        self.assertEqual(failed.exception.extra, dict(balances=[(a, ASSET), (b, ASSET)]))
+        self.assertEqual((self.stored(a), self.stored(b)), (before_a, before_b))
+        self.assertEqual((self.count(self.txns), self.count(self.history)), (0, 0))
+
+    async def test_v1_upgraded_on_write(self):
+        a, b = self.add_account('100', ACC_HASH_V1), self.add_account('0')
+        before = self.stored(a)[0]
+        await self.send(a, b, '30', 0)
+
+        row, balances = self.stored(a)
+        self.assertEqual((row.hash_version, row.balances, row.prev_hash), (ACC_HASH_V2, None, before.hash))
+        self.assertEqual(balances, [{"asset": ASSET, "balance": '70.0000000'}])
+        AMSCore.check_acc_row(row, balances)
+        # upgraded once: the next transfer locks and validates it as v2
+        await self.send(a, b, '10', 1)
+        self.assertEqual(self.stored(a)[1], [{"asset": ASSET, "balance": '60.0000000'}])
+
+
+if __name__ == '__main__':
+    unittest.main()